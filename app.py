@@ -0,0 +1,132 @@
+import sys
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from pydantic import create_model
+
+from src.logger import logging
+from src.exception import MyException
+from src.constants import APP_HOST, APP_PORT, SCHEMA_FILE_PATH, TARGET_COLUMN
+from src.entity.config_entity import ServingConfig
+from src.pipeline.prediction_pipeline import MicroBatchPredictor, InvalidRecordError
+from src.utils.main_utils import read_yaml_file
+from src.utils.model_bundle import load_model_file
+
+SCHEMA_TYPES = {'float': float, 'int': int, 'category': str}
+
+
+def get_request_model():
+    """
+    Builds the request body of a single applicant from the input columns of the schema. Categorical
+    columns only accept the values of their categorical_domains, other values are rejected with a 422
+    before the request is queued.
+    """
+    schema = read_yaml_file(file_path = SCHEMA_FILE_PATH)
+    domains = schema.get('categorical_domains', {})
+    fields = {}
+    for column in schema['columns']:
+        (name, dtype), = column.items()
+        if name != TARGET_COLUMN and name not in schema['drop_columns']:
+            field_type = Literal[tuple(domains[name])] if dtype == 'category' and name in domains else SCHEMA_TYPES[dtype]
+            fields[name] = (field_type, ...)
+    return create_model('LoanApplication', **fields)
+
+
+LoanApplication = get_request_model()
+
+
+def load_model(serving_config: ServingConfig):
+    """
+    Loads the model once when the service starts from the local model file or bundle. When a model bucket
+    is configured, a Proj1Estimator serves the current version and polls for new ones.
+    """
+    try:
+        if serving_config.model_file_path is None:
+            raise Exception("No model to serve, set the MODEL_FILE_PATH environment variable")
+        if serving_config.model_bucket_name is None:
+            model = load_model_file(serving_config.model_file_path)
+        else:
+            from src.entity.s3_estimator import Proj1Estimator
+            model = Proj1Estimator(bucket_name = serving_config.model_bucket_name,
+                                   model_path = serving_config.model_file_path,
+                                   max_cached_versions = serving_config.model_cache_max_versions)
+            model.refresh()
+            if serving_config.model_reload_interval_seconds is not None:
+                model.start_polling(serving_config.model_reload_interval_seconds)
+        logging.info(f"Serving model {serving_config.model_file_path}")
+        return model
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    serving_config = ServingConfig()
+    app.state.model = load_model(serving_config)
+    app.state.predictor = MicroBatchPredictor(model = app.state.model, serving_config = serving_config)
+    app.state.predictor.start()
+    yield
+    await app.state.predictor.stop()
+    if hasattr(app.state.model, 'stop_polling'):
+        app.state.model.stop_polling()
+
+
+app = FastAPI(title = 'Loan scoring', lifespan = lifespan)
+
+
+@app.post('/predict')
+async def predict(application: LoanApplication):
+    try:
+        prediction = await app.state.predictor.predict(application.model_dump())
+    except InvalidRecordError as e:
+        raise HTTPException(status_code = 422, detail = str(e))
+    except Exception as e:
+        raise HTTPException(status_code = 500, detail = str(e))
+    return {'prediction': prediction}
+
+
+@app.get('/metrics')
+async def metrics():
+    return app.state.predictor.get_metrics()
+
+
+@app.get('/model')
+async def model_version():
+    model = app.state.model
+    return {'version': getattr(model, 'loaded_version', None), 'cached_versions': getattr(model, 'cached_versions', []),
+            'pinned': getattr(model, 'is_pinned', False)}
+
+
+@app.post('/model/rollback')
+async def rollback(version: Optional[str] = None):
+    if not hasattr(app.state.model, 'rollback'):
+        raise HTTPException(status_code = 400, detail = 'The served model is a local file without versions')
+    try:
+        return {'version': app.state.model.rollback(etag = version)}
+    except Exception as e:
+        raise HTTPException(status_code = 409, detail = str(e))
+
+
+@app.post('/model/unpin')
+async def unpin():
+    if not hasattr(app.state.model, 'unpin'):
+        raise HTTPException(status_code = 400, detail = 'The served model is a local file without versions')
+    app.state.model.unpin()
+    try:
+        # Serve the version in the bucket now rather than at the next poll
+        await asyncio.to_thread(app.state.model.refresh)
+    except Exception as e:
+        raise HTTPException(status_code = 500, detail = str(e))
+    return {'version': app.state.model.loaded_version}
+
+
+@app.get('/health')
+async def health():
+    return {'status': 'ok'}
+
+
+if __name__ == '__main__':
+    uvicorn.run(app, host = APP_HOST, port = APP_PORT)
@@ -0,0 +1,60 @@
+"""
+Benchmark of the dataframe artifact formats: read/write time and file size of
+CSV, Parquet and Arrow IPC on notebooks/loan_data.csv scaled to --rows rows.
+
+Usage:
+    python benchmarks/artifact_formats.py --rows 10000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.constants import SCHEMA_FILE_PATH, TARGET_COLUMN
+from src.utils.main_utils import (read_yaml_file, get_schema_dtypes, apply_schema_dtypes,
+                                  save_dataframe, read_dataframe, read_dataframe_schema)
+
+SOURCE_FILE_PATH = 'notebooks/loan_data.csv'
+
+
+def scale_dataset(rows:int, dtypes:dict) -> pd.DataFrame:
+    source_df = apply_schema_dtypes(pd.read_csv(SOURCE_FILE_PATH), dtypes)
+    repeats = int(np.ceil(rows / len(source_df)))
+    return pd.concat([source_df] * repeats, ignore_index=True).iloc[:rows]
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--formats', nargs='+', default=['csv', 'parquet', 'arrow'])
+    args = parser.parse_args()
+
+    schema_config = read_yaml_file(SCHEMA_FILE_PATH)
+    dtypes = get_schema_dtypes(schema_config)
+    dataframe = scale_dataset(args.rows, dtypes)
+    subset = schema_config['oh_columns'] + [TARGET_COLUMN]
+    print(f"rows: {len(dataframe):,}  in-memory: {dataframe.memory_usage(deep=True).sum() / 2**20:,.1f} MiB")
+
+    print(f"{'format':<10}{'write s':>10}{'read s':>10}{'subset s':>10}{'schema s':>10}{'size MiB':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file_format in args.formats:
+            file_path = os.path.join(tmp_dir, f'loan_data.{file_format}')
+            _, write_time = timed(lambda: save_dataframe(file_path, dataframe))
+            _, read_time = timed(lambda: read_dataframe(file_path, dtypes=dtypes))
+            _, subset_time = timed(lambda: read_dataframe(file_path, columns=subset, dtypes=dtypes))
+            _, schema_time = timed(lambda: read_dataframe_schema(file_path))
+            size = os.path.getsize(file_path) / 2**20
+            print(f"{file_format:<10}{write_time:>10.2f}{read_time:>10.2f}{subset_time:>10.2f}{schema_time:>10.4f}{size:>12,.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark of the KNN neighbor backends (sklearn brute force, KD tree, Ball tree and
+the NumPy IVF index) on notebooks/loan_data.csv transformed with the pipeline
+preprocessor and scaled to --rows reference rows (duplicates get a small jitter).
+
+Reports the build time, recall@k against exact brute force search, and p50/p99
+latency per single row query and per batch of --batch-size rows.
+
+Usage:
+    python benchmarks/neighbor_index.py --rows 200000 --n-probe 4 8 16
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.components.data_transformation import DataTransformation
+from src.constants import SCHEMA_FILE_PATH, TARGET_COLUMN
+from src.entity.config_entity import DataTransformationConfig
+from src.entity.neighbor_index import ExactNeighborIndex, IVFNeighborIndex
+from src.utils.main_utils import read_yaml_file, get_schema_dtypes, apply_schema_dtypes
+
+SOURCE_FILE_PATH = 'notebooks/loan_data.csv'
+
+
+def get_feature_matrix(rows: int, seed: int) -> np.ndarray:
+    dtypes = get_schema_dtypes(read_yaml_file(SCHEMA_FILE_PATH))
+    source_df = apply_schema_dtypes(pd.read_csv(SOURCE_FILE_PATH), dtypes)
+    data_transformation = DataTransformation(data_ingestion_artifact=None, data_transformation_config=DataTransformationConfig,
+                                             data_validation_artifact=None)
+    features = data_transformation.get_data_transformer_object().fit_transform(
+        source_df[data_transformation.get_required_columns()].drop(columns=[TARGET_COLUMN]))
+    rng = np.random.default_rng(seed)
+    features = features[rng.integers(0, len(features), size=rows)]
+    return features + rng.normal(scale=0.05, size=features.shape)
+
+
+def percentiles(timings: list) -> str:
+    return f"p50 {np.percentile(timings, 50) * 1000:8.3f} ms  p99 {np.percentile(timings, 99) * 1000:8.3f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--batches', type=int, default=3)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--backends', nargs='+', default=['brute', 'kd_tree', 'ball_tree', 'ivf'])
+    args = parser.parse_args()
+
+    reference = get_feature_matrix(args.rows, seed=0)
+    queries = get_feature_matrix(args.batch_size * args.batches, seed=1)
+    print(f"reference rows: {len(reference):,}  features: {reference.shape[1]}  k: {args.k}")
+
+    _, exact_ids = ExactNeighborIndex('brute').fit(reference).kneighbors(queries[:args.batch_size], args.k)
+
+    indexes = []
+    for backend in args.backends:
+        if backend == 'ivf':
+            indexes += [(f"ivf n_probe={n_probe}", IVFNeighborIndex(n_probe=n_probe)) for n_probe in args.n_probe]
+        else:
+            indexes.append((backend, ExactNeighborIndex(backend)))
+
+    for name, index in indexes:
+        start = time.perf_counter()
+        index.fit(reference)
+        build_time = time.perf_counter() - start
+
+        single_timings = []
+        for row in queries[:args.queries]:
+            start = time.perf_counter()
+            index.kneighbors(row[None, :], args.k)
+            single_timings.append(time.perf_counter() - start)
+
+        batch_timings = []
+        for batch_start in range(0, len(queries), args.batch_size):
+            start = time.perf_counter()
+            _, ids = index.kneighbors(queries[batch_start:batch_start + args.batch_size], args.k)
+            batch_timings.append(time.perf_counter() - start)
+            if batch_start == 0:
+                recall = np.mean([len(np.intersect1d(found, exact)) / args.k for found, exact in zip(ids, exact_ids)])
+
+        print(f"{name:18s} build {build_time:7.2f}s  recall@{args.k} {recall:.4f}  "
+              f"query: {percentiles(single_timings)}  batch of {args.batch_size}: {percentiles(batch_timings)}")
+
+
+if __name__ == '__main__':
+    main()
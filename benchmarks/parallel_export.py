@@ -0,0 +1,72 @@
+"""
+Benchmark of the parallel '_id' range-partitioned MongoDB export against the
+single cursor export.
+
+Usage:
+    python benchmarks/parallel_export.py --rows 500000
+    python benchmarks/parallel_export.py --rows 500000 --mongo-url mongodb://localhost:27017
+
+Without --mongo-url the collection is loaded into an in-process mongomock client,
+which only measures the client side cost (mongomock serialises on the GIL).
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from src.configuration.mongo_db_connection import MongoDBClient
+from src.constants import DATABASE_NAME
+from src.data_access.loan_data import LoanData
+
+BENCHMARK_COLLECTION_NAME = 'Loan-Data-Benchmark'
+SOURCE_FILE_PATH = 'notebooks/loan_data.csv'
+
+
+def load_collection(rows:int, mongo_url:str = None):
+    if mongo_url is None:
+        import mongomock
+        MongoDBClient.client = mongomock.MongoClient()
+    else:
+        import pymongo
+        MongoDBClient.client = pymongo.MongoClient(mongo_url)
+
+    collection = MongoDBClient.client[DATABASE_NAME][BENCHMARK_COLLECTION_NAME]
+    collection.drop()
+    source_df = pd.read_csv(SOURCE_FILE_PATH)
+    source_df = source_df.sample(n=rows, replace=rows > len(source_df), random_state=42)
+    for start in range(0, rows, 100000):
+        collection.insert_many(source_df.iloc[start:start+100000].to_dict('records'))
+    return collection
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--mongo-url', default=None)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    collection = load_collection(rows=args.rows, mongo_url=args.mongo_url)
+    loan_data = LoanData()
+
+    print(f"{'mode':<12}{'workers':>8}{'rows':>12}{'seconds':>10}{'rows/s':>14}")
+    start = time.perf_counter()
+    df = loan_data.export_collection_as_dataframe(collection_name=BENCHMARK_COLLECTION_NAME,
+                                                  batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{'cursor':<12}{1:>8}{len(df):>12}{elapsed:>10.2f}{len(df)/elapsed:>14,.0f}")
+
+    for n_workers in args.workers:
+        start = time.perf_counter()
+        df = loan_data.export_collection_in_parallel(collection_name=BENCHMARK_COLLECTION_NAME,
+                                                     n_workers=n_workers,
+                                                     batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"{'partitioned':<12}{n_workers:>8}{len(df):>12}{elapsed:>10.2f}{len(df)/elapsed:>14,.0f}")
+
+    collection.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of the SMOTEENN resampling step of the data transformation on
+notebooks/loan_data.csv transformed with the pipeline preprocessor and scaled
+to --rows training rows (duplicates get a small jitter).
+
+Every (rows, backend) pair runs in its own process, so the reported peak RSS
+is the one of that resampling alone. Reports the wall time, the peak RSS and
+the rows/minority share after resampling.
+
+Usage:
+    python benchmarks/resampling.py --rows 1000000 5000000 --backends auto ivf --n-jobs -1
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.components.data_transformation import DataTransformation
+from src.constants import SCHEMA_FILE_PATH, TARGET_COLUMN
+from src.entity.config_entity import DataTransformationConfig
+from src.utils.main_utils import read_yaml_file, get_schema_dtypes, apply_schema_dtypes
+
+SOURCE_FILE_PATH = 'notebooks/loan_data.csv'
+
+
+def get_training_data(data_transformation: DataTransformation, rows: int, seed: int, dtype: str):
+    dtypes = get_schema_dtypes(read_yaml_file(SCHEMA_FILE_PATH))
+    source_df = apply_schema_dtypes(pd.read_csv(SOURCE_FILE_PATH), dtypes)
+    features = data_transformation.get_data_transformer_object().fit_transform(
+        source_df[data_transformation.get_required_columns()].drop(columns=[TARGET_COLUMN]))
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(features), size=rows)
+    # Resampling runs on the feature dtype in the pipeline, the jitter is generated in it directly
+    jittered = rng.standard_normal(size=(len(rows), features.shape[1]), dtype=dtype)
+    jittered *= 0.05
+    jittered += features.astype(dtype)[rows]
+    return jittered, source_df[TARGET_COLUMN].to_numpy()[rows]
+
+
+def run_resampling(rows: int, backend: str, n_jobs: int, n_probe: int, results: multiprocessing.Queue) -> None:
+    config = DataTransformationConfig(resampling_algorithm=backend, resampling_n_jobs=n_jobs, resampling_ivf_n_probe=n_probe)
+    data_transformation = DataTransformation(data_ingestion_artifact=None, data_transformation_config=config,
+                                             data_validation_artifact=None)
+    features, labels = get_training_data(data_transformation, rows, seed=0, dtype=config.feature_dtype)
+    start = time.perf_counter()
+    _, resampled_labels = data_transformation.get_resampler().fit_resample(features, labels)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    results.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                 len(resampled_labels), float(np.mean(resampled_labels == 0))))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 5000000])
+    parser.add_argument('--backends', nargs='+', default=['auto', 'ivf'])
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--n-probe', type=int, default=8)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for rows in args.rows:
+        for backend in args.backends:
+            results = context.Queue()
+            process = context.Process(target=run_resampling, args=(rows, backend, args.n_jobs, args.n_probe, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"rows {rows:>9,}  {backend:8s} n_jobs {args.n_jobs:>3}  failed with exit code {process.exitcode} "
+                      f"(-9: killed, e.g. out of memory)")
+                continue
+            seconds, peak_rss, resampled_rows, class_0_share = results.get()
+            print(f"rows {rows:>9,}  {backend:8s} n_jobs {args.n_jobs:>3}  wall {seconds:8.1f}s  "
+                  f"peak rss {peak_rss / 2 ** 30:6.2f} GiB  resampled rows {resampled_rows:>9,}  class 0 share {class_0_share:.3f}")
+
+
+if __name__ == '__main__':
+    main()
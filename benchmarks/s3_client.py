@@ -0,0 +1,79 @@
+"""
+Microbenchmark of the S3 client setup: latency of constructing the storage client
+and making a first request (HEAD of an object), before and after the pooled client.
+
+  previous:      boto3.resource + boto3.client on the default session, the previous S3Client
+  per_instance:  a new resource + client for every SimpleStorageService, as without its class cache
+  pooled:        the shared S3Client (one session and client on one connection pool, a resource per thread)
+
+'cold' is the first construct + request in a fresh process, 'warm' the mean of --repeats
+constructions + requests once the process is warm. Runs against an in-process moto S3,
+which has no network or TLS cost: against a real endpoint, the connections kept alive in
+the pool also save the TCP/TLS handshakes of every client rebuilt by per_instance.
+
+Usage:
+    python benchmarks/s3_client.py --repeats 200
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+BUCKET_NAME = 'benchmark'
+KEY = 'model.pkl'
+MODES = ('previous', 'per_instance', 'pooled')
+
+
+def construct(mode:str, cache:dict):
+    import boto3
+    from src.configuration.aws_connection import S3Client
+    from src.constants import REGION_NAME
+    if mode == 'pooled':
+        return S3Client().s3_client
+    if mode == 'previous' and 'client' in cache:
+        return cache['client']
+    boto3.resource('s3', region_name=REGION_NAME)
+    cache['client'] = boto3.client('s3', region_name=REGION_NAME)
+    return cache['client']
+
+
+def run(mode:str, repeats:int, results:multiprocessing.Queue) -> None:
+    from moto import mock_aws
+    with mock_aws():
+        import boto3
+        # A session of its own, the default session would have the S3 service model loaded already
+        setup = boto3.session.Session().client('s3', region_name='us-east-1')
+        setup.create_bucket(Bucket=BUCKET_NAME)
+        setup.put_object(Bucket=BUCKET_NAME, Key=KEY, Body=b'model')
+        cache = {}
+        start = time.perf_counter()
+        construct(mode, cache).head_object(Bucket=BUCKET_NAME, Key=KEY)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeats):
+            construct(mode, cache).head_object(Bucket=BUCKET_NAME, Key=KEY)
+        results.put((cold, (time.perf_counter() - start) / repeats))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--modes', nargs='+', default=list(MODES))
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'mode':<14}{'cold ms':>10}{'warm ms':>10}")
+    for mode in args.modes:
+        results = context.Queue()
+        process = context.Process(target=run, args=(mode, args.repeats, results))
+        process.start()
+        cold, warm = results.get()
+        process.join()
+        print(f"{mode:<14}{cold * 1000:>10.1f}{warm * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
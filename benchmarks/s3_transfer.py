@@ -0,0 +1,96 @@
+"""
+Benchmark of the SimpleStorageService transfers against an in-process moto S3: the
+previous upload (temporary csv file + default transfer settings) and download
+(whole body read, decoded and wrapped in StringIO) against the streamed uploads
+(csv, csv.gz, parquet) and the streamed csv download, on notebooks/loan_data.csv
+scaled to --rows rows.
+
+Memory is the tracemalloc peak above what is held before and after the transfer,
+i.e. the transient copies of the transfer itself: moto keeps the objects in the
+same process, so the RSS would count the stored objects too.
+
+Usage:
+    python benchmarks/s3_transfer.py --rows 1000000
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+import numpy as np
+import pandas as pd
+from moto import mock_aws
+
+from src.cloud_storage.aws_storage import SimpleStorageService
+
+SOURCE_FILE_PATH = 'notebooks/loan_data.csv'
+BUCKET_NAME = 'benchmark'
+
+
+def scale_dataset(rows:int) -> pd.DataFrame:
+    source_df = pd.read_csv(SOURCE_FILE_PATH)
+    repeats = int(np.ceil(rows / len(source_df)))
+    return pd.concat([source_df] * repeats, ignore_index=True).iloc[:rows]
+
+
+def measure(func):
+    """
+    Returns the wall time of func and its transient traced memory, from a second traced run
+    as tracing slows the allocation heavy csv writer down many times.
+    """
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, peak - current
+
+
+def previous_upload(storage:SimpleStorageService, dataframe:pd.DataFrame, key:str) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_filename = os.path.join(tmp_dir, 'upload.csv')
+        dataframe.to_csv(local_filename, index=None, header=True)
+        storage.s3_resource.meta.client.upload_file(local_filename, BUCKET_NAME, key)
+
+
+def previous_download(storage:SimpleStorageService, key:str) -> pd.DataFrame:
+    body = storage.s3_resource.Object(BUCKET_NAME, key).get()["Body"].read().decode()
+    return pd.read_csv(io.StringIO(body), na_values="na")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    dataframe = scale_dataset(args.rows)
+    print(f"rows: {len(dataframe):,}  in-memory: {dataframe.memory_usage(deep=True).sum() / 2**20:,.1f} MiB")
+    with mock_aws():
+        storage = SimpleStorageService(model_cache_dir=None)
+        storage.s3_client.create_bucket(Bucket=BUCKET_NAME)
+        print(f"{'transfer':<32}{'wall s':>10}{'transient MiB':>16}{'object MiB':>12}")
+
+        def report(name, key, func):
+            seconds, transient = measure(func)
+            size = storage.s3_client.head_object(Bucket=BUCKET_NAME, Key=key)['ContentLength']
+            print(f"{name:<32}{seconds:>10.2f}{transient / 2**20:>16.1f}{size / 2**20:>12.1f}")
+
+        report('upload csv (previous)', 'previous.csv', lambda: previous_upload(storage, dataframe, 'previous.csv'))
+        for key in ('streamed.csv', 'streamed.csv.gz', 'streamed.parquet'):
+            report(f'upload {key.split(".", 1)[1]} (streamed)', key, lambda: storage.upload_df(dataframe, key, BUCKET_NAME))
+        report('download csv (previous)', 'previous.csv', lambda: previous_download(storage, 'previous.csv'))
+        for key in ('streamed.csv', 'streamed.csv.gz'):
+            report(f'download {key.split(".", 1)[1]} (streamed)', key,
+                   lambda: storage.get_df_from_object(storage.s3_resource.Object(BUCKET_NAME, key)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark of the DataValidation content checks (dtypes, null rates, ranges and
+categorical domains) on notebooks/loan_data.csv scaled to --rows rows, both on an
+in-memory dataframe and streamed in chunks from a Parquet file.
+
+Usage:
+    python benchmarks/validation_engine.py --rows 10000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.components.data_validation import DataValidation
+from src.constants import SCHEMA_FILE_PATH
+from src.entity.artifact_entity import DataIngestionArtifact
+from src.entity.config_entity import DataValidationConfig
+from src.utils.main_utils import read_yaml_file, get_schema_dtypes, apply_schema_dtypes, save_dataframe
+
+SOURCE_FILE_PATH = 'notebooks/loan_data.csv'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--chunk-size', type=int, default=DataValidationConfig.validation_chunk_size)
+    args = parser.parse_args()
+
+    dtypes = get_schema_dtypes(read_yaml_file(SCHEMA_FILE_PATH))
+    source_df = apply_schema_dtypes(pd.read_csv(SOURCE_FILE_PATH), dtypes)
+    repeats = int(np.ceil(args.rows / len(source_df)))
+    dataframe = pd.concat([source_df] * repeats, ignore_index=True).iloc[:args.rows]
+
+    DataValidationConfig.validation_chunk_size = args.chunk_size
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'train.parquet')
+        save_dataframe(file_path, dataframe)
+        data_validation = DataValidation(data_ingestion_artifact=DataIngestionArtifact(file_path, file_path),
+                                         data_validation_config=DataValidationConfig)
+
+        start = time.perf_counter()
+        report = data_validation.validate_dataframe_content(data_validation.iter_chunks(dataframe, file_path))
+        in_memory_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data_validation.validate_dataframe_content(data_validation.iter_chunks(None, file_path))
+        streamed_time = time.perf_counter() - start
+
+    print(f"rows: {report['rows']:,}  chunk size: {args.chunk_size:,}  failed checks: {len(report['errors'])}")
+    print(f"in-memory dataframe: {in_memory_time:.2f}s ({report['rows'] / in_memory_time:,.0f} rows/s)")
+    print(f"streamed parquet   : {streamed_time:.2f}s ({report['rows'] / streamed_time:,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
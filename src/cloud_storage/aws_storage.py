@@ -1,35 +1,181 @@
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from src.configuration.aws_connection import S3Client
-from io import StringIO
-from typing import Union,List
+from src.constants import (MODEL_CACHE_DIR, MODEL_CACHE_MAX_BYTES, MODEL_CACHE_MIN_MMAP_BYTES, S3_MULTIPART_THRESHOLD,
+                           S3_MULTIPART_CHUNKSIZE, S3_MAX_CONCURRENCY, S3_STREAM_CHUNK_SIZE,
+                           S3_METADATA_CACHE_TTL_SECONDS, S3_METADATA_CACHE_MAX_ENTRIES)
+from io import TextIOWrapper
+from typing import Union,List,Optional,Iterator,Callable,BinaryIO
 import os,sys
+import tempfile
+import threading
+import time
 from src.logger import logging
+from src.utils.main_utils import DATAFRAME_FILE_FORMATS, iter_dataframe_chunks, apply_schema_dtypes
+from src.utils.model_cache import ModelDiskCache
+from src.utils.model_bundle import is_model_bundle, unpack_model_bundle, load_model_bundle
 from mypy_boto3_s3.service_resource import Bucket
 from src.exception import MyException
 from botocore.exceptions import ClientError
 from pandas import DataFrame,read_csv
 import pickle
 
+# Compression of csv objects by key extension, pandas only infers it from the extension of a local path
+CSV_COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".zst": "zstd", ".xz": "xz"}
+
+
+def get_object_format(key: str) -> tuple:
+    """
+    Returns the dataframe format ('parquet', 'arrow' or 'csv') and the csv compression of an object key,
+    e.g. ('csv', 'gzip') for .csv.gz. The format is None for keys that are not dataframe objects.
+    """
+    root, extension = os.path.splitext(key)
+    compression = CSV_COMPRESSIONS.get(extension.lower())
+    if compression is not None:
+        root, extension = os.path.splitext(root)
+    file_format = extension.lstrip('.').lower()
+    if file_format not in DATAFRAME_FILE_FORMATS or (compression is not None and file_format != 'csv'):
+        return None, None
+    return file_format, compression
+
+
+class PipeUploadStream:
+    """
+    Read end of a pipe fed by write_func on a thread, for upload_fileobj to stream what write_func
+    writes without a temporary file. Only the multipart parts in flight are held in memory. A failure
+    of write_func is raised by read instead of ending the stream, so a truncated object is never completed.
+    """
+
+    def __init__(self, write_func: Callable[[BinaryIO], None]):
+        read_fd, write_fd = os.pipe()
+        self._reader = open(read_fd, "rb")
+        self._error = None
+        self._thread = threading.Thread(target=self._write, args=(write_func, write_fd), daemon=True)
+        self._thread.start()
+
+    def _write(self, write_func: Callable[[BinaryIO], None], write_fd: int) -> None:
+        writer = open(write_fd, "wb")
+        try:
+            write_func(writer)
+        except BaseException as e:
+            self._error = e
+        finally:
+            try:
+                writer.close()
+            except BrokenPipeError:
+                # The upload stopped reading, its own error is raised
+                pass
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._reader.read(size)
+        if not data:
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        return data
+
+    def close(self) -> None:
+        # Closing the read end first unblocks a writer waiting on a full pipe
+        self._reader.close()
+        self._thread.join()
+
 
 class SimpleStorageService:
     """
     A class for interacting with AWS S3 storage, providing methods for file management, 
     data uploads, and data retrieval in S3 buckets.
+
+    Object metadata from HEAD requests, missing objects included, is cached process wide for
+    S3_METADATA_CACHE_TTL_SECONDS, so hot existence checks and lookups of the same key in a row
+    cost one request. Uploads through this class invalidate the metadata of the written key.
     """
 
-    def __init__(self):
+    # (bucket_name, s3_key) -> (expiry time, HEAD metadata or None for a missing object)
+    _metadata_cache = {}
+    _metadata_lock = threading.Lock()
+
+    def __init__(self, model_cache_dir: Optional[str] = MODEL_CACHE_DIR):
         """
         Initializes the SimpleStorageService instance with S3 resource and client
         from the S3Client class.
+
+        Args:
+            model_cache_dir (str): Local disk cache of the loaded models, None disables it.
+        """
+        self._s3 = S3Client()
+        self.s3_client = self._s3.s3_client
+        self.transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                                              multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                                              max_concurrency=S3_MAX_CONCURRENCY)
+        self.model_cache = ModelDiskCache(cache_dir=model_cache_dir, max_bytes=MODEL_CACHE_MAX_BYTES,
+                                          min_mmap_bytes=MODEL_CACHE_MIN_MMAP_BYTES) if model_cache_dir else None
+
+    @property
+    def s3_resource(self):
+        """
+        S3 resource of the calling thread, the instance may be shared by threads while resources are not thread safe.
+        """
+        return self._s3.s3_resource
+
+    def get_object_metadata(self, bucket_name: str, s3_key: str, use_cache: bool = True) -> Optional[dict]:
+        """
+        Returns the metadata of an object with a single HEAD request, or from the metadata cache.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            s3_key (str): Exact key of the object.
+            use_cache (bool): Whether a cached result younger than the TTL may be returned, the result is cached either way.
+
+        Returns:
+            Optional[dict]: ETag, ContentLength, LastModified and VersionId of the object, None when it does not exist.
+        """
+        try:
+            now = time.monotonic()
+            if use_cache:
+                with SimpleStorageService._metadata_lock:
+                    cached = SimpleStorageService._metadata_cache.get((bucket_name, s3_key))
+                if cached is not None and cached[0] > now:
+                    return cached[1]
+            try:
+                response = self.s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+                metadata = {name: response.get(name) for name in ("ETag", "ContentLength", "LastModified", "VersionId")}
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                    raise
+                metadata = None
+            if S3_METADATA_CACHE_TTL_SECONDS > 0:
+                with SimpleStorageService._metadata_lock:
+                    cache = SimpleStorageService._metadata_cache
+                    cache.pop((bucket_name, s3_key), None)
+                    if len(cache) >= S3_METADATA_CACHE_MAX_ENTRIES:
+                        # Dicts keep the insertion order, the oldest entry goes first
+                        cache.pop(next(iter(cache)))
+                    cache[(bucket_name, s3_key)] = (now + S3_METADATA_CACHE_TTL_SECONDS, metadata)
+            return metadata
+        except Exception as e:
+            raise MyException(e, sys) from e
+
+    @staticmethod
+    def invalidate_metadata(bucket_name: str, s3_key: str) -> None:
+        with SimpleStorageService._metadata_lock:
+            SimpleStorageService._metadata_cache.pop((bucket_name, s3_key), None)
+
+    def get_first_object(self, bucket_name: str, prefix: str) -> Optional[object]:
         """
-        s3_client = S3Client()
-        self.s3_resource = s3_client.s3_resource
-        self.s3_client = s3_client.s3_client
+        Returns the first object under a prefix in key order with a single LIST request of one key,
+        instead of listing every object under the prefix.
+        """
+        try:
+            return next(iter(self.get_bucket(bucket_name).objects.filter(Prefix=prefix).page_size(1)), None)
+        except Exception as e:
+            raise MyException(e, sys) from e
 
     def s3_key_path_available(self, bucket_name, s3_key) -> bool:
         """
         Checks if a specified S3 key path (file path) is available in the specified bucket.
+        An existing object is found with one HEAD request, a folder like prefix with one more
+        LIST request of a single key.
 
         Args:
             bucket_name (str): Name of the S3 bucket.
@@ -39,36 +185,33 @@ class SimpleStorageService:
             bool: True if the file exists, False otherwise.
         """
         try:
-            bucket = self.get_bucket(bucket_name)
-            file_objects = [file_object for file_object in bucket.objects.filter(Prefix=s3_key)]
-            return len(file_objects) > 0
+            if self.get_object_metadata(bucket_name, s3_key) is not None:
+                return True
+            return self.get_first_object(bucket_name, s3_key) is not None
         except Exception as e:
             raise MyException(e, sys)
 
     @staticmethod
-    def read_object(object_name: str, decode: bool = True, make_readable: bool = False) -> Union[StringIO, str]:
+    def read_object(object_name: str, decode: bool = True, make_readable: bool = False) -> Union[TextIOWrapper, str, bytes]:
         """
         Reads the specified S3 object with optional decoding and formatting.
 
         Args:
             object_name (str): The S3 object name.
             decode (bool): Whether to decode the object content as a string.
-            make_readable (bool): Whether to convert content to StringIO for DataFrame usage.
+            make_readable (bool): Whether to return a text stream for DataFrame usage. The stream decodes
+                the response body as it is read, the content is never held in memory as a whole.
 
         Returns:
-            Union[StringIO, str]: The content of the object, as a StringIO or decoded string.
+            Union[TextIOWrapper, str, bytes]: The content of the object, as a text stream, decoded string or bytes.
         """
         # logging.info("Entered the read_object method of SimpleStorageService class")
         try:
-            # Read and decode the object content if decode=True
-            func = (
-                lambda: object_name.get()["Body"].read().decode()
-                if decode else object_name.get()["Body"].read()
-            )
-            # Convert to StringIO if make_readable=True
-            conv_func = lambda: StringIO(func()) if make_readable else func()
+            body = object_name.get()["Body"]
+            if make_readable:
+                return TextIOWrapper(body, encoding="utf-8")
             # logging.info("Exited the read_object method of SimpleStorageService class")
-            return conv_func()
+            return body.read().decode() if decode else body.read()
         except Exception as e:
             raise MyException(e, sys) from e
 
@@ -92,43 +235,99 @@ class SimpleStorageService:
 
     def get_file_object(self, filename: str, bucket_name: str) -> Union[List[object], object]:
         """
-        Retrieves the file object(s) from the specified bucket based on the filename.
+        Retrieves the file object from the specified bucket based on the filename. An exact key is
+        checked with one HEAD request, otherwise the first object under the filename prefix is returned.
 
         Args:
             filename (str): The name of the file to retrieve.
             bucket_name (str): The name of the S3 bucket.
 
         Returns:
-            Union[List[object], object]: The S3 file object or list of file objects.
+            Union[List[object], object]: The S3 file object, or an empty list when nothing matches.
         """
         logging.info("Entered the get_file_object method of SimpleStorageService class")
         try:
-            bucket = self.get_bucket(bucket_name)
-            file_objects = [file_object for file_object in bucket.objects.filter(Prefix=filename)]
-            func = lambda x: x[0] if len(x) == 1 else x
-            file_objs = func(file_objects)
+            if self.get_object_metadata(bucket_name, filename) is not None:
+                file_obj = self.s3_resource.Object(bucket_name, filename)
+            else:
+                file_obj = self.get_first_object(bucket_name, filename)
             logging.info("Exited the get_file_object method of SimpleStorageService class")
-            return file_objs
+            return file_obj if file_obj is not None else []
+        except Exception as e:
+            raise MyException(e, sys) from e
+
+    def get_object_etag(self, bucket_name: str, s3_key: str, use_cache: bool = True) -> Optional[str]:
+        """
+        Returns the ETag of an object with a single HEAD request, without listing the bucket.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            s3_key (str): Key of the object.
+            use_cache (bool): Whether the ETag may come from the metadata cache.
+
+        Returns:
+            Optional[str]: The ETag of the object, None when the object does not exist.
+        """
+        metadata = self.get_object_metadata(bucket_name, s3_key, use_cache=use_cache)
+        return metadata["ETag"] if metadata is not None else None
+
+    def download_object(self, bucket_name: str, s3_key: str, file_path: str, etag: str = None,
+                        chunk_size: int = S3_STREAM_CHUNK_SIZE) -> None:
+        """
+        Streams an object to a local file in chunks, without holding its body in memory.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            s3_key (str): Key of the object.
+            file_path (str): Local file to write.
+            etag (str): ETag of the expected version, the download fails when the object has changed since.
+            chunk_size (int): Bytes read from the response stream at a time.
+        """
+        try:
+            extra_args = {"IfMatch": etag} if etag is not None else {}
+            body = self.s3_client.get_object(Bucket=bucket_name, Key=s3_key, **extra_args)["Body"]
+            with open(file_path, "wb") as file:
+                for chunk in body.iter_chunks(chunk_size=chunk_size):
+                    file.write(chunk)
         except Exception as e:
             raise MyException(e, sys) from e
 
-    def load_model(self, model_name: str, bucket_name: str, model_dir: str = None) -> object:
+    def load_model(self, model_name: str, bucket_name: str, model_dir: str = None, etag: str = None) -> object:
         """
-        Loads a serialized model from the specified S3 bucket.
+        Loads a serialized model or a model bundle (.bundle key) from the specified S3 bucket. With the model
+        cache, the model version is looked up by ETag on the local disk first, a cached model is loaded
+        without any GET request.
 
         Args:
             model_name (str): Name of the model file in the bucket.
             bucket_name (str): Name of the S3 bucket.
             model_dir (str): Directory path within the bucket.
+            etag (str): ETag of the expected model version, the load fails when the object has changed since.
 
         Returns:
             object: The deserialized model object.
         """
         try:
             model_file = model_dir + "/" + model_name if model_dir else model_name
-            file_object = self.get_file_object(model_file, bucket_name)
-            model_obj = self.read_object(file_object, decode=False)
-            model = pickle.loads(model_obj)
+            if self.model_cache is not None:
+                etag = etag if etag is not None else self.get_object_etag(bucket_name, model_file)
+                if etag is None:
+                    raise Exception(f"Model s3://{bucket_name}/{model_file} not found")
+                model = self.model_cache.get(bucket_name, model_file, etag)
+                if model is None:
+                    model = self.model_cache.put(bucket_name, model_file, etag, download=lambda file_path:
+                                                 self.download_object(bucket_name, model_file, file_path, etag=etag))
+            elif is_model_bundle(model_file):
+                # Without the cache the bundle is unpacked in a temporary directory, its arrays are read into memory
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    bundle_file_path = os.path.join(temp_dir, os.path.basename(model_file))
+                    self.download_object(bucket_name, model_file, bundle_file_path, etag=etag)
+                    bundle_dir = os.path.join(temp_dir, 'unpacked')
+                    unpack_model_bundle(bundle_file_path, bundle_dir)
+                    model = load_model_bundle(bundle_dir, mmap=False)
+            else:
+                extra_args = {"IfMatch": etag} if etag is not None else {}
+                model = pickle.loads(self.s3_client.get_object(Bucket=bucket_name, Key=model_file, **extra_args)["Body"].read())
             logging.info("Production model loaded from S3 bucket.")
             return model
         except Exception as e:
@@ -166,7 +365,8 @@ class SimpleStorageService:
         logging.info("Entered the upload_file method of SimpleStorageService class")
         try:
             logging.info(f"Uploading {from_filename} to {to_filename} in {bucket_name}")
-            self.s3_resource.meta.client.upload_file(from_filename, bucket_name, to_filename)
+            self.s3_client.upload_file(from_filename, bucket_name, to_filename, Config=self.transfer_config)
+            self.invalidate_metadata(bucket_name, to_filename)
             logging.info(f"Uploaded {from_filename} to {to_filename} in {bucket_name}")
 
             # Delete the local file if remove is True
@@ -177,28 +377,72 @@ class SimpleStorageService:
         except Exception as e:
             raise MyException(e, sys) from e
 
+    def download_file(self, bucket_name: str, s3_key: str, file_path: str) -> None:
+        """
+        Downloads an object to a local file, large objects as parallel ranged GETs.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            s3_key (str): Key of the object.
+            file_path (str): Local file to write.
+        """
+        try:
+            self.s3_client.download_file(bucket_name, s3_key, file_path, Config=self.transfer_config)
+        except Exception as e:
+            raise MyException(e, sys) from e
+
+    def upload_df(self, data_frame: DataFrame, bucket_filename: str, bucket_name: str) -> None:
+        """
+        Streams a DataFrame to the specified S3 bucket without a local file, as a multipart upload
+        of the serialized parts. The format is given by the key: .parquet, .csv or compressed csv
+        (.csv.gz, .csv.bz2, .csv.zst, ...).
+
+        Args:
+            data_frame (DataFrame): DataFrame to be uploaded.
+            bucket_filename (str): Target filename in the bucket.
+            bucket_name (str): Name of the S3 bucket.
+        """
+        logging.info("Entered the upload_df method of SimpleStorageService class")
+        try:
+            if bucket_filename.endswith(".parquet"):
+                write_func = lambda file: data_frame.to_parquet(file, index=False)
+            elif ".csv" in os.path.basename(bucket_filename):
+                compression = CSV_COMPRESSIONS.get(os.path.splitext(bucket_filename)[1])
+                write_func = lambda file: data_frame.to_csv(file, header=True, index=False, compression=compression)
+            else:
+                raise Exception(f"Unsupported format for {bucket_filename}, expected .parquet, .csv or compressed .csv")
+            stream = PipeUploadStream(write_func)
+            try:
+                self.s3_client.upload_fileobj(stream, bucket_name, bucket_filename, Config=self.transfer_config)
+            finally:
+                stream.close()
+                self.invalidate_metadata(bucket_name, bucket_filename)
+            logging.info(f"Uploaded {len(data_frame)} rows to {bucket_filename} in {bucket_name}")
+        except Exception as e:
+            raise MyException(e, sys) from e
+
     def upload_df_as_csv(self, data_frame: DataFrame, local_filename: str, bucket_filename: str, bucket_name: str) -> None:
         """
-        Uploads a DataFrame as a CSV file to the specified S3 bucket.
+        Uploads a DataFrame as a CSV file to the specified S3 bucket, compressed when bucket_filename
+        ends with a compression extension such as .csv.gz. The CSV is streamed, no local file is written.
 
         Args:
             data_frame (DataFrame): DataFrame to be uploaded.
-            local_filename (str): Temporary local filename for the DataFrame.
+            local_filename (str): Unused, kept for compatibility.
             bucket_filename (str): Target filename in the bucket.
             bucket_name (str): Name of the S3 bucket.
         """
         logging.info("Entered the upload_df_as_csv method of SimpleStorageService class")
         try:
-            # Save DataFrame to CSV locally and then upload it
-            data_frame.to_csv(local_filename, index=None, header=True)
-            self.upload_file(local_filename, bucket_filename, bucket_name)
+            self.upload_df(data_frame, bucket_filename, bucket_name)
             logging.info("Exited the upload_df_as_csv method of SimpleStorageService class")
         except Exception as e:
             raise MyException(e, sys) from e
 
     def get_df_from_object(self, object_: object) -> DataFrame:
         """
-        Converts an S3 object to a DataFrame.
+        Converts an S3 object to a DataFrame. The CSV is parsed while the response body streams in,
+        compressed objects (.csv.gz, ...) are decompressed on the fly.
 
         Args:
             object_ (object): The S3 object.
@@ -208,8 +452,9 @@ class SimpleStorageService:
         """
         logging.info("Entered the get_df_from_object method of SimpleStorageService class")
         try:
-            content = self.read_object(object_, make_readable=True)
-            df = read_csv(content, na_values="na")
+            compression = CSV_COMPRESSIONS.get(os.path.splitext(object_.key)[1])
+            content = object_.get()["Body"] if compression else self.read_object(object_, make_readable=True)
+            df = read_csv(content, na_values="na", compression=compression)
             logging.info("Exited the get_df_from_object method of SimpleStorageService class")
             return df
         except Exception as e:
@@ -233,4 +478,42 @@ class SimpleStorageService:
             logging.info("Exited the read_csv method of SimpleStorageService class")
             return df
         except Exception as e:
-            raise MyException(e, sys) from e
\ No newline at end of file
+            raise MyException(e, sys) from e
+
+    def iter_prefix_dataframe_chunks(self, bucket_name: str, prefix: str, chunksize: int,
+                                     dtypes: Optional[dict] = None) -> Iterator[DataFrame]:
+        """
+        Streams every csv (optionally compressed, e.g. .csv.gz)/parquet/arrow object under a prefix as
+        DataFrame chunks, in key order. CSV objects are parsed from the response stream, parquet and
+        arrow objects need random access and are downloaded to a temporary file one at a time.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            prefix (str): Key prefix of the objects to read.
+            chunksize (int): Number of rows per chunk.
+            dtypes (dict): dtypes returned by get_schema_dtypes, applied to the chunks of every object.
+
+        Yields:
+            DataFrame: Chunk of at most chunksize rows.
+        """
+        logging.info("Entered the iter_prefix_dataframe_chunks method of SimpleStorageService class")
+        try:
+            bucket = self.get_bucket(bucket_name)
+            keys = sorted(file_object.key for file_object in bucket.objects.filter(Prefix=prefix)
+                          if get_object_format(file_object.key)[0] is not None)
+            logging.info(f"Streaming {len(keys)} objects under s3://{bucket_name}/{prefix}")
+            for key in keys:
+                file_format, compression = get_object_format(key)
+                if file_format == 'csv':
+                    body = self.s3_client.get_object(Bucket=bucket_name, Key=key)["Body"]
+                    for chunk in read_csv(body, chunksize=chunksize, na_values="na", compression=compression):
+                        yield apply_schema_dtypes(chunk, dtypes) if dtypes else chunk
+                    continue
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    file_path = os.path.join(temp_dir, os.path.basename(key))
+                    self.download_file(bucket_name, key, file_path)
+                    for chunk in iter_dataframe_chunks(file_path, chunksize=chunksize):
+                        yield apply_schema_dtypes(chunk, dtypes) if dtypes else chunk
+            logging.info("Exited the iter_prefix_dataframe_chunks method of SimpleStorageService class")
+        except Exception as e:
+            raise MyException(e, sys) from e
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from src.logger import logging
+from src.exception import MyException
+from src.utils.main_utils import read_yaml_file, read_dataframe, get_schema_dtypes
+from src.constants import SCHEMA_FILE_PATH
+from src.entity.config_entity import DataDriftConfig
+from src.entity.artifact_entity import DataIngestionArtifact, DataDriftArtifact
+
+# Floor applied to bin proportions so PSI stays finite for empty bins
+PROPORTION_EPSILON = 1e-6
+
+class DataDrift:
+    def __init__(self, data_ingestion_artifact: DataIngestionArtifact, data_drift_config: DataDriftConfig):
+        """
+        :param data_ingestion_artifact: Output reference of data ingestion artifact stage
+        :param data_drift_config: configuration for data drift
+        """
+        try:
+            self.data_ingestion_artifact = data_ingestion_artifact
+            self.data_drift_config = data_drift_config
+            self._schema_config = read_yaml_file(file_path = SCHEMA_FILE_PATH)
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def build_reference_profile(self, dataframe: DataFrame) -> dict:
+        """
+        Method Name :   build_reference_profile
+        Description :   This method builds compact per feature sketches of the training data:
+                        quantile bin edges and bin proportions for the numerical columns and
+                        frequency tables for the categorical columns
+
+        Output      :   Returns the reference profile as a json serializable dict
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            n_bins = self.data_drift_config.n_bins
+            numerical_profile = {}
+            for column in self._schema_config['numerical_columns']:
+                values = pd.to_numeric(dataframe[column], errors='coerce').to_numpy(dtype=np.float64)
+                values = values[~np.isnan(values)]
+                # Inner edges only, the outer bins are open so new batches can never fall outside
+                edges = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1])) if len(values) else np.array([])
+                counts = np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1)
+                numerical_profile[column] = {
+                    'edges': edges.tolist(),
+                    'proportions': (counts / max(len(values), 1)).tolist()
+                }
+
+            categorical_profile = {}
+            for column in self._schema_config['categorical_columns']:
+                frequencies = DataDrift.get_frequencies(dataframe[column])
+                categorical_profile[column] = {'frequencies': {str(key): float(value) for key, value in frequencies.items()}}
+
+            return {'rows': len(dataframe), 'numerical_columns': numerical_profile, 'categorical_columns': categorical_profile}
+        except Exception as e:
+            raise MyException(e,sys)
+
+    @staticmethod
+    def get_frequencies(series: pd.Series) -> pd.Series:
+        """
+        Returns the relative frequency of each value of series, keyed by the value as a string.
+        Counting happens before the string conversion so only the distinct values are converted.
+        """
+        frequencies = series.value_counts(normalize=True, sort=False)
+        frequencies.index = frequencies.index.astype(str)
+        return frequencies.groupby(level=0).sum()
+
+    @staticmethod
+    def compare_proportions(expected: np.ndarray, actual: np.ndarray) -> dict:
+        """
+        Returns the population stability index and the largest gap between the cumulative
+        distributions (a binned Kolmogorov-Smirnov statistic) of two sets of bin proportions.
+        """
+        expected = np.clip(expected, PROPORTION_EPSILON, None)
+        actual = np.clip(actual, PROPORTION_EPSILON, None)
+        psi = float(np.sum((actual - expected) * np.log(actual / expected)))
+        ks = float(np.max(np.abs(np.cumsum(actual) - np.cumsum(expected))))
+        return {'psi': psi, 'ks': ks}
+
+    @staticmethod
+    def score_dataframe(dataframe: DataFrame, reference_profile: dict, psi_threshold: float = DataDriftConfig.psi_threshold,
+                        ks_threshold: float = DataDriftConfig.ks_threshold) -> dict:
+        """
+        Method Name :   score_dataframe
+        Description :   This method scores a new batch against the reference profile. Each column is
+                        binned with one searchsorted and one bincount, so the training data is never reloaded
+
+        Output      :   Returns per column PSI/KS statistics and the list of drifted columns
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            columns_report = {}
+            for column, sketch in reference_profile['numerical_columns'].items():
+                if column not in dataframe.columns:
+                    continue
+                values = pd.to_numeric(dataframe[column], errors='coerce').to_numpy(dtype=np.float64)
+                values = values[~np.isnan(values)]
+                edges = np.asarray(sketch['edges'])
+                counts = np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1)
+                columns_report[column] = DataDrift.compare_proportions(np.asarray(sketch['proportions']),
+                                                                       counts / max(len(values), 1))
+
+            for column, sketch in reference_profile['categorical_columns'].items():
+                if column not in dataframe.columns:
+                    continue
+                categories = list(sketch['frequencies'])
+                frequencies = DataDrift.get_frequencies(dataframe[column])
+                # Categories never seen in training are pooled into one extra bucket
+                unseen_rate = float(frequencies.drop(labels=categories, errors='ignore').sum())
+                actual = np.append(frequencies.reindex(categories, fill_value=0.0).to_numpy(), unseen_rate)
+                expected = np.append(np.asarray(list(sketch['frequencies'].values())), 0.0)
+                columns_report[column] = DataDrift.compare_proportions(expected, actual)
+                columns_report[column]['unseen_rate'] = unseen_rate
+
+            drifted_columns = [column for column, statistics in columns_report.items()
+                               if statistics['psi'] > psi_threshold or statistics['ks'] > ks_threshold]
+            return {'rows': len(dataframe), 'drift_status': len(drifted_columns) > 0,
+                    'drifted_columns': drifted_columns, 'columns': columns_report}
+        except Exception as e:
+            raise MyException(e,sys)
+
+    @staticmethod
+    def detect_drift(dataframe: DataFrame, reference_profile_file_path: str) -> dict:
+        """
+        Method Name :   detect_drift
+        Description :   This method scores a new batch against a saved reference profile
+
+        Output      :   Returns the drift report of the batch
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            with open(reference_profile_file_path, 'r') as profile_file:
+                reference_profile = json.load(profile_file)
+            return DataDrift.score_dataframe(dataframe = dataframe, reference_profile = reference_profile)
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def initiate_data_drift(self) -> DataDriftArtifact:
+        """
+        Method Name :   initiate_data_drift
+        Description :   This method builds the reference profile from the train set, saves it and
+                        scores the test set against it
+
+        Output      :   Returns data drift artifact
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            logging.info("Starting Data Drift")
+            columns = self._schema_config['numerical_columns'] + self._schema_config['categorical_columns']
+            schema_dtypes = get_schema_dtypes(self._schema_config)
+            train_df = self.data_ingestion_artifact.train_df
+            if train_df is None:
+                train_df = read_dataframe(file_path = self.data_ingestion_artifact.training_file_path,
+                                          columns = columns, dtypes = schema_dtypes)
+            test_df = self.data_ingestion_artifact.test_df
+            if test_df is None:
+                test_df = read_dataframe(file_path = self.data_ingestion_artifact.testing_file_path,
+                                         columns = columns, dtypes = schema_dtypes)
+
+            reference_profile = self.build_reference_profile(dataframe = train_df)
+            os.makedirs(self.data_drift_config.data_drift_dir, exist_ok=True)
+            with open(self.data_drift_config.reference_profile_file_path, 'w') as profile_file:
+                json.dump(reference_profile, profile_file)
+            logging.info(f"Reference profile saved: {self.data_drift_config.reference_profile_file_path}")
+
+            drift_report = self.score_dataframe(dataframe = test_df, reference_profile = reference_profile,
+                                                psi_threshold = self.data_drift_config.psi_threshold,
+                                                ks_threshold = self.data_drift_config.ks_threshold)
+            with open(self.data_drift_config.drift_report_file_path, 'w') as report_file:
+                json.dump(drift_report, report_file, indent=4)
+
+            data_drift_artifact = DataDriftArtifact(drift_status = drift_report['drift_status'],
+                                                    drifted_columns = drift_report['drifted_columns'],
+                                                    reference_profile_file_path = self.data_drift_config.reference_profile_file_path,
+                                                    drift_report_file_path = self.data_drift_config.drift_report_file_path)
+            logging.info(f"Data drift artifact: {data_drift_artifact}")
+            return data_drift_artifact
+        except Exception as e:
+            raise MyException(e,sys)
@@ -1,15 +1,22 @@
 import os
 import sys
+import json
+import shutil
+from typing import List, Optional, Tuple
 
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split
+from bson import ObjectId
 
 from src.logger import logging
 from src.exception import MyException
 from src.entity.config_entity import DataIngestionConfig
 from src.entity.artifact_entity import DataIngestionArtifact
 from src.data_access.loan_data import LoanData
+from src.constants import SCHEMA_FILE_PATH, ARTIFACT_FILE_FORMAT, TARGET_COLUMN, DATA_INGESTION_HOLDOUT_HASH_BUCKETS
+from src.utils.main_utils import (concat_typed_chunks, save_dataframe, read_dataframe,
+                                  read_yaml_file, get_schema_dtypes, save_in_background)
+from src.utils.profiling import profile_step
 
 class DataIngestion:
     
@@ -19,55 +26,257 @@ class DataIngestion:
         """
         try:
             self.data_ingestion_config = data_ingestion_config
+            self._schema_dtypes = get_schema_dtypes(read_yaml_file(file_path = SCHEMA_FILE_PATH))
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def export_documents(self, my_data: LoanData, query: dict = None) -> pd.DataFrame:
+        """
+        Method Name :   export_documents
+        Description :   This method exports the documents matching query from mongodb,
+                        reading '_id' partitions in parallel when more than one worker is configured
+        
+        Output      :   data is returned as a typed dataframe
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            if self.data_ingestion_config.n_workers > 1:
+                return my_data.export_collection_in_parallel(collection_name = self.data_ingestion_config.collection_name,
+                                                             n_workers = self.data_ingestion_config.n_workers,
+                                                             batch_size = self.data_ingestion_config.batch_size,
+                                                             query = query)
+            return my_data.export_collection_as_dataframe(collection_name = self.data_ingestion_config.collection_name,
+                                                          batch_size = self.data_ingestion_config.batch_size,
+                                                          query = query)
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def get_data_fingerprint(self) -> dict:
+        """
+        Method Name :   get_data_fingerprint
+        Description :   This method cheaply identifies the current content of the collection with its
+                        document count and largest '_id', both read from collection metadata and the '_id' index
+        
+        Output      :   fingerprint dict
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            my_data = LoanData()
+            collection = my_data.get_collection(self.data_ingestion_config.collection_name)
+            return {'collection_name': self.data_ingestion_config.collection_name,
+                    'document_count': collection.estimated_document_count(),
+                    'last_id': str(my_data.get_high_water_mark(collection_name = self.data_ingestion_config.collection_name))}
         except Exception as e:
             raise MyException(e,sys)
         
     def export_data_into_feature_store(self) -> pd.DataFrame:
         """
         Method Name :   export_data_into_feature_store
-        Description :   This method exports data from mongodb to csv file
+        Description :   This method exports data from mongodb to the feature store file, or into
+                        the persistent feature store when incremental ingestion is enabled
         
         Output      :   data is returned as artifact of data ingestion components
         On Failure  :   Write an exception log and then raise an exception
         """
         try:
+            if self.data_ingestion_config.incremental:
+                return self.sync_feature_store()
+            
             logging.info("Exporting data from MongoDB")
             my_data = LoanData()
-            dataframe = my_data.export_collection_as_dataframe(collection_name = self.data_ingestion_config.collection_name)
+            with profile_step('mongo_export'):
+                dataframe = self.export_documents(my_data)
             logging.info(f"Shape of DataFrame:{dataframe.shape}")
             
             feature_store_file_path = self.data_ingestion_config.feature_store_file_path
-            dir_path = os.path.dirname(feature_store_file_path)
-            os.makedirs(dir_path,exist_ok=True)
-            
             logging.info(f"Saving exported data into feature store: {feature_store_file_path}")
-            dataframe.to_csv(feature_store_file_path, header=True, index=False)
+            save_in_background(save_dataframe, file_path = feature_store_file_path, dataframe = dataframe)
             return dataframe
         except Exception as e:
             raise MyException(e,sys)
         
-    def split_data_as_train_test(self,dataframe: pd.DataFrame) -> None:
+    def read_checkpoint(self) -> Optional[dict]:
+        """
+        Method Name :   read_checkpoint
+        Description :   This method reads the high-water-mark checkpoint of the persistent feature store
+        
+        Output      :   checkpoint dict, or None when no checkpoint exists
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            checkpoint_file_path = self.data_ingestion_config.checkpoint_file_path
+            if not os.path.exists(checkpoint_file_path):
+                return None
+            with open(checkpoint_file_path, 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint['last_id_type'] == 'ObjectId':
+                checkpoint['last_id'] = ObjectId(checkpoint['last_id'])
+            return checkpoint
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def write_checkpoint(self, last_id: object, row_count: int, parts: List[str]) -> None:
+        """
+        Method Name :   write_checkpoint
+        Description :   This method atomically replaces the checkpoint with the new high-water mark,
+                        row count and list of feature store parts
+        
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            checkpoint = {
+                'collection_name': self.data_ingestion_config.collection_name,
+                'last_id': str(last_id) if isinstance(last_id, ObjectId) else last_id,
+                'last_id_type': type(last_id).__name__,
+                'last_id_timestamp': last_id.generation_time.isoformat() if isinstance(last_id, ObjectId) else None,
+                'row_count': row_count,
+                'parts': parts
+            }
+            checkpoint_file_path = self.data_ingestion_config.checkpoint_file_path
+            os.makedirs(os.path.dirname(checkpoint_file_path), exist_ok=True)
+            with open(checkpoint_file_path + '.tmp', 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file, indent=4)
+            os.replace(checkpoint_file_path + '.tmp', checkpoint_file_path)
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def read_feature_store(self, parts: List[str], parts_dir: Optional[str] = None) -> pd.DataFrame:
+        """
+        Method Name :   read_feature_store
+        Description :   This method reads the parts of the persistent feature store listed in the checkpoint,
+                        from parts_dir (by default the feature store parts directory)
+        
+        Output      :   data is returned as a typed dataframe
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            parts_dir = parts_dir or self.data_ingestion_config.feature_store_parts_dir
+            return concat_typed_chunks([read_dataframe(file_path = os.path.join(parts_dir, part), dtypes = self._schema_dtypes)
+                                        for part in parts])
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def sync_feature_store(self) -> pd.DataFrame:
+        """
+        Method Name :   sync_feature_store
+        Description :   This method appends the documents added since the last checkpoint to the
+                        persistent feature store. A full refresh is done when it is requested, when
+                        no checkpoint exists or when the collection shrank below the checkpointed row count
+        
+        Output      :   complete feature store is returned as artifact of data ingestion components
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            my_data = LoanData()
+            collection = my_data.get_collection(self.data_ingestion_config.collection_name)
+            parts_dir = self.data_ingestion_config.feature_store_parts_dir
+            
+            checkpoint = None if self.data_ingestion_config.full_refresh else self.read_checkpoint()
+            if checkpoint is not None and collection.estimated_document_count() < checkpoint['row_count']:
+                logging.info("Collection has fewer documents than the checkpoint, running a full refresh")
+                checkpoint = None
+            
+            # Documents inserted after this point are left for the next run
+            high_water_mark = my_data.get_high_water_mark(collection_name = self.data_ingestion_config.collection_name)
+            
+            # A full refresh writes its parts to a staging directory, the current parts and checkpoint
+            # stay valid until the new parts are complete
+            write_dir = parts_dir
+            if checkpoint is None:
+                logging.info("Running a full refresh of the feature store")
+                write_dir = parts_dir + '.refresh'
+                shutil.rmtree(write_dir, ignore_errors=True)
+                last_id, row_count, parts = None, 0, []
+                query = {'_id': {'$lte': high_water_mark}}
+            else:
+                last_id, row_count, parts = checkpoint['last_id'], checkpoint['row_count'], checkpoint['parts']
+                logging.info(f"Fetching documents newer than checkpoint: {last_id} ({row_count} rows)")
+                query = {'_id': {'$gt': last_id, '$lte': high_water_mark}}
+            
+            if high_water_mark is not None and high_water_mark != last_id:
+                with profile_step('mongo_export'):
+                    new_dataframe = self.export_documents(my_data, query = query)
+                logging.info(f"Shape of new DataFrame:{new_dataframe.shape}")
+                if len(new_dataframe) > 0:
+                    os.makedirs(write_dir, exist_ok=True)
+                    part = f"part-{row_count:012d}-{row_count + len(new_dataframe):012d}.{ARTIFACT_FILE_FORMAT}"
+                    save_dataframe(file_path = os.path.join(write_dir, part), dataframe = new_dataframe)
+                    parts = parts + [part]
+                    row_count += len(new_dataframe)
+                last_id = high_water_mark
+            
+            dataframe = self.read_feature_store(parts, parts_dir = write_dir)
+            
+            stale_parts = []
+            if len(parts) > self.data_ingestion_config.max_feature_store_parts:
+                logging.info(f"Compacting {len(parts)} feature store parts")
+                compacted_part = f"part-{0:012d}-{row_count:012d}.{ARTIFACT_FILE_FORMAT}"
+                save_dataframe(file_path = os.path.join(write_dir, compacted_part), dataframe = dataframe)
+                stale_parts, parts = [part for part in parts if part != compacted_part], [compacted_part]
+            
+            if write_dir != parts_dir:
+                # The checkpoint is removed before the parts are swapped: a run interrupted in between
+                # finds no checkpoint and refreshes again, instead of reading parts that are gone
+                if os.path.exists(self.data_ingestion_config.checkpoint_file_path):
+                    os.remove(self.data_ingestion_config.checkpoint_file_path)
+                shutil.rmtree(parts_dir, ignore_errors=True)
+                os.makedirs(write_dir, exist_ok=True)
+                os.rename(write_dir, parts_dir)
+            if last_id is not None:
+                self.write_checkpoint(last_id = last_id, row_count = row_count, parts = parts)
+            for part in stale_parts:
+                os.remove(os.path.join(parts_dir, part))
+            
+            logging.info(f"Feature store synced: {self.data_ingestion_config.persistent_feature_store_dir} ({row_count} rows)")
+            return dataframe
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def get_holdout_mask(self, dataframe: pd.DataFrame) -> np.ndarray:
+        """
+        Method Name :   get_holdout_mask
+        Description :   This method assigns each row to the test set by a hash of its feature values, so a row
+                        lands on the same side on every run while the feature store grows, and rows with the
+                        same features are never split between train and test. A production model trained on an
+                        earlier run has therefore never seen the test rows it is evaluated on. The hashed values
+                        have a fixed dtype (float64 numbers, strings otherwise), so an int column read as float
+                        because of a missing value does not move rows between train and test
+        
+        Output      :   boolean mask of the test rows
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            hash_keys = pd.DataFrame({column: values.astype('float64') if pd.api.types.is_numeric_dtype(values) else values.astype(str)
+                                      for column, values in dataframe.items() if column != TARGET_COLUMN})
+            row_hashes = pd.util.hash_pandas_object(hash_keys, index=False).to_numpy()
+            n_test_buckets = round(self.data_ingestion_config.train_test_split_ratio * DATA_INGESTION_HOLDOUT_HASH_BUCKETS)
+            return row_hashes % np.uint64(DATA_INGESTION_HOLDOUT_HASH_BUCKETS) < np.uint64(n_test_buckets)
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def split_data_as_train_test(self,dataframe: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """
         Method Name :   split_data_as_train_test
-        Description :   This method splits the dataframe into train set and test set based on split ratio 
+        Description :   This method splits the dataframe into train set and test set based on split ratio,
+                        with the stable hash assignment of get_holdout_mask, and writes them to the ingested
+                        dir in the background
         
-        Output      :   Folder is created in s3 bucket
+        Output      :   train set and test set dataframes
         On Failure  :   Write an exception log and then raise an exception
         """
         logging.info("Entered split_data_as_train_test of Data_Ingestion class")
         try:
-            train_df, test_df = train_test_split(dataframe,test_size=self.data_ingestion_config.train_test_split_ratio)
-            logging.info("Performed train test split on the dataframe")
+            with profile_step('train_test_split', rows = len(dataframe)):
+                is_test = self.get_holdout_mask(dataframe)
+                train_df, test_df = dataframe[~is_test], dataframe[is_test]
+            logging.info(f"Performed train test split on the dataframe: {len(train_df)} train rows, {len(test_df)} test rows")
             logging.info("Exited split_data_as_train_test of Data_Ingestion class")
             
-            dir_name = self.data_ingestion_config.data_ingestion_ingested_dir
-            os.makedirs(dir_name,exist_ok=True)
-            
             logging.info(f"Exporting train and test file path")
-            train_df.to_csv(self.data_ingestion_config.training_file_path,header=True,index=False)
-            test_df.to_csv(self.data_ingestion_config.testing_file_path,header=True,index=False)
-            logging.info(f"Exported train and test file path.")
-            
+            save_in_background(save_dataframe, file_path = self.data_ingestion_config.training_file_path, dataframe = train_df)
+            save_in_background(save_dataframe, file_path = self.data_ingestion_config.testing_file_path, dataframe = test_df)
+            logging.info(f"Queued export of train and test file path.")
+            return train_df, test_df
         except Exception as e:
             raise MyException(e,sys)
         
@@ -85,14 +294,16 @@ class DataIngestion:
             dataframe = self.export_data_into_feature_store()
             logging.info("Got the data from MongoDB")
             
-            self.split_data_as_train_test(dataframe)
+            train_df, test_df = self.split_data_as_train_test(dataframe)
             
             logging.info("Performed train_test_split om the dataset")
             
             logging.info("Exited from initaite_data_ingestion of Data_Ingestion class")
             
             data_ingestion_artifact = DataIngestionArtifact(training_file_path = self.data_ingestion_config.training_file_path,
-                                                            testing_file_path = self.data_ingestion_config.testing_file_path)
+                                                            testing_file_path = self.data_ingestion_config.testing_file_path,
+                                                            train_df = train_df,
+                                                            test_df = test_df)
             logging.info(f"Data ingestion artifact: {data_ingestion_artifact}")
             return data_ingestion_artifact
         except Exception as e:
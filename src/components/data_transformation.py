@@ -1,18 +1,28 @@
 import sys
 import os
+from typing import Optional, Tuple
 import numpy as np
 import pandas as pd
 from imblearn.combine import SMOTEENN
+from imblearn.over_sampling import SMOTE
+from imblearn.under_sampling import EditedNearestNeighbours
 from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder, StandardScaler, PowerTransformer
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.metrics import accuracy_score
 
 from src.logger import logging
 from src.exception import MyException
-from src.entity.config_entity import DataTransformationConfig
+from src.entity.config_entity import DataTransformationConfig, ModelTrainerConfig
 from src.entity.artifact_entity import DataTransformationArtifact, DataIngestionArtifact, DataValidationArtifact
+from src.entity.neighbor_index import get_nearest_neighbors
+from src.entity.compiled_preprocessor import CompiledPreprocessor, compile_preprocessor
 from src.constants import TARGET_COLUMN, SCHEMA_FILE_PATH,CURRENT_YEAR
-from src.utils.main_utils import save_object, save_numpy_array_data, read_yaml_file
+from src.utils.main_utils import (save_object, save_feature_label_data, read_yaml_file, read_dataframe,
+                                  get_schema_dtypes, save_in_background, fit_quantization, quantize_features,
+                                  dequantize_features)
+from src.utils.profiling import profile_step
 
 class DataTransformation:
     def __init__(self, data_ingestion_artifact = DataIngestionArtifact,
@@ -27,9 +37,118 @@ class DataTransformation:
             raise MyException(e,sys)
         
     @staticmethod
-    def read_data(file_path:str) -> pd.DataFrame:
+    def read_data(file_path:str, columns:list = None, dtypes:dict = None) -> pd.DataFrame:
         try:
-            return pd.read_csv(file_path)
+            return read_dataframe(file_path = file_path, columns = columns, dtypes = dtypes)
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def get_required_columns(self) -> list:
+        """
+        Returns the columns used by the preprocessor and the target column, in schema order.
+        """
+        used_columns = set(self._schema_config['oh_columns'] + self._schema_config['or_columns'] +
+                           self._schema_config['transform_features'] + self._schema_config['numerical_columns'] +
+                           [TARGET_COLUMN])
+        return [column for column in get_schema_dtypes(self._schema_config) if column in used_columns]
+        
+    def get_quantization(self, train_features: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns the int8 (offset, scale) grid fitted on the train features, None without int8 storage.
+        The test set and the queries of the trained model are quantized on the same grid.
+        """
+        if self.data_transformation_config.storage_dtype == 'int8':
+            return fit_quantization(train_features)
+        return None
+        
+    def to_feature_dtype(self, features: np.ndarray, quantization: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> np.ndarray:
+        """
+        Returns features as the in-memory feature dtype. With int8 storage the values go through the
+        same quantization grid as the saved files, so in-memory and reloaded arrays are identical.
+        """
+        feature_dtype = self.data_transformation_config.feature_dtype
+        if quantization is not None:
+            codes, offset, scale = quantize_features(features, *quantization)
+            return dequantize_features(codes, offset, scale, dtype = feature_dtype)
+        return np.ascontiguousarray(features, dtype = feature_dtype)
+    
+    def get_dtype_accuracy_delta(self, x_train: np.ndarray, y_train: np.ndarray,
+                                 x_test: np.ndarray, y_test: np.ndarray) -> float:
+        """
+        Method Name :   get_dtype_accuracy_delta
+        Description :   This method fits the KNN model on a sample of the train set once with float64 features
+                        and once with the compact features (feature dtype and storage quantization) and
+                        compares their accuracy on a sample of the test set
+        
+        Output      :   Returns compact minus float64 test accuracy
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            sample_size = self.data_transformation_config.dtype_check_sample_size
+            rng = np.random.default_rng(42)
+            train_rows = rng.choice(len(x_train), size = min(sample_size, len(x_train)), replace = False)
+            test_rows = rng.choice(len(x_test), size = min(sample_size, len(x_test)), replace = False)
+            accuracies = []
+            quantization = self.get_quantization(x_train[train_rows])
+            for dtype_x_train, dtype_x_test in [(x_train[train_rows].astype(np.float64), x_test[test_rows].astype(np.float64)),
+                                                (self.to_feature_dtype(x_train[train_rows], quantization),
+                                                 self.to_feature_dtype(x_test[test_rows], quantization))]:
+                # brute force keeps the input dtype, the tree backends compute in float64
+                clf = KNeighborsClassifier(n_neighbors = ModelTrainerConfig._n_neighbors, weights = ModelTrainerConfig._weights,
+                                           algorithm = 'brute')
+                clf.fit(dtype_x_train, y_train[train_rows])
+                accuracies.append(accuracy_score(y_test[test_rows], clf.predict(dtype_x_test)))
+            return accuracies[1] - accuracies[0]
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def get_resampler(self) -> SMOTEENN:
+        """
+        Method Name :   get_resampler
+        Description :   This method builds the SMOTEENN resampler (SMOTE on the minority class, then ENN on
+                        all classes) with the configured neighbor search: exact sklearn search on
+                        resampling_n_jobs workers or the approximate IVF index searched on as many threads
+
+        Output      :   Returns the unfitted SMOTEENN resampler
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            config = self.data_transformation_config
+            # The neighbors objects include the query row itself, hence the imblearn defaults + 1
+            smote_neighbors = get_nearest_neighbors(config.resampling_algorithm, n_neighbors = 5 + 1, n_jobs = config.resampling_n_jobs,
+                                                    ivf_n_probe = config.resampling_ivf_n_probe)
+            enn_neighbors = get_nearest_neighbors(config.resampling_algorithm, n_neighbors = 3 + 1, n_jobs = config.resampling_n_jobs,
+                                                  ivf_n_probe = config.resampling_ivf_n_probe)
+            return SMOTEENN(smote = SMOTE(sampling_strategy = 'minority', k_neighbors = smote_neighbors,
+                                          random_state = config.resampling_random_state),
+                            enn = EditedNearestNeighbours(sampling_strategy = 'all', n_neighbors = enn_neighbors,
+                                                          n_jobs = config.resampling_n_jobs))
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def get_compiled_preprocessor(self, preprocessor: Pipeline, dataframe: pd.DataFrame) -> Tuple[Optional[CompiledPreprocessor], Optional[float]]:
+        """
+        Method Name :   get_compiled_preprocessor
+        Description :   This method compiles the fitted preprocessor into the NumPy-only CompiledPreprocessor and
+                        verifies it on dataframe. It is only returned when its output matches the sklearn output
+                        within compiled_tolerance, predictions otherwise keep using the sklearn preprocessor
+
+        Output      :   Returns the compiled preprocessor (or None) and its max abs difference to sklearn
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            try:
+                compiled_preprocessor = compile_preprocessor(preprocessor)
+            except MyException as e:
+                logging.info(f"Preprocessor can not be compiled, keeping the sklearn preprocessor: {e}")
+                return None, None
+            max_abs_difference = compiled_preprocessor.max_abs_difference(preprocessor, dataframe)
+            logging.info(f"Compiled preprocessor max abs difference to sklearn: {max_abs_difference}")
+            if not max_abs_difference <= self.data_transformation_config.compiled_tolerance:
+                logging.info(f"Compiled preprocessor exceeds the tolerance of {self.data_transformation_config.compiled_tolerance}, "
+                             f"keeping the sklearn preprocessor")
+                return None, max_abs_difference
+            return compiled_preprocessor, max_abs_difference
         except Exception as e:
             raise MyException(e,sys)
         
@@ -78,8 +197,19 @@ class DataTransformation:
             if not self.data_validation_artifact.validation_status:
                 raise Exception(self.data_validation_artifact.message)
             
-            train_df = self.read_data(file_path = self.data_ingestion_artifact.training_file_path)
-            test_df = self.read_data(file_path = self.data_ingestion_artifact.testing_file_path)
+            required_columns = self.get_required_columns()
+            schema_dtypes = get_schema_dtypes(self._schema_config)
+            # Use the in-memory frames handed over by data ingestion when they are available
+            if self.data_ingestion_artifact.train_df is not None:
+                train_df = self.data_ingestion_artifact.train_df[required_columns]
+            else:
+                train_df = self.read_data(file_path = self.data_ingestion_artifact.training_file_path,
+                                          columns = required_columns, dtypes = schema_dtypes)
+            if self.data_ingestion_artifact.test_df is not None:
+                test_df = self.data_ingestion_artifact.test_df[required_columns]
+            else:
+                test_df = self.read_data(file_path = self.data_ingestion_artifact.testing_file_path,
+                                         columns = required_columns, dtypes = schema_dtypes)
             logging.info("Train and test data are loaded")
             
             input_feature_train_df = train_df.drop(columns=[TARGET_COLUMN],axis=1)
@@ -94,40 +224,91 @@ class DataTransformation:
             logging.info("Got the preprocessor object")
             
             logging.info("Initializing transformation for Training-data")
-            input_feature_train_arr = preprocessor.fit_transform(input_feature_train_df)
+            with profile_step('fit_preprocessor', rows = len(input_feature_train_df)):
+                input_feature_train_arr = preprocessor.fit_transform(input_feature_train_df)
             
             logging.info("Initializing transformation for Testing-data")
-            input_feature_test_arr = preprocessor.transform(input_feature_test_df)
+            with profile_step('transform', rows = len(input_feature_test_df)):
+                input_feature_test_arr = preprocessor.transform(input_feature_test_df)
+            
+            compiled_preprocessor, compiled_max_abs_difference = None, None
+            if self.data_transformation_config.compile_preprocessor:
+                with profile_step('compile_preprocessor', rows = len(input_feature_test_df)):
+                    compiled_preprocessor, compiled_max_abs_difference = self.get_compiled_preprocessor(preprocessor, input_feature_test_df)
+            
+            # The compact feature dtype is checked against the float64 preprocessor output before resampling
+            label_dtype = self.data_transformation_config.label_dtype
+            dtype_accuracy_delta = 0.0
+            if self.data_transformation_config.dtype_check_sample_size > 0:
+                with profile_step('dtype_accuracy_check'):
+                    dtype_accuracy_delta = self.get_dtype_accuracy_delta(input_feature_train_arr, np.asarray(target_feature_train_df, dtype = label_dtype),
+                                                                         input_feature_test_arr, np.asarray(target_feature_test_df, dtype = label_dtype))
+                logging.info(f"Accuracy of {self.data_transformation_config.feature_dtype} features "
+                             f"({self.data_transformation_config.storage_dtype} storage) minus float64: {dtype_accuracy_delta:.5f}")
+            
+            # Resampling works on the feature dtype, SMOTE then generates the synthetic rows in it as well
+            feature_dtype = self.data_transformation_config.feature_dtype
+            input_feature_train_arr = np.asarray(input_feature_train_arr, dtype = feature_dtype)
+            input_feature_test_arr = np.asarray(input_feature_test_arr, dtype = feature_dtype)
             
             logging.info("Applying SMOOTEENN for handling imbalanced dataset")
-            smt = SMOTEENN(sampling_strategy = 'minority')
-            input_feature_train_final, target_feature_train_final = smt.fit_resample(
-                input_feature_train_arr,target_feature_train_df
-            )
+            smt = self.get_resampler()
+            with profile_step('smoteenn', rows = len(input_feature_train_arr)):
+                input_feature_train_final, target_feature_train_final = smt.fit_resample(
+                    input_feature_train_arr,target_feature_train_df
+                )
             
-            input_feature_test_final, target_feature_test_final = smt.fit_resample(
-                input_feature_test_arr,target_feature_test_df
-            )
-            logging.info("SMOTEENN applied to train-test df.")
+            # Resampling the test split changes the distribution the model is evaluated on, it is opt-in
+            if self.data_transformation_config.resample_test:
+                with profile_step('smoteenn_test', rows = len(input_feature_test_arr)):
+                    input_feature_test_final, target_feature_test_final = smt.fit_resample(
+                        input_feature_test_arr,target_feature_test_df
+                    )
+                logging.info("SMOTEENN applied to train-test df.")
+            else:
+                input_feature_test_final, target_feature_test_final = input_feature_test_arr, target_feature_test_df
+                logging.info("SMOTEENN applied to train df, test df is kept as is.")
             
-            train_arr = np.c_[input_feature_train_final,np.array(target_feature_train_final)]
-            test_arr = np.c_[input_feature_test_final,np.array(target_feature_test_final)]
-            logging.info("Feature-target concatenation done for train-test df.")
+            # Features are kept in the compact feature dtype and labels in a separate small int array
+            train_labels = np.asarray(target_feature_train_final, dtype = label_dtype)
+            test_labels = np.asarray(target_feature_test_final, dtype = label_dtype)
+            # The int8 grid is fitted on the train set only, the test set is quantized on it as well
+            quantization = self.get_quantization(input_feature_train_final)
+            train_features = self.to_feature_dtype(input_feature_train_final, quantization)
+            test_features = self.to_feature_dtype(input_feature_test_final, quantization)
+            logging.info(f"Features converted to {train_features.dtype}, labels to {train_labels.dtype}")
             
-            save_object(obj=preprocessor, file_path = self.data_transformation_config.transformed_object_file_path)
+            save_in_background(save_object, obj=preprocessor, file_path = self.data_transformation_config.transformed_object_file_path)
+            if compiled_preprocessor is not None:
+                save_in_background(save_object, obj=compiled_preprocessor, file_path = self.data_transformation_config.compiled_object_file_path)
             
             dir_name = os.path.join(self.data_transformation_config.data_transformation_transformed_dir)
             os.makedirs(dir_name, exist_ok=True)
             
-            save_numpy_array_data(file_path=self.data_transformation_config.transformed_train_file_path,array=train_arr)
-            save_numpy_array_data(file_path=self.data_transformation_config.transformed_test_file_path,array=test_arr)
-            logging.info("Saving transformation object and transformed files.")
+            storage_dtype = self.data_transformation_config.storage_dtype
+            save_in_background(save_feature_label_data, dir_path=self.data_transformation_config.transformed_train_dir,
+                               features=train_features, labels=train_labels, storage_dtype=storage_dtype,
+                               quantization=quantization)
+            save_in_background(save_feature_label_data, dir_path=self.data_transformation_config.transformed_test_dir,
+                               features=test_features, labels=test_labels, storage_dtype=storage_dtype,
+                               quantization=quantization)
+            logging.info("Saving transformation object and transformed files in the background.")
 
             logging.info("Data transformation completed successfully")
             data_transformation_artifact = DataTransformationArtifact(
-                transformed_train_file_path = self.data_transformation_config.transformed_train_file_path,
-                transformed_test_file_path = self.data_transformation_config.transformed_test_file_path,
-                transformed_object_file_path = self.data_transformation_config.transformed_object_file_path
+                transformed_train_dir = self.data_transformation_config.transformed_train_dir,
+                transformed_test_dir = self.data_transformation_config.transformed_test_dir,
+                transformed_object_file_path = self.data_transformation_config.transformed_object_file_path,
+                dtype_accuracy_delta = dtype_accuracy_delta,
+                compiled_object_file_path = self.data_transformation_config.compiled_object_file_path if compiled_preprocessor is not None else None,
+                compiled_max_abs_difference = compiled_max_abs_difference,
+                train_features = train_features,
+                train_labels = train_labels,
+                test_features = test_features,
+                test_labels = test_labels,
+                preprocessing_object = preprocessor,
+                compiled_preprocessor = compiled_preprocessor,
+                quantization = quantization
             )
             return data_transformation_artifact
         except Exception as e:
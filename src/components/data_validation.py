@@ -1,13 +1,16 @@
 import os
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
 
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
 from src.logger import logging
 from src.exception import MyException
-from src.utils.main_utils import read_yaml_file
+from src.utils.main_utils import read_yaml_file, read_dataframe_schema, get_schema_dtypes, iter_dataframe_chunks
 from src.constants import SCHEMA_FILE_PATH
 from src.entity.config_entity import DataValidationConfig, DataIngestionConfig
 from src.entity.artifact_entity import DataValidationArtifact, DataIngestionArtifact
@@ -73,8 +76,147 @@ class DataValidation:
         
     @staticmethod
     def read_data(file_path) -> DataFrame:
+        """
+        Reads only the columns and dtypes of the file, which is all the column checks need.
+        """
+        try:
+            return read_dataframe_schema(file_path = file_path)
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def iter_chunks(self, dataframe: Optional[DataFrame], file_path: str) -> Iterator[DataFrame]:
+        """
+        Method Name :   iter_chunks
+        Description :   This method yields the schema columns of the in-memory dataframe, or of the file
+                        when no dataframe was handed over, in chunks of validation_chunk_size rows
+        
+        Output      :   Returns an iterator of dataframe chunks
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            chunk_size = self.data_validation_config.validation_chunk_size
+            if dataframe is not None:
+                for start in range(0, len(dataframe), chunk_size):
+                    yield dataframe.iloc[start:start + chunk_size]
+                return
+            file_columns = DataValidation.read_data(file_path = file_path).columns
+            schema_dtypes = get_schema_dtypes(self._schema_config)
+            yield from iter_dataframe_chunks(file_path = file_path,
+                                             chunksize = chunk_size,
+                                             columns = [column for column in schema_dtypes if column in file_columns],
+                                             dtypes = schema_dtypes)
+        except Exception as e:
+            raise MyException(e,sys)
+        
+    def validate_dataframe_content(self, chunks: Iterable[DataFrame]) -> dict:
+        """
+        Method Name :   validate_dataframe_content
+        Description :   This method checks dtypes, null rates, numerical ranges and categorical domains
+                        declared in schema.yaml. Every check is a vectorized column reduction, all of them
+                        run in a single pass over the chunks and the per chunk results are merged
+        
+        Output      :   Returns the per column statistics and the list of failed checks
+        On Failure  :   Write an exception log and then raise an exception
+        """
         try:
-            return pd.read_csv(file_path)
+            schema_dtypes = get_schema_dtypes(self._schema_config)
+            numerical_ranges = self._schema_config.get('numerical_ranges', {})
+            categorical_domains = self._schema_config.get('categorical_domains', {})
+            
+            range_columns = list(numerical_ranges)
+            lower_bounds = np.array([-np.inf if numerical_ranges[column][0] is None else numerical_ranges[column][0]
+                                     for column in range_columns], dtype=np.float64)
+            upper_bounds = np.array([np.inf if numerical_ranges[column][1] is None else numerical_ranges[column][1]
+                                     for column in range_columns], dtype=np.float64)
+            minimums = np.full(len(range_columns), np.nan)
+            maximums = np.full(len(range_columns), np.nan)
+            out_of_range_counts = np.zeros(len(range_columns), dtype=np.int64)
+            out_of_domain_counts = {column: 0 for column in categorical_domains}
+            unexpected_values = {column: set() for column in categorical_domains}
+            null_counts = pd.Series(0, index=list(schema_dtypes), dtype=np.int64)
+            column_dtypes = {}
+            n_rows = 0
+            
+            for chunk in chunks:
+                if len(chunk) == 0:
+                    continue
+                if n_rows == 0:
+                    column_dtypes = {column: chunk[column].dtype for column in schema_dtypes if column in chunk.columns}
+                n_rows += len(chunk)
+                
+                # Null counts of every schema column in one reduction
+                null_counts = null_counts.add(chunk.reindex(columns=null_counts.index).isna().sum(), fill_value=0)
+                
+                # Min, max and out of range counts of every numerical column in one reduction each
+                numeric_chunk = chunk.reindex(columns=range_columns)
+                for column in range_columns:
+                    if not pd.api.types.is_numeric_dtype(numeric_chunk[column]):
+                        numeric_chunk[column] = pd.to_numeric(numeric_chunk[column], errors='coerce')
+                values = numeric_chunk.to_numpy(dtype=np.float64, na_value=np.nan)
+                minimums = np.fmin(minimums, np.fmin.reduce(values, axis=0))
+                maximums = np.fmax(maximums, np.fmax.reduce(values, axis=0))
+                out_of_range_counts += ((values < lower_bounds) | (values > upper_bounds)).sum(axis=0)
+                
+                # Values outside the declared domain of every categorical column
+                for column, domain in categorical_domains.items():
+                    if column not in chunk.columns:
+                        continue
+                    series = chunk[column]
+                    mask = series.notna().to_numpy() & ~series.isin(domain).to_numpy()
+                    count = int(mask.sum())
+                    if count > 0:
+                        out_of_domain_counts[column] += count
+                        unexpected_values[column].update(series[mask].astype(str).unique()[:5].tolist())
+            
+            max_null_rate = self._schema_config.get('max_null_rate', 0.0)
+            max_out_of_range_rate = self._schema_config.get('max_out_of_range_rate', 0.0)
+            max_out_of_domain_rate = self._schema_config.get('max_out_of_domain_rate', 0.0)
+            rows = max(n_rows, 1)
+            errors = []
+            columns_report = {}
+            for column, expected_dtype in schema_dtypes.items():
+                if column not in column_dtypes:
+                    continue
+                actual_dtype = column_dtypes[column]
+                if expected_dtype == 'category':
+                    dtype_ok = (isinstance(actual_dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(actual_dtype)
+                                or pd.api.types.is_string_dtype(actual_dtype))
+                else:
+                    dtype_ok = pd.api.types.is_numeric_dtype(actual_dtype)
+                null_rate = float(null_counts[column]) / rows
+                column_report = {'dtype': str(actual_dtype), 'expected_dtype': expected_dtype, 'null_rate': null_rate}
+                if not dtype_ok:
+                    errors.append(f"{column} has dtype {actual_dtype}, expected {expected_dtype}.")
+                if null_rate > max_null_rate:
+                    errors.append(f"{column} has a null rate of {null_rate:.4f} above {max_null_rate}.")
+                columns_report[column] = column_report
+            
+            for index, column in enumerate(range_columns):
+                if column not in columns_report:
+                    continue
+                out_of_range_rate = float(out_of_range_counts[index]) / rows
+                columns_report[column].update({
+                    'min': None if np.isnan(minimums[index]) else float(minimums[index]),
+                    'max': None if np.isnan(maximums[index]) else float(maximums[index]),
+                    'out_of_range_rate': out_of_range_rate
+                })
+                if out_of_range_rate > max_out_of_range_rate:
+                    errors.append(f"{column} has {out_of_range_rate:.4f} of values outside {numerical_ranges[column]}.")
+            
+            for column in categorical_domains:
+                if column not in columns_report:
+                    continue
+                out_of_domain_rate = out_of_domain_counts[column] / rows
+                columns_report[column].update({
+                    'out_of_domain_rate': out_of_domain_rate,
+                    'unexpected_values': sorted(unexpected_values[column])
+                })
+                if out_of_domain_rate > max_out_of_domain_rate:
+                    errors.append(f"{column} has unexpected values {sorted(unexpected_values[column])}.")
+            
+            for error in errors:
+                logging.info(f"Data validation check failed: {error}")
+            return {'rows': n_rows, 'errors': errors, 'columns': columns_report}
         except Exception as e:
             raise MyException(e,sys)
         
@@ -89,8 +231,13 @@ class DataValidation:
         try:
             validation_err_msg = ""
             logging.info("Starting Data Validation")
-            train_df,test_df = (DataValidation.read_data(file_path = self.data_ingestion_artifact.training_file_path),
-                                DataValidation.read_data(file_path = self.data_ingestion_artifact.testing_file_path))
+            # Use the in-memory frames handed over by data ingestion when they are available
+            train_df = self.data_ingestion_artifact.train_df
+            if train_df is None:
+                train_df = DataValidation.read_data(file_path = self.data_ingestion_artifact.training_file_path)
+            test_df = self.data_ingestion_artifact.test_df
+            if test_df is None:
+                test_df = DataValidation.read_data(file_path = self.data_ingestion_artifact.testing_file_path)
             
             # Checking col len of dataframe for train/test df
             status = self.validate_number_of_columns(dataframe = train_df)
@@ -118,6 +265,22 @@ class DataValidation:
             else:
                 logging.info(f"All required columns are present in test_df: {status}")
             
+            # Checking dtypes, null rates, ranges and domains in one chunked pass per dataframe,
+            # train and test are independent and are checked concurrently
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                train_future = executor.submit(self.validate_dataframe_content,
+                                               chunks = self.iter_chunks(dataframe = self.data_ingestion_artifact.train_df,
+                                                                         file_path = self.data_ingestion_artifact.training_file_path))
+                test_future = executor.submit(self.validate_dataframe_content,
+                                              chunks = self.iter_chunks(dataframe = self.data_ingestion_artifact.test_df,
+                                                                        file_path = self.data_ingestion_artifact.testing_file_path))
+                train_report = train_future.result()
+                test_report = test_future.result()
+            if len(train_report['errors']) > 0:
+                validation_err_msg += f"Content checks failed in train_df: {' '.join(train_report['errors'])} "
+            if len(test_report['errors']) > 0:
+                validation_err_msg += f"Content checks failed in test_df: {' '.join(test_report['errors'])} "
+            
             validation_status = len(validation_err_msg)==0
             
             data_validation_artifact = DataValidationArtifact(validation_status=validation_status,
@@ -130,7 +293,9 @@ class DataValidation:
             # Save validation status and msg to JSON file
             validation_report = {
                 'validation_status': validation_status,
-                'message': validation_err_msg.strip()
+                'message': validation_err_msg.strip(),
+                'train': train_report,
+                'test': test_report
             }
             
             with open(self.data_validation_config.validation_report_file_path, 'w') as report_file:
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import dataclasses
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.logger import logging
+from src.exception import MyException
+from src.constants import TARGET_COLUMN, SCHEMA_FILE_PATH
+from src.utils.main_utils import load_object, read_yaml_file, get_schema_dtypes, iter_dataframe_chunks, save_in_background
+from src.utils.model_bundle import save_model_bundle, pack_model_bundle
+from src.utils.profiling import profile_step
+from src.entity.estimator import MyModel
+from src.entity.config_entity import ModelEvaluationConfig
+from src.entity.artifact_entity import (DataIngestionArtifact, ModelTrainerArtifact, ModelEvaluationArtifact,
+                                        EvaluationMetricArtifact)
+
+
+class _HashWriter:
+    """
+    File-like sink of pickle.dump that hashes and counts the pickled bytes without keeping them.
+    """
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.n_bytes = 0
+
+    def write(self, data) -> int:
+        # Protocol 5 writes large buffers as PickleBuffer objects
+        n_bytes = memoryview(data).nbytes
+        self.hash.update(data)
+        self.n_bytes += n_bytes
+        return n_bytes
+
+
+def get_pickle_digest(obj: object) -> Tuple[str, int]:
+    """
+    Returns the sha256 and the size of obj pickled with protocol 5, computed in one streamed pass.
+    """
+    writer = _HashWriter()
+    pickle.dump(obj, writer, protocol=5)
+    return writer.hash.hexdigest(), writer.n_bytes
+
+
+def get_preprocessor_fingerprint(model: MyModel) -> str:
+    """
+    Hash of everything MyModel.transform depends on: two models with the same fingerprint
+    produce the same feature matrix for the same rows.
+    """
+    return get_pickle_digest((model.preprocessing_object, getattr(model, 'compiled_preprocessor', None),
+                              getattr(model, 'feature_dtype', None), getattr(model, 'quantization', None)))[0]
+
+
+class ModelEvaluation:
+    def __init__(self, model_eval_config: ModelEvaluationConfig, data_ingestion_artifact: DataIngestionArtifact,
+                 model_trainer_artifact: ModelTrainerArtifact):
+        """
+        :param model_eval_config: Configuration for model evaluation
+        :param data_ingestion_artifact: Output reference of data ingestion artifact stage, its test split is the held-out set.
+                                        Rows are assigned to it by a stable hash, so no model trained by this
+                                        pipeline has seen them
+        :param model_trainer_artifact: Output reference of model trainer artifact stage
+        """
+        try:
+            self.model_eval_config = model_eval_config
+            self.data_ingestion_artifact = data_ingestion_artifact
+            self.model_trainer_artifact = model_trainer_artifact
+            self._schema_config = read_yaml_file(file_path = SCHEMA_FILE_PATH)
+        except Exception as e:
+            raise MyException(e, sys)
+
+    @staticmethod
+    def get_production_model_version(model_eval_config: ModelEvaluationConfig) -> Optional[str]:
+        """
+        Returns the ETag of the production model with one HEAD request, None when no bucket is configured
+        or the bucket has no model. Part of the stage cache key: a new production model is evaluated again.
+        """
+        try:
+            if model_eval_config.bucket_name is None:
+                return None
+            from src.entity.s3_estimator import Proj1Estimator
+            return Proj1Estimator(bucket_name = model_eval_config.bucket_name,
+                                  model_path = model_eval_config.s3_model_key).get_model_version()
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def get_production_model(self) -> Tuple[Optional[str], Optional[MyModel], Optional[int]]:
+        """
+        Method Name :   get_production_model
+        Description :   This function loads the model Proj1Estimator serves from the model bucket
+
+        Output      :   Returns the ETag, the production model and the size of its bundle, (None, None, None) when there is none
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            etag = self.get_production_model_version(self.model_eval_config)
+            if etag is None:
+                logging.info("No production model to evaluate against")
+                return None, None, None
+            from src.entity.s3_estimator import Proj1Estimator
+            estimator = Proj1Estimator(bucket_name = self.model_eval_config.bucket_name,
+                                       model_path = self.model_eval_config.s3_model_key)
+            # Loading by ETag fails rather than scoring a model replaced since the HEAD request
+            production_model = estimator.load_model(etag = etag)
+            # The size comes from the metadata cache filled by the HEAD request
+            metadata = estimator.s3.get_object_metadata(bucket_name = self.model_eval_config.bucket_name,
+                                                        s3_key = self.model_eval_config.s3_model_key)
+            return etag, production_model, metadata['ContentLength'] if metadata is not None else None
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def get_trained_model_bytes(self, trained_model: MyModel) -> int:
+        """
+        Returns the size of the trained model packed as a model bundle with the compression of the model
+        pusher, the way the production model is stored, so that both sizes are measured alike.
+        """
+        try:
+            config = self.model_eval_config
+            save_model_bundle(trained_model, bundle_dir = config.bundle_dir, codec = config.compression,
+                              level = config.compression_level, min_array_bytes = config.min_array_bytes)
+            pack_model_bundle(bundle_dir = config.bundle_dir, file_path = config.bundle_file_path)
+            return os.path.getsize(config.bundle_file_path)
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def iter_test_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Method Name :   iter_test_chunks
+        Description :   This function streams the held-out test split in chunks of at most chunk_size rows,
+                        from the in-memory frame of data ingestion when available, from its file otherwise.
+                        Every model is evaluated on these rows only
+
+        Output      :   Returns an iterator of DataFrame chunks
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            chunk_size = self.model_eval_config.chunk_size
+            test_df = self.data_ingestion_artifact.test_df
+            if test_df is not None:
+                for start in range(0, len(test_df), chunk_size):
+                    yield test_df.iloc[start:start + chunk_size]
+            else:
+                yield from iter_dataframe_chunks(self.data_ingestion_artifact.testing_file_path, chunksize = chunk_size,
+                                                 dtypes = get_schema_dtypes(self._schema_config))
+        except Exception as e:
+            raise MyException(e, sys)
+
+    @staticmethod
+    def get_metric_artifact(scores: dict, model: MyModel, model_bytes: Optional[int]) -> EvaluationMetricArtifact:
+        """
+        Builds the metrics of a model from the confusion counts and timings accumulated over the chunks,
+        model_bytes is the size of its saved file or bundle.
+        Precision, recall and F1 are 0 when undefined, as sklearn's default zero_division does.
+        """
+        tn, fp, fn, tp = (int(count) for count in scores['counts'])
+        n_rows = tn + fp + fn + tp
+        per_row = 1 / n_rows if n_rows else 0.0
+        n_reference_rows = getattr(model.trained_model_object, 'n_samples_fit_', None)
+        return EvaluationMetricArtifact(accuracy_score = (tp + tn) * per_row,
+                                        f1_score = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.0,
+                                        precision_score = tp / (tp + fp) if tp + fp else 0.0,
+                                        recall_score = tp / (tp + fn) if tp + fn else 0.0,
+                                        n_rows = n_rows,
+                                        transform_seconds_per_row = scores['transform_seconds'] * per_row,
+                                        predict_seconds_per_row = scores['predict_seconds'] * per_row,
+                                        seconds_per_row = (scores['transform_seconds'] + scores['predict_seconds']) * per_row,
+                                        model_bytes = model_bytes,
+                                        n_reference_rows = int(n_reference_rows) if n_reference_rows is not None else None)
+
+    def evaluate_models(self, models: dict, model_bytes: dict) -> Tuple[dict, bool]:
+        """
+        Method Name :   evaluate_models
+        Description :   This function scores every model on the same held-out chunks in one pass. A chunk is
+                        preprocessed once per distinct preprocessor, so models with identical preprocessors
+                        are predicted on the same feature matrix. Only the confusion counts of each model
+                        are accumulated, the memory is bounded by the chunk size. model_bytes holds the
+                        bundle size of the models it is known for, None for the others
+
+        Output      :   Returns the metric artifacts by model name and whether a matrix was shared
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            fingerprints = {name: get_preprocessor_fingerprint(model) for name, model in models.items()}
+            shared_preprocessing = len(set(fingerprints.values())) < len(fingerprints)
+            logging.info(f"Preprocessor fingerprints: {fingerprints}, shared preprocessing: {shared_preprocessing}")
+            scores = {name: {'counts': np.zeros(4, dtype=np.int64), 'transform_seconds': 0.0, 'predict_seconds': 0.0}
+                      for name in models}
+            n_chunks = 0
+            for chunk in self.iter_test_chunks():
+                y_true = chunk[TARGET_COLUMN].to_numpy(dtype=np.int64)
+                features = {}
+                for name, model in models.items():
+                    fingerprint = fingerprints[name]
+                    if fingerprint not in features:
+                        start = time.perf_counter()
+                        features[fingerprint] = (model.transform(chunk[model.get_input_columns()]), time.perf_counter() - start)
+                    x, transform_seconds = features[fingerprint]
+                    start = time.perf_counter()
+                    y_pred = np.asarray(model.trained_model_object.predict(x), dtype=np.int64)
+                    scores[name]['predict_seconds'] += time.perf_counter() - start
+                    # A shared matrix counts for every model, it is what each of them costs on its own
+                    scores[name]['transform_seconds'] += transform_seconds
+                    # Labels are 0/1: true * 2 + predicted indexes tn, fp, fn, tp
+                    scores[name]['counts'] += np.bincount(y_true * 2 + y_pred, minlength=4)
+                n_chunks += 1
+            logging.info(f"Evaluated {len(models)} models on {n_chunks} chunks")
+            return {name: self.get_metric_artifact(scores[name], model, model_bytes.get(name))
+                    for name, model in models.items()}, shared_preprocessing
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def is_model_accepted(self, trained_metrics: EvaluationMetricArtifact,
+                          production_metrics: Optional[EvaluationMetricArtifact]) -> Tuple[bool, float]:
+        """
+        The trained model is accepted without a production model, or when it improves the evaluation
+        metric by at least changed_threshold_score (and is not more than max_latency_ratio times slower).
+        """
+        metric = self.model_eval_config.metric
+        trained_score = getattr(trained_metrics, metric)
+        if production_metrics is None:
+            return True, trained_score
+        changed_score = trained_score - getattr(production_metrics, metric)
+        is_accepted = changed_score >= self.model_eval_config.changed_threshold_score
+        max_latency_ratio = self.model_eval_config.max_latency_ratio
+        if is_accepted and max_latency_ratio is not None and production_metrics.seconds_per_row > 0:
+            latency_ratio = trained_metrics.seconds_per_row / production_metrics.seconds_per_row
+            if latency_ratio > max_latency_ratio:
+                logging.info(f"Trained model is {latency_ratio:.2f}x slower per row than the production model")
+                is_accepted = False
+        return is_accepted, changed_score
+
+    def initiate_model_evaluation(self) -> ModelEvaluationArtifact:
+        """
+        Method Name :   initiate_model_evaluation
+        Description :   This function compares the trained model against the production model on the held-out set
+
+        Output      :   Returns model evaluation artifact
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            print("------------------------------------------------------------------------------------------------")
+            print("Starting Model Evaluation Component")
+            trained_model = self.model_trainer_artifact.trained_model
+            if trained_model is None:
+                trained_model = load_object(file_path = self.model_trainer_artifact.transformed_model_file_path)
+            # The trained model is packed in the background while the models are scored
+            trained_model_bytes = save_in_background(self.get_trained_model_bytes, trained_model = trained_model)
+            production_model_version, production_model, production_model_bytes = self.get_production_model()
+            models = {'trained': trained_model}
+            model_bytes = {}
+            if production_model is not None:
+                models['production'] = production_model
+                model_bytes['production'] = production_model_bytes
+
+            with profile_step('evaluate_models'):
+                metrics, shared_preprocessing = self.evaluate_models(models, model_bytes)
+            metrics['trained'].model_bytes = trained_model_bytes.result()
+            is_accepted, changed_score = self.is_model_accepted(metrics['trained'], metrics.get('production'))
+            logging.info(f"Trained model {self.model_eval_config.metric} changed by {changed_score:.5f}, accepted: {is_accepted}")
+
+            model_evaluation_artifact = ModelEvaluationArtifact(
+                is_model_accepted = is_accepted,
+                changed_score = changed_score,
+                s3_model_key = self.model_eval_config.s3_model_key,
+                trained_model_path = self.model_trainer_artifact.transformed_model_file_path,
+                evaluation_report_file_path = self.model_eval_config.evaluation_report_file_path,
+                trained_model_metrics = metrics['trained'],
+                production_model_metrics = metrics.get('production'),
+                production_model_version = production_model_version,
+                shared_preprocessing = shared_preprocessing)
+
+            os.makedirs(os.path.dirname(self.model_eval_config.evaluation_report_file_path), exist_ok=True)
+            with open(self.model_eval_config.evaluation_report_file_path, 'w') as report_file:
+                json.dump(dataclasses.asdict(model_evaluation_artifact), report_file, indent=4)
+            logging.info(f"Model evaluation artifact: {model_evaluation_artifact}")
+            return model_evaluation_artifact
+        except Exception as e:
+            raise MyException(e, sys)
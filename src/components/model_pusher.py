@@ -0,0 +1,95 @@
+import os
+import sys
+import dataclasses
+from typing import Optional
+
+from src.logger import logging
+from src.exception import MyException
+from src.utils.main_utils import load_object
+from src.utils.model_bundle import save_model_bundle, pack_model_bundle
+from src.utils.profiling import profile_step
+from src.entity.config_entity import ModelPusherConfig
+from src.entity.artifact_entity import ModelPusherArtifact, ModelEvaluationArtifact, ModelTrainerArtifact
+
+
+class ModelPusher:
+    def __init__(self, model_evaluation_artifact: ModelEvaluationArtifact, model_pusher_config: ModelPusherConfig,
+                 model_trainer_artifact: Optional[ModelTrainerArtifact] = None):
+        """
+        :param model_evaluation_artifact: Output reference of model evaluation artifact stage
+        :param model_pusher_config: Configuration for model pusher
+        :param model_trainer_artifact: Output reference of model trainer artifact stage (optional),
+                                       its in-memory model is packaged instead of loading the model file
+        """
+        try:
+            self.model_evaluation_artifact = model_evaluation_artifact
+            self.model_pusher_config = model_pusher_config
+            self.model_trainer_artifact = model_trainer_artifact
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def get_bundle_metadata(self) -> dict:
+        """
+        Evaluation results stored in the bundle manifest along with the model.
+        """
+        evaluation = self.model_evaluation_artifact
+        return {'trained_model_path': evaluation.trained_model_path,
+                'changed_score': evaluation.changed_score,
+                'production_model_version': evaluation.production_model_version,
+                'metrics': dataclasses.asdict(evaluation.trained_model_metrics)}
+
+    def initiate_model_pusher(self) -> ModelPusherArtifact:
+        """
+        Method Name :   initiate_model_pusher
+        Description :   This function packages an accepted model into a compressed, checksummed bundle file
+                        and uploads it to the model bucket as a parallel multipart upload
+
+        Output      :   Returns model pusher artifact
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        logging.info("Entered initiate_model_pusher method of ModelPusher class")
+        try:
+            print("------------------------------------------------------------------------------------------------")
+            print("Starting Model Pusher Component")
+            config = self.model_pusher_config
+            if not self.model_evaluation_artifact.is_model_accepted:
+                logging.info("Trained model was not accepted, nothing to push")
+                return ModelPusherArtifact(is_model_pushed = False, bucket_name = config.bucket_name,
+                                           s3_model_key = config.s3_model_key, bundle_file_path = None)
+
+            trained_model = self.model_trainer_artifact.trained_model if self.model_trainer_artifact is not None else None
+            if trained_model is None:
+                trained_model = load_object(file_path = self.model_evaluation_artifact.trained_model_path)
+
+            with profile_step('save_model_bundle'):
+                manifest = save_model_bundle(trained_model, bundle_dir = config.bundle_dir, codec = config.compression,
+                                             level = config.compression_level, min_array_bytes = config.min_array_bytes,
+                                             metadata = self.get_bundle_metadata())
+                pack_model_bundle(bundle_dir = config.bundle_dir, file_path = config.bundle_file_path)
+            bundle_bytes = os.path.getsize(config.bundle_file_path)
+            uncompressed_array_bytes = sum(array['npy_bytes'] for array in manifest['arrays'])
+            logging.info(f"Model bundle {manifest['version']}: {bundle_bytes} bytes, arrays {uncompressed_array_bytes} bytes uncompressed")
+
+            is_model_pushed = False
+            if config.bucket_name is None:
+                logging.info("No model bucket configured, the model bundle is kept locally")
+            else:
+                from src.entity.s3_estimator import Proj1Estimator
+                with profile_step('upload_model_bundle'):
+                    # Uploaded with the multipart TransferConfig of SimpleStorageService, parts in parallel
+                    Proj1Estimator(bucket_name = config.bucket_name,
+                                   model_path = config.s3_model_key).save_model(from_file = config.bundle_file_path)
+                is_model_pushed = True
+                logging.info(f"Model bundle {manifest['version']} pushed to s3://{config.bucket_name}/{config.s3_model_key}")
+
+            model_pusher_artifact = ModelPusherArtifact(is_model_pushed = is_model_pushed,
+                                                        bucket_name = config.bucket_name,
+                                                        s3_model_key = config.s3_model_key,
+                                                        bundle_file_path = config.bundle_file_path,
+                                                        model_version = manifest['version'],
+                                                        bundle_bytes = bundle_bytes,
+                                                        uncompressed_array_bytes = uncompressed_array_bytes)
+            logging.info(f"Model pusher artifact: {model_pusher_artifact}")
+            return model_pusher_artifact
+        except Exception as e:
+            raise MyException(e, sys)
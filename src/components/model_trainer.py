@@ -1,60 +1,68 @@
 import sys
-from typing import Tuple
+from typing import Tuple, Optional
 
 import numpy as np
-from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import accuracy_score, precision_score, f1_score, recall_score
 
 
 from src.logger import logging
 from src.exception import MyException
-from src.utils.main_utils import load_numpy_array_data, save_object, load_object
+from src.utils.main_utils import load_feature_label_data, load_quantization, save_object, load_object, save_in_background
+from src.utils.profiling import profile_step
 from src.entity.estimator import MyModel
+from src.entity.neighbor_index import get_neighbor_classifier, predict_in_batches
 from src.entity.config_entity import ModelTrainerConfig
-from src.entity.artifact_entity import ModelTrainerArtifact, DataTransformationArtifact, ClassificationMetricArtifact
+from src.entity.artifact_entity import (ModelTrainerArtifact, DataTransformationArtifact, ClassificationMetricArtifact,
+                                        PrototypeReductionArtifact)
 
 
 class ModelTrainer:
     def __init__(self, data_transformation_artifact:DataTransformationArtifact,
-                 model_trainer_config:ModelTrainerConfig):
+                 model_trainer_config:ModelTrainerConfig,
+                 prototype_reduction_artifact:Optional[PrototypeReductionArtifact] = None):
         """
         :param data_transformation_artifact: Output reference of data transformation artifact stage
         :param model_trainer_config: Configuration for model training
+        :param prototype_reduction_artifact: Output reference of prototype reduction artifact stage (optional),
+                                             its reduced train set replaces the transformed train set
         """
         try:
             self.data_transformation_artifact = data_transformation_artifact
             self.model_trainer_config = model_trainer_config
+            self.prototype_reduction_artifact = prototype_reduction_artifact
         except Exception as e:
             raise MyException(e,sys)
         
-    def get_model_object_and_report(self, train_arr: np.array, test_arr: np.array) -> Tuple[object,object]:
+    def get_model_object_and_report(self, x_train: np.ndarray, y_train: np.ndarray,
+                                    x_test: np.ndarray, y_test: np.ndarray) -> Tuple[object,object]:
         """
         Method Name :   get_model_object_and_report
-        Description :   This function trains a KNeighborsClassifier with specified parameters
+        Description :   This function trains a KNN classifier with specified parameters, on the exact
+                        sklearn neighbor search or on an approximate IVF index depending on _algorithm
         
         Output      :   Returns metric artifact object and trained model object
         On Failure  :   Write an exception log and then raise an exception
         """
         try:
-            logging.info("Training KNeighborsClassifier with specified params")
+            logging.info("Training KNN classifier with specified params")
             
-            # splitting the train and test data into feature and target column
-            x_train, y_train, x_test, y_test = train_arr[:,:-1], train_arr[:,-1], test_arr[:,:-1], test_arr[:,-1]
-            logging.info("train-test split done")
-            
-            # Initializing KNeighborsClassifier with specied params
+            # Initializing the KNN classifier with specied params and neighbor backend
             params = {'KNN': {'weights': self.model_trainer_config._weights,
                               'n_neighbors': self.model_trainer_config._n_neighbors,
-                              'algorithm': self.model_trainer_config._algorithm}}
-            clf = KNeighborsClassifier(**params['KNN'])
+                              'algorithm': self.model_trainer_config._algorithm,
+                              'ivf_n_lists': self.model_trainer_config._ivf_n_lists,
+                              'ivf_n_probe': self.model_trainer_config._ivf_n_probe}}
+            clf = get_neighbor_classifier(**params['KNN'])
             
             # Training the model
             logging.info("Training the model...")
-            clf.fit(x_train,y_train)
+            with profile_step('knn_fit', rows = len(x_train)):
+                clf.fit(x_train,y_train)
             logging.info("Model Trained")
             
             # Doing Predictions and evaluations
-            y_pred = clf.predict(x_test)
+            with profile_step('knn_predict', rows = len(x_test)):
+                y_pred = predict_in_batches(clf, x_test, batch_size = self.model_trainer_config.predict_batch_size)
             accuracy= accuracy_score(y_test,y_pred)
             f1 = f1_score(y_test,y_pred)
             precision = precision_score(y_test,y_pred)
@@ -80,34 +88,65 @@ class ModelTrainer:
         try:
             print("------------------------------------------------------------------------------------------------")
             print("Starting Model Trainer Component")
-            # Load Transformed train and test data
-            train_arr = load_numpy_array_data(file_path = self.data_transformation_artifact.transformed_train_file_path)
-            test_arr = load_numpy_array_data(file_path = self.data_transformation_artifact.transformed_test_file_path)
-            logging.info("train-test data loaded")
+            # Load Transformed train and test features and labels, unless they were handed over in memory.
+            # Loaded files are memory mapped, the model is fitted and evaluated on views of the mapped arrays
+            if self.prototype_reduction_artifact is not None:
+                x_train, y_train = self.prototype_reduction_artifact.train_features, self.prototype_reduction_artifact.train_labels
+                if x_train is None:
+                    x_train, y_train = load_feature_label_data(dir_path = self.prototype_reduction_artifact.reduced_train_dir)
+            else:
+                x_train, y_train = self.data_transformation_artifact.train_features, self.data_transformation_artifact.train_labels
+                if x_train is None:
+                    x_train, y_train = load_feature_label_data(dir_path = self.data_transformation_artifact.transformed_train_dir)
+            x_test, y_test = self.data_transformation_artifact.test_features, self.data_transformation_artifact.test_labels
+            if x_test is None:
+                x_test, y_test = load_feature_label_data(dir_path = self.data_transformation_artifact.transformed_test_dir)
+            logging.info(f"train-test data loaded, features {x_train.dtype}, labels {y_train.dtype}")
             
             # Train model and get metrics
-            trained_model, model_artifact = self.get_model_object_and_report(train_arr = train_arr, test_arr = test_arr)
+            trained_model, model_artifact = self.get_model_object_and_report(x_train = x_train, y_train = y_train,
+                                                                             x_test = x_test, y_test = y_test)
+            model_artifact.dtype_accuracy_delta = self.data_transformation_artifact.dtype_accuracy_delta
+            if self.prototype_reduction_artifact is not None:
+                model_artifact.reduction_ratio = self.prototype_reduction_artifact.reduction_ratio
+                model_artifact.accuracy_delta = self.prototype_reduction_artifact.accuracy_delta
+                model_artifact.f1_delta = self.prototype_reduction_artifact.f1_delta
             logging.info("Model object and artifact loaded")
             
             # load_preprocessing object
-            preprocessing_obj = load_object(file_path = self.data_transformation_artifact.transformed_object_file_path)
+            preprocessing_obj = self.data_transformation_artifact.preprocessing_object
+            if preprocessing_obj is None:
+                preprocessing_obj = load_object(file_path = self.data_transformation_artifact.transformed_object_file_path)
+            compiled_preprocessor = self.data_transformation_artifact.compiled_preprocessor
+            if compiled_preprocessor is None and self.data_transformation_artifact.compiled_object_file_path is not None:
+                compiled_preprocessor = load_object(file_path = self.data_transformation_artifact.compiled_object_file_path)
+            # Queries are quantized on the int8 grid of the train set, as the reference and test sets are
+            quantization = self.data_transformation_artifact.quantization
+            if quantization is None:
+                quantization = load_quantization(dir_path = self.data_transformation_artifact.transformed_train_dir)
             logging.info("Preprocessing object loaded")
             
             # Check if model's acc meets the expected threshold
-            if accuracy_score(train_arr[:,-1], trained_model.predict(train_arr[:,:-1]))<self.model_trainer_config.expected_accuracy:
+            with profile_step('knn_predict_train', rows = len(x_train)):
+                train_accuracy = accuracy_score(y_train, predict_in_batches(trained_model, x_train,
+                                                                            batch_size = self.model_trainer_config.predict_batch_size))
+            if train_accuracy<self.model_trainer_config.expected_accuracy:
                 logging.info("No model found with score aborve the base score")
                 raise Exception("No model found with score aborve the base score")
             
             # Save the final model object that includes both preprocessign and the trained model
             logging.info("Saving new model as performance is better than previous one. ")
-            my_model = MyModel(preprocessing_object=preprocessing_obj, trained_model_object=trained_model)
-            save_object(file_path = self.model_trainer_config.model_trainer_trained_model_file_path, obj = my_model)
+            my_model = MyModel(preprocessing_object=preprocessing_obj, trained_model_object=trained_model,
+                               compiled_preprocessor=compiled_preprocessor, feature_dtype=str(x_train.dtype),
+                               quantization=quantization)
+            save_in_background(save_object, file_path = self.model_trainer_config.model_trainer_trained_model_file_path, obj = my_model)
             
             logging.info("Saved final model object that includes both preprocessing and the trained model")
             
             # Check and return the ModelTrainerArtifact
             model_trainer_artifact = ModelTrainerArtifact(transformed_model_file_path=self.model_trainer_config.model_trainer_trained_model_file_path,
-                                                          model_artifact = model_artifact)
+                                                          model_artifact = model_artifact,
+                                                          trained_model = my_model)
             logging.info(f"Model Trainer artifact: {model_trainer_artifact}")
             return model_trainer_artifact
         
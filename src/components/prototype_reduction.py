@@ -0,0 +1,217 @@
+import sys
+from typing import Tuple
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import accuracy_score, f1_score
+
+from src.logger import logging
+from src.exception import MyException
+from src.entity.config_entity import PrototypeReductionConfig, ModelTrainerConfig
+from src.entity.artifact_entity import DataTransformationArtifact, PrototypeReductionArtifact
+from src.entity.neighbor_index import get_neighbor_classifier, kmeans, predict_in_batches
+from src.utils.main_utils import load_feature_label_data, save_feature_label_data, save_in_background
+from src.utils.profiling import profile_step
+
+PROTOTYPE_REDUCTION_METHODS = ('condensed', 'edited_condensed', 'kmeans')
+
+class PrototypeReduction:
+    def __init__(self, data_transformation_artifact: DataTransformationArtifact,
+                 prototype_reduction_config: PrototypeReductionConfig,
+                 model_trainer_config: ModelTrainerConfig):
+        """
+        :param data_transformation_artifact: Output reference of data transformation artifact stage
+        :param prototype_reduction_config: Configuration for prototype reduction
+        :param model_trainer_config: Configuration of the KNN model the prototypes are selected for
+        """
+        try:
+            self.data_transformation_artifact = data_transformation_artifact
+            self.prototype_reduction_config = prototype_reduction_config
+            self.model_trainer_config = model_trainer_config
+            self._rng = np.random.default_rng(prototype_reduction_config.random_state)
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def edit(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Method Name :   edit
+        Description :   Wilson's edited nearest neighbours: drops the rows whose n_neighbors nearest
+                        other rows vote for another class, i.e. noise and class overlap
+
+        Output      :   Returns the indices of the kept rows
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            n_neighbors = self.model_trainer_config._n_neighbors
+            _, neighbors = NearestNeighbors(n_neighbors = n_neighbors + 1).fit(x).kneighbors(x)
+            # The first neighbor of a row is the row itself
+            votes = (y[neighbors[:, 1:]] == y[:, None]).sum(axis=1)
+            return np.flatnonzero(votes * 2 >= n_neighbors)
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def condense(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Method Name :   condense
+        Description :   Hart's condensed nearest neighbours, batched: starting from one row per class,
+                        rows misclassified by 1-NN on the current prototypes are added a batch at a time.
+                        Only the rows misclassified in the previous round are checked again, a full
+                        pass over the remaining rows confirms the convergence
+
+        Output      :   Returns the indices of the prototype rows
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            is_prototype = np.zeros(len(x), dtype=bool)
+            is_prototype[[self._rng.choice(np.flatnonzero(y == label)) for label in np.unique(y)]] = True
+            candidates, full_pass = np.flatnonzero(~is_prototype), True
+            while len(candidates) > 0:
+                prototypes = np.flatnonzero(is_prototype)
+                _, nearest = NearestNeighbors(n_neighbors = 1).fit(x[prototypes]).kneighbors(x[candidates])
+                misclassified = candidates[y[prototypes[nearest[:, 0]]] != y[candidates]]
+                if len(misclassified) == 0:
+                    if full_pass:
+                        break
+                    candidates, full_pass = np.flatnonzero(~is_prototype), True
+                    continue
+
+                batch_size = max(1, int(len(misclassified) * self.prototype_reduction_config.condensing_batch_fraction))
+                added = self._rng.choice(misclassified, size = batch_size, replace = False)
+                is_prototype[added] = True
+                candidates, full_pass = np.setdiff1d(misclassified, added), False
+                if len(candidates) == 0:
+                    candidates, full_pass = np.flatnonzero(~is_prototype), True
+            return np.flatnonzero(is_prototype)
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def get_kmeans_prototypes(self, x: np.ndarray, y: np.ndarray, ratio: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns ratio * rows k-means centroids per class as prototypes, with their class labels.
+        """
+        prototypes, labels = [], []
+        for label in np.unique(y):
+            x_label = x[y == label]
+            centroids = kmeans(x_label, n_clusters = max(1, int(round(len(x_label) * ratio))),
+                               random_state = self.prototype_reduction_config.random_state)
+            prototypes.append(centroids.astype(x.dtype))
+            labels.append(np.full(len(centroids), label, dtype = y.dtype))
+        return np.vstack(prototypes), np.concatenate(labels)
+
+    def reduce(self, x: np.ndarray, y: np.ndarray, method: str, ratio: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the prototypes of x and their labels selected with method, ratio is the k-means prototypes per row.
+        """
+        with profile_step(f"prototype_{method}", rows = len(x)):
+            if method == 'kmeans':
+                return self.get_kmeans_prototypes(x, y, ratio = ratio)
+            kept = np.arange(len(x))
+            if method == 'edited_condensed':
+                kept = self.edit(x, y)
+            kept = kept[self.condense(x[kept], y[kept])]
+            return x[kept], y[kept]
+
+    def exceeds_max_kept_fraction(self, y_reduced: np.ndarray, n_rows: int) -> bool:
+        """
+        Returns whether a reduced set keeps more than max_kept_fraction of n_rows. k-means rounds the
+        prototype count of each class, up to one extra row per class is tolerated.
+        """
+        config = self.prototype_reduction_config
+        slack = len(np.unique(y_reduced)) if config.method == 'kmeans' else 0
+        return len(y_reduced) > config.max_kept_fraction * n_rows + slack
+
+    def evaluate(self, x_train: np.ndarray, y_train: np.ndarray, x_test: np.ndarray, y_test: np.ndarray) -> Tuple[float, float]:
+        """
+        Returns the accuracy and F1 score on x_test of the configured KNN model fitted on x_train.
+        """
+        clf = get_neighbor_classifier(algorithm = self.model_trainer_config._algorithm,
+                                      n_neighbors = self.model_trainer_config._n_neighbors,
+                                      weights = self.model_trainer_config._weights,
+                                      ivf_n_lists = self.model_trainer_config._ivf_n_lists,
+                                      ivf_n_probe = self.model_trainer_config._ivf_n_probe)
+        y_pred = predict_in_batches(clf.fit(x_train, y_train), x_test, batch_size = self.model_trainer_config.predict_batch_size)
+        return accuracy_score(y_test, y_pred), f1_score(y_test, y_pred)
+
+    def initiate_prototype_reduction(self) -> PrototypeReductionArtifact:
+        """
+        Method Name :   initiate_prototype_reduction
+        Description :   This method shrinks the KNN reference set with the configured method and keeps
+                        the result only when accuracy and F1 drop by at most max_metric_drop. The decision is
+                        made on a validation split carved out of the train set, the test set stays held out
+                        for the trainer and model evaluation. k-means prototypes are retried with twice as many
+                        prototypes until they are within the tolerance, as long as they keep at most
+                        max_kept_fraction of the rows. A reduced set keeping more rows than that is rejected too.
+                        The accepted reduction is then applied to the full train set and checked against
+                        max_kept_fraction again. When the reduction is disabled or rejected the full train set
+                        is passed on
+
+        Output      :   Returns prototype reduction artifact
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            logging.info("Entered initiate_prototype_reduction method of PrototypeReduction class")
+            config = self.prototype_reduction_config
+            method = config.method
+            x_train, y_train = self.data_transformation_artifact.train_features, self.data_transformation_artifact.train_labels
+            if x_train is None:
+                x_train, y_train = load_feature_label_data(dir_path = self.data_transformation_artifact.transformed_train_dir)
+            full_artifact = PrototypeReductionArtifact(reduced_train_dir = self.data_transformation_artifact.transformed_train_dir,
+                                                       method = method, reduction_ratio = 1.0, accuracy_delta = 0.0,
+                                                       f1_delta = 0.0, train_features = x_train, train_labels = y_train)
+            if method is None:
+                logging.info("Prototype reduction is disabled, keeping the full train set")
+                return full_artifact
+            if method not in PROTOTYPE_REDUCTION_METHODS:
+                raise Exception(f"Unknown prototype reduction method {method}, expected one of {PROTOTYPE_REDUCTION_METHODS}")
+
+            x_fit, x_val, y_fit, y_val = train_test_split(x_train, y_train, test_size = config.validation_fraction,
+                                                          stratify = y_train, random_state = config.random_state)
+            full_accuracy, full_f1 = self.evaluate(x_fit, y_fit, x_val, y_val)
+            logging.info(f"Full reference set: {len(x_fit)} rows, validation accuracy {full_accuracy:.4f}, f1 {full_f1:.4f}")
+
+            ratio = config.kmeans_ratio
+            while True:
+                x_reduced, y_reduced = self.reduce(x_fit, y_fit, method = method, ratio = ratio)
+                accuracy, f1 = self.evaluate(x_reduced, y_reduced, x_val, y_val)
+                accuracy_delta, f1_delta = accuracy - full_accuracy, f1 - full_f1
+                logging.info(f"Reduced reference set ({method}): {len(x_reduced)} rows, "
+                             f"validation accuracy delta {accuracy_delta:.4f}, f1 delta {f1_delta:.4f}")
+                within_tolerance = min(accuracy_delta, f1_delta) >= -config.max_metric_drop
+                if within_tolerance or method != 'kmeans' or ratio * 2 > config.max_kept_fraction:
+                    break
+                ratio *= 2
+
+            kept_fraction = len(x_reduced) / len(x_fit)
+            if not within_tolerance:
+                logging.info(f"Prototype reduction missed its target: with {kept_fraction:.1%} of the rows kept the metrics drop "
+                             f"by more than {config.max_metric_drop}, keeping the full train set")
+                return full_artifact
+            if self.exceeds_max_kept_fraction(y_reduced, len(x_fit)):
+                logging.info(f"Prototype reduction missed its target: it keeps {kept_fraction:.1%} of the rows, more than "
+                             f"max_kept_fraction {config.max_kept_fraction:.1%}, keeping the full train set")
+                return full_artifact
+
+            # The validation rows are part of the reference set of the trained model, the reduction
+            # of the full train set is checked again before it is passed on
+            x_reduced, y_reduced = self.reduce(x_train, y_train, method = method, ratio = ratio)
+            if self.exceeds_max_kept_fraction(y_reduced, len(x_train)):
+                logging.info(f"Prototype reduction missed its target on the full train set: it keeps "
+                             f"{len(x_reduced) / len(x_train):.1%} of the rows, more than max_kept_fraction "
+                             f"{config.max_kept_fraction:.1%}, keeping the full train set")
+                return full_artifact
+            save_in_background(save_feature_label_data, dir_path = config.reduced_train_dir,
+                               features = x_reduced, labels = y_reduced, storage_dtype = str(x_reduced.dtype))
+
+            prototype_reduction_artifact = PrototypeReductionArtifact(
+                reduced_train_dir = config.reduced_train_dir,
+                method = method,
+                reduction_ratio = len(x_train) / len(x_reduced),
+                accuracy_delta = accuracy_delta,
+                f1_delta = f1_delta,
+                train_features = x_reduced,
+                train_labels = y_reduced)
+            logging.info(f"Prototype reduction artifact: {prototype_reduction_artifact}")
+            return prototype_reduction_artifact
+        except Exception as e:
+            raise MyException(e,sys)
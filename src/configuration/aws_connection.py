@@ -1,35 +1,82 @@
 import boto3
 import os
-from src.constants import AWS_SECRET_ACCESS_KEY_ENV_KEY, AWS_ACCESS_KEY_ID_ENV_KEY, REGION_NAME
+import threading
+from botocore.config import Config
+from src.constants import (AWS_SECRET_ACCESS_KEY_ENV_KEY, AWS_ACCESS_KEY_ID_ENV_KEY, REGION_NAME, S3_MAX_POOL_CONNECTIONS,
+                           S3_MAX_RETRIES, S3_RETRY_MODE, S3_TCP_KEEPALIVE, S3_CONNECT_TIMEOUT_SECONDS, S3_READ_TIMEOUT_SECONDS)
+
+
+def get_s3_config() -> Config:
+    """
+    Returns the botocore config of the shared S3 clients: connection pool size, retries, keep-alive and timeouts.
+    """
+    return Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                  retries={'max_attempts': S3_MAX_RETRIES, 'mode': S3_RETRY_MODE},
+                  tcp_keepalive=S3_TCP_KEEPALIVE,
+                  connect_timeout=S3_CONNECT_TIMEOUT_SECONDS,
+                  read_timeout=S3_READ_TIMEOUT_SECONDS)
 
 
 class S3Client:
 
-    s3_client=None
-    s3_resource = None
+    # Session and client of every region, shared by all the instances and threads of the process
+    _s3_sessions = {}
+    _lock = threading.Lock()
+    # S3 resource of every region, one per thread
+    _local = threading.local()
     def __init__(self, region_name=REGION_NAME):
         """ 
         This Class gets aws credentials from env_variable and creates an connection with s3 bucket 
         and raise exception when environment variable is not set
+
+        The session and client of a region are created once per process under a lock and shared by
+        every instance, so all S3 calls go through a single connection pool whose connections are kept
+        alive between calls. boto3 clients are thread safe, resources are not: s3_resource is created
+        from the shared session once per thread and should only be used for Bucket/Object handles.
+        """
+
+        s3_session = S3Client._s3_sessions.get(region_name)
+        if s3_session is None:
+            with S3Client._lock:
+                s3_session = S3Client._s3_sessions.get(region_name)
+                if s3_session is None:
+                    __access_key_id = os.getenv(AWS_ACCESS_KEY_ID_ENV_KEY, )
+                    __secret_access_key = os.getenv(AWS_SECRET_ACCESS_KEY_ENV_KEY, )
+                    if __access_key_id is None:
+                        raise Exception(f"Environment variable: {AWS_ACCESS_KEY_ID_ENV_KEY} is not not set.")
+                    if __secret_access_key is None:
+                        raise Exception(f"Environment variable: {AWS_SECRET_ACCESS_KEY_ENV_KEY} is not set.")
+
+                    # A session of its own, the boto3 default session is not thread safe
+                    session = boto3.session.Session(aws_access_key_id=__access_key_id,
+                                                    aws_secret_access_key=__secret_access_key,
+                                                    region_name=region_name)
+                    s3_session = (session, session.client('s3', config=get_s3_config()))
+                    S3Client._s3_sessions[region_name] = s3_session
+        self.region_name = region_name
+        self.session, self.s3_client = s3_session
+
+    @property
+    def s3_resource(self):
+        """
+        S3 resource of the calling thread, created from the shared session on first use in the thread.
         """
+        resources = getattr(S3Client._local, 'resources', None)
+        if resources is None:
+            resources = S3Client._local.resources = {}
+        session, s3_resource = resources.get(self.region_name, (None, None))
+        if session is not self.session:
+            # Sessions are not thread safe either, resources are created under the lock
+            with S3Client._lock:
+                s3_resource = self.session.resource('s3', config=get_s3_config())
+            resources[self.region_name] = (self.session, s3_resource)
+        return s3_resource
 
-        if S3Client.s3_resource==None or S3Client.s3_client==None:
-            __access_key_id = os.getenv(AWS_ACCESS_KEY_ID_ENV_KEY, )
-            __secret_access_key = os.getenv(AWS_SECRET_ACCESS_KEY_ENV_KEY, )
-            if __access_key_id is None:
-                raise Exception(f"Environment variable: {AWS_ACCESS_KEY_ID_ENV_KEY} is not not set.")
-            if __secret_access_key is None:
-                raise Exception(f"Environment variable: {AWS_SECRET_ACCESS_KEY_ENV_KEY} is not set.")
-        
-            S3Client.s3_resource = boto3.resource('s3',
-                                            aws_access_key_id=__access_key_id,
-                                            aws_secret_access_key=__secret_access_key,
-                                            region_name=region_name
-                                            )
-            S3Client.s3_client = boto3.client('s3',
-                                        aws_access_key_id=__access_key_id,
-                                        aws_secret_access_key=__secret_access_key,
-                                        region_name=region_name
-                                        )
-        self.s3_resource = S3Client.s3_resource
-        self.s3_client = S3Client.s3_client
\ No newline at end of file
+    @classmethod
+    def reset(cls) -> None:
+        """
+        Drops the shared clients, the next S3Client creates new ones, e.g. after the credentials changed.
+        The resources of the threads are recreated from the new session on their next use.
+        """
+        with cls._lock:
+            cls._s3_sessions = {}
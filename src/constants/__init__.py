@@ -9,19 +9,46 @@ MONGODB_URL_KEY = 'MONGODB_URL'
 PIPELINE_NAME:str = ""
 ARTIFACT_DIR:str = "artifact"
 CURRENT_YEAR:str = date.today().year
+STAGE_CACHE_DIR_NAME:str = 'stage_cache'
+STAGE_CACHE_MAX_ENTRIES:int = 25
+PIPELINE_MAX_PARALLEL_STAGES:int = 2 # 1 runs the stages serially, the run profile then has the process CPU time of each stage
+RUN_PROFILE_FILE_NAME:str = 'run_profile.json'
+PIPELINE_PROFILE_DIR_NAME:str = 'profiles'
+PIPELINE_PROFILER = None # None, 'cprofile' or 'pyinstrument', a profiler runs the stages serially
+MODEL_CACHE_DIR:str = os.path.join(ARTIFACT_DIR,'model_cache') # local disk cache of the models loaded from S3, None disables it
+MODEL_CACHE_MAX_BYTES:int = 4 * 2**30
+MODEL_CACHE_MIN_MMAP_BYTES:int = 2**20 # arrays of the cached models from this size on are memory mapped
+
+# Format of the dataframe artifacts: 'parquet', 'arrow' (Arrow IPC) or 'csv'
+ARTIFACT_FILE_FORMAT:str = 'parquet'
 
 MODEL_FILE_NAME = 'model.pkl'
-FILE_NAME:str = 'laon_data.csv'
+FILE_NAME:str = f'loan_data.{ARTIFACT_FILE_FORMAT}'
 PREPROCESSING_OBJECT_FILE_NAME = "preprocessing.pkl"
+COMPILED_PREPROCESSING_OBJECT_FILE_NAME = "compiled_preprocessing.pkl"
 
 TARGET_COLUMN = 'loan_status'
-TRAIN_FILE_NAME:str = 'train.csv'
-TEST_FILE_NAME:str = 'test.csv'
+TRAIN_FILE_NAME:str = f'train.{ARTIFACT_FILE_FORMAT}'
+TEST_FILE_NAME:str = f'test.{ARTIFACT_FILE_FORMAT}'
 SCHEMA_FILE_PATH:str = os.path.join('config','schema.yaml')
 
 AWS_ACCESS_KEY_ID_ENV_KEY = "AWS_ACCESS_KEY_ID"
 AWS_SECRET_ACCESS_KEY_ENV_KEY = "AWS_SECRET_ACCESS_KEY"
 REGION_NAME = "us-east-1"
+# S3 transfers: objects above the threshold move as multipart transfers of chunksize parts, max_concurrency at a time
+S3_MULTIPART_THRESHOLD:int = 8 * 2**20
+S3_MULTIPART_CHUNKSIZE:int = 8 * 2**20
+S3_MAX_CONCURRENCY:int = 10
+S3_STREAM_CHUNK_SIZE:int = 2**20 # bytes read at a time from a streamed download
+# Process wide S3 client shared by every SimpleStorageService, its pool should cover S3_MAX_CONCURRENCY per concurrent transfer
+S3_MAX_POOL_CONNECTIONS:int = 50
+S3_MAX_RETRIES:int = 5
+S3_RETRY_MODE:str = 'standard' # 'legacy', 'standard' or 'adaptive' (client side rate limiting)
+S3_TCP_KEEPALIVE:bool = True
+S3_CONNECT_TIMEOUT_SECONDS:float = 5.0
+S3_READ_TIMEOUT_SECONDS:float = 60.0
+S3_METADATA_CACHE_TTL_SECONDS:float = 5.0 # HEAD results of hot keys are reused this long, 0 disables the cache
+S3_METADATA_CACHE_MAX_ENTRIES:int = 1024
 
 """
 Data Ingestion related constant start with DATA_INGESTION VAR NAME
@@ -30,13 +57,31 @@ DATA_INGESTION_COLLECTION_NAME:str = 'Loan-Data'
 DATA_INGESTION_DIR_NAME:str = 'data_ingestion'
 DATA_INGESTION_FEATURE_STORE_DIR:str = 'feature_store'
 DATA_INGESTION_INGESTED_DIR:str = 'ingested'
-DATA_INGESTION_TRAIN_TEST_SPLIT_RATIO:float = 0.2
+DATA_INGESTION_TRAIN_TEST_SPLIT_RATIO:float = 0.2 # raising it moves rows earlier models trained on into the test set
+DATA_INGESTION_HOLDOUT_HASH_BUCKETS:int = 10000 # resolution of the hash based train/test assignment
+DATA_INGESTION_BATCH_SIZE:int = 50000
+DATA_INGESTION_N_WORKERS:int = 4
+DATA_INGESTION_INCREMENTAL:bool = True
+DATA_INGESTION_CHECKPOINT_FILE_NAME:str = 'checkpoint.json'
+DATA_INGESTION_FEATURE_STORE_PARTS_DIR:str = 'parts'
+DATA_INGESTION_MAX_FEATURE_STORE_PARTS:int = 30
 
 """
 Data Validation related constant start with DATA_INGESTION VAR NAME
 """
 DATA_VALIDATION_DIR_NAME:str = 'data_validation'
 DATA_VALIDATION_REPORT_FILE_NAME:str = 'report.yaml'
+DATA_VALIDATION_CHUNK_SIZE:int = 1000000
+
+"""
+Data Drift related constant start with DATA_DRIFT VAR NAME
+"""
+DATA_DRIFT_DIR_NAME:str = 'data_drift'
+DATA_DRIFT_REFERENCE_PROFILE_FILE_NAME:str = 'reference_profile.json'
+DATA_DRIFT_REPORT_FILE_NAME:str = 'drift_report.json'
+DATA_DRIFT_N_BINS:int = 10
+DATA_DRIFT_PSI_THRESHOLD:float = 0.2
+DATA_DRIFT_KS_THRESHOLD:float = 0.1
 
 """
 Data Transformation related constant start with DATA_INGESTION VAR NAME
@@ -44,6 +89,30 @@ Data Transformation related constant start with DATA_INGESTION VAR NAME
 DATA_TRANSFORMATION_DIR_NAME:str = 'data_transformation'
 DATA_TRANSFORMATION_TRANSFORMED_DATA_DIR:str = 'transformed'
 DATA_TRANSFORMATION_TRANSFORMED_OBJECT_DIR:str = 'transformed_object'
+DATA_TRANSFORMATION_FEATURE_DTYPE:str = 'float32' # dtype of the in-memory features and of the KNN reference set
+DATA_TRANSFORMATION_LABEL_DTYPE:str = 'int8'
+DATA_TRANSFORMATION_STORAGE_DTYPE:str = 'float32' # 'float32', 'float64' or 'int8' (quantized) features on disk
+DATA_TRANSFORMATION_DTYPE_CHECK_SAMPLE_SIZE:int = 20000 # rows used to compare accuracy against float64, 0 disables
+DATA_TRANSFORMATION_RESAMPLE_TEST:bool = False # True also resamples the test split with SMOTEENN
+DATA_TRANSFORMATION_RESAMPLING_N_JOBS:int = -1 # threads of the SMOTEENN neighbor searches, -1 for all CPUs
+DATA_TRANSFORMATION_RESAMPLING_ALGORITHM:str = 'auto' # exact 'auto', 'brute', 'kd_tree', 'ball_tree' or approximate 'ivf'
+DATA_TRANSFORMATION_RESAMPLING_IVF_N_PROBE:int = 8
+DATA_TRANSFORMATION_RESAMPLING_RANDOM_STATE:int = 42
+DATA_TRANSFORMATION_COMPILE_PREPROCESSOR:bool = True # export the fitted preprocessor to the NumPy-only CompiledPreprocessor
+DATA_TRANSFORMATION_COMPILED_TOLERANCE:float = 1e-9 # max abs difference to the sklearn output for the compiled preprocessor to be used
+
+"""
+Prototype Reduction related constant start with PROTOTYPE_REDUCTION VAR NAME
+"""
+PROTOTYPE_REDUCTION_DIR_NAME:str = 'prototype_reduction'
+PROTOTYPE_REDUCTION_REDUCED_DATA_DIR:str = 'reduced'
+PROTOTYPE_REDUCTION_METHOD = None # None (disabled), 'condensed', 'edited_condensed' or 'kmeans'
+PROTOTYPE_REDUCTION_KMEANS_RATIO:float = 0.1
+PROTOTYPE_REDUCTION_MAX_KEPT_FRACTION:float = 0.1 # a reduced set keeping more of the rows is rejected, it caps the k-means retries
+PROTOTYPE_REDUCTION_CONDENSING_BATCH_FRACTION:float = 0.1
+PROTOTYPE_REDUCTION_MAX_METRIC_DROP:float = 0.01
+PROTOTYPE_REDUCTION_VALIDATION_FRACTION:float = 0.2 # of the train set, the reduction is accepted on it
+PROTOTYPE_REDUCTION_RANDOM_STATE:int = 42
 
 """
 Model Trainer related constant start with DATA_INGESTION VAR NAME
@@ -55,4 +124,53 @@ MODEL_TRAINER_MODEL_CONFIG_FILE_PATH:str = os.path.join('config','model.yaml')
 MODEL_TRAINER_EXPECTED_SCORE:float = 0.8
 MODEL_TRAINER_WEIGHTS:str = 'distance'
 MODEL_TRAINER_N_NEIGHBORS:int = 3
-MODEL_TRAINER_ALGORITHM:str = 'auto'
\ No newline at end of file
+MODEL_TRAINER_ALGORITHM:str = 'auto' # 'auto', 'brute', 'kd_tree', 'ball_tree' or the approximate 'ivf' index
+MODEL_TRAINER_IVF_N_LISTS = None # None: sqrt(number of training rows)
+MODEL_TRAINER_IVF_N_PROBE:int = 8
+MODEL_TRAINER_PREDICT_BATCH_SIZE:int = 100000 # rows predicted at once when evaluating the model
+
+"""
+Model Evaluation related constant start with MODEL_EVALUATION VAR NAME
+"""
+MODEL_BUCKET_NAME = os.getenv('MODEL_BUCKET_NAME') # bucket of the production model, None: no production model to compare with
+MODEL_EVALUATION_DIR_NAME:str = 'model_evaluation'
+MODEL_EVALUATION_REPORT_FILE_NAME:str = 'evaluation_report.json'
+MODEL_EVALUATION_METRIC:str = 'f1_score' # 'accuracy_score', 'f1_score', 'precision_score' or 'recall_score'
+MODEL_EVALUATION_CHANGED_THRESHOLD_SCORE:float = 0.02 # improvement of the metric over the production model needed to accept
+MODEL_EVALUATION_MAX_LATENCY_RATIO = None # max latency per row of the trained model / production model, None: not checked
+MODEL_EVALUATION_CHUNK_SIZE:int = 100000 # held-out rows scored at once, bounds the memory
+MODEL_EVALUATION_BUNDLE_DIR:str = 'bundle' # trained model packed as the production model is, to compare their sizes
+
+"""
+Model Pusher related constant start with MODEL_PUSHER VAR NAME
+"""
+MODEL_BUNDLE_FILE_NAME:str = 'model.bundle' # key of the production model bundle in MODEL_BUCKET_NAME
+MODEL_PUSHER_DIR_NAME:str = 'model_pusher'
+MODEL_PUSHER_BUNDLE_DIR:str = 'bundle'
+MODEL_PUSHER_COMPRESSION = 'zstd' # compression of the array blocks: 'zstd', 'lz4' (needs the lz4 package), 'zlib' or None
+MODEL_PUSHER_COMPRESSION_LEVEL:int = 3
+MODEL_PUSHER_MIN_ARRAY_BYTES:int = 2**16 # arrays of the model from this size on are stored as .npy blocks
+
+"""
+Batch Prediction related constant start with BATCH_PREDICTION VAR NAME
+"""
+BATCH_PREDICTION_DIR_NAME:str = 'batch_prediction'
+BATCH_PREDICTION_FILE_NAME:str = f'predictions.{ARTIFACT_FILE_FORMAT}'
+BATCH_PREDICTION_INPUT_SOURCE:str = 'file' # 'file' (csv/parquet/arrow), 'mongodb' (collection) or 's3' (key prefix)
+BATCH_PREDICTION_CHUNK_SIZE:int = 50000
+BATCH_PREDICTION_N_WORKERS = None # scoring processes, None: number of CPUs, 1 scores in the calling process
+BATCH_PREDICTION_MAX_PENDING_CHUNKS_PER_WORKER:int = 2 # chunks read ahead per worker, bounds the memory
+BATCH_PREDICTION_PREDICTION_COLUMN:str = 'prediction'
+
+"""
+Model Serving related constant start with SERVING VAR NAME
+"""
+APP_HOST:str = '0.0.0.0'
+APP_PORT:int = 5000
+SERVING_MODEL_FILE_PATH_KEY = 'MODEL_FILE_PATH' # local model file, or its key in the bucket of SERVING_MODEL_BUCKET_NAME_KEY
+SERVING_MODEL_BUCKET_NAME_KEY = 'MODEL_BUCKET_NAME'
+SERVING_MAX_BATCH_SIZE:int = 64 # requests scored in one vectorized predict call
+SERVING_MAX_WAIT_MS:float = 5.0 # longest a request waits for others to fill its batch
+SERVING_METRICS_WINDOW:int = 10000 # latest requests/batches the latency and batch size metrics are computed on
+SERVING_MODEL_CACHE_MAX_VERSIONS:int = 3 # model versions kept in memory by Proj1Estimator for instant rollback
+SERVING_MODEL_RELOAD_INTERVAL_SECONDS:float = 60.0 # period of the ETag check of the served model, None disables the polling
@@ -1,11 +1,14 @@
 import sys
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Optional, Iterator, List
 import pandas as pd
 import numpy as np
 
 from src.exception import MyException
-from src.constants import DATABASE_NAME
+from src.constants import DATABASE_NAME, SCHEMA_FILE_PATH, DATA_INGESTION_BATCH_SIZE, DATA_INGESTION_N_WORKERS
 from src.configuration.mongo_db_connection import MongoDBClient
+from src.utils.main_utils import read_yaml_file, get_schema_dtypes, apply_schema_dtypes, concat_typed_chunks
 
 class LoanData:
     """
@@ -17,10 +20,74 @@ class LoanData:
         """
         try:
             self.mongo_client = MongoDBClient(database_name = DATABASE_NAME)
+            self._schema_dtypes = get_schema_dtypes(read_yaml_file(file_path = SCHEMA_FILE_PATH))
         except Exception as e:
             raise MyException(e,sys)
-        
-    def export_collection_as_dataframe(self, collection_name:str, database_name: Optional[str]=None) -> None:
+
+    def get_collection(self, collection_name:str, database_name: Optional[str]=None):
+        """
+        Returns the collection from the default or specified database.
+        """
+        if database_name is None:
+            return self.mongo_client.database[collection_name]
+        return self.mongo_client.client[database_name][collection_name]
+
+    def export_collection_as_batches(self, collection_name:str, database_name: Optional[str]=None,
+                                     batch_size:int = DATA_INGESTION_BATCH_SIZE,
+                                     query: Optional[dict]=None, sort_by_id:bool = False) -> Iterator[pd.DataFrame]:
+        """
+        Streams a MongoDB collection as typed pandas DataFrame chunks.
+
+        Parameters:
+        ----------
+        collection_name : str
+            The name of the MongoDB collection to export.
+        database_name : Optional[str]
+            Name of the database (optional). Defaults to DATABASE_NAME.
+        batch_size : int
+            Number of documents held in memory at once. Defaults to DATA_INGESTION_BATCH_SIZE.
+        query : Optional[dict]
+            Filter applied on the server (optional). Defaults to the whole collection.
+        sort_by_id : bool
+            Whether documents are returned in '_id' order.
+
+        Yields:
+        -------
+        pd.DataFrame
+            Chunk of at most batch_size rows, without '_id', 'na' values replaced with NaN
+            and columns cast to the dtypes declared in schema.yaml.
+        """
+        try:
+            collection = self.get_collection(collection_name, database_name)
+
+            # '_id' is dropped on the server so it never reaches the client
+            cursor = collection.find(query or {}, projection={'_id': 0}, batch_size=batch_size)
+            if sort_by_id:
+                cursor = cursor.sort('_id', 1)
+            try:
+                while True:
+                    documents = list(islice(cursor, batch_size))
+                    if len(documents) == 0:
+                        break
+                    yield self.documents_to_dataframe(documents)
+            finally:
+                cursor.close()
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def documents_to_dataframe(self, documents:list) -> pd.DataFrame:
+        """
+        Converts a batch of MongoDB documents into a typed DataFrame chunk.
+        """
+        df = pd.DataFrame.from_records(documents)
+        if "_id" in df.columns.to_list():
+            df = df.drop(columns=['_id'])
+        df.replace({"na":np.nan},inplace=True)
+        return apply_schema_dtypes(df, self._schema_dtypes)
+
+    def export_collection_as_dataframe(self, collection_name:str, database_name: Optional[str]=None,
+                                       batch_size:int = DATA_INGESTION_BATCH_SIZE,
+                                       query: Optional[dict]=None) -> pd.DataFrame:
         """
         Exports an entire MongoDB collection as a pandas DataFrame.
 
@@ -30,6 +97,10 @@ class LoanData:
             The name of the MongoDB collection to export.
         database_name : Optional[str]
             Name of the database (optional). Defaults to DATABASE_NAME.
+        batch_size : int
+            Number of documents converted per chunk. Defaults to DATA_INGESTION_BATCH_SIZE.
+        query : Optional[dict]
+            Filter applied on the server (optional). Defaults to the whole collection.
 
         Returns:
         -------
@@ -37,20 +108,128 @@ class LoanData:
             DataFrame containing the collection data, with '_id' column removed and 'na' values replaced with NaN.
         """
         try:
-            # Access specified collection from the default or specified database
-            if database_name is None:
-                collection = self.mongo_client.database[collection_name]
-            else:
-                collection = self.mongo_client.database[database_name][collection_name]
-            
-            # Convert collection data to pandas dataframe and preprocess
+            # Convert collection data to typed chunks and concatenate them once
             print("Fetching Data from MongoDB")
-            df = pd.DataFrame(list(collection.find()))
+            chunks = list(self.export_collection_as_batches(collection_name = collection_name,
+                                                            database_name = database_name,
+                                                            batch_size = batch_size,
+                                                            query = query))
+            df = concat_typed_chunks(chunks)
             print(f"Data Fetched with length of: {len(df)}")
-            if "_id" in df.columns.to_list():
-                df = df.drop(columns=['_id'],axis=1)
-                
-            df.replace({"na":np.nan},inplace=True)
             return df
         except Exception as e:
-            raise MyException(e,sys)
\ No newline at end of file
+            raise MyException(e,sys)
+
+    def get_high_water_mark(self, collection_name:str, database_name: Optional[str]=None,
+                            query: Optional[dict]=None) -> Optional[object]:
+        """
+        Returns the largest '_id' matching query, read from the '_id' index, or None
+        when no document matches.
+        """
+        try:
+            collection = self.get_collection(collection_name, database_name)
+            last_document = list(collection.find(query or {}, projection={'_id': 1}).sort('_id', -1).limit(1))
+            return last_document[0]['_id'] if len(last_document) > 0 else None
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def get_id_partitions(self, collection_name:str, database_name: Optional[str]=None,
+                          n_partitions:int = DATA_INGESTION_N_WORKERS,
+                          query: Optional[dict]=None) -> List[dict]:
+        """
+        Splits a collection into contiguous '_id' ranges of roughly equal size.
+
+        The boundaries are found by walking the '_id' index, so no document is fetched
+        and no $sample stage is used.
+
+        Returns:
+        -------
+        List[dict]
+            One MongoDB filter per partition, ordered by '_id' and combined with query
+            when one is given.
+        """
+        try:
+            collection = self.get_collection(collection_name, database_name)
+            query = query or {}
+            total_documents = collection.count_documents(query) if query else collection.estimated_document_count()
+            n_partitions = max(1, min(n_partitions, total_documents))
+
+            boundaries = []
+            for partition in range(1, n_partitions):
+                skip = partition * total_documents // n_partitions
+                boundary = list(collection.find(query, projection={'_id': 1}).sort('_id', 1).skip(skip).limit(1))
+                if len(boundary) > 0 and (len(boundaries) == 0 or boundary[0]['_id'] != boundaries[-1]):
+                    boundaries.append(boundary[0]['_id'])
+
+            lower_bounds = [None] + boundaries
+            upper_bounds = boundaries + [None]
+            partitions = []
+            for lower, upper in zip(lower_bounds, upper_bounds):
+                id_range = {}
+                if lower is not None:
+                    id_range['$gte'] = lower
+                if upper is not None:
+                    id_range['$lt'] = upper
+                partition_query = {'_id': id_range} if id_range else {}
+                if query and partition_query:
+                    partition_query = {'$and': [query, partition_query]}
+                partitions.append(partition_query or query)
+            return partitions
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def export_partition_as_dataframe(self, collection_name:str, query:dict, database_name: Optional[str]=None,
+                                      batch_size:int = DATA_INGESTION_BATCH_SIZE) -> pd.DataFrame:
+        """
+        Exports the documents matching one '_id' range partition as a typed DataFrame.
+        """
+        chunks = list(self.export_collection_as_batches(collection_name = collection_name,
+                                                        database_name = database_name,
+                                                        batch_size = batch_size,
+                                                        query = query,
+                                                        sort_by_id = True))
+        return concat_typed_chunks(chunks)
+
+    def export_collection_in_parallel(self, collection_name:str, database_name: Optional[str]=None,
+                                      n_workers:int = DATA_INGESTION_N_WORKERS,
+                                      batch_size:int = DATA_INGESTION_BATCH_SIZE,
+                                      query: Optional[dict]=None) -> pd.DataFrame:
+        """
+        Exports an entire MongoDB collection by reading '_id' range partitions concurrently.
+
+        Parameters:
+        ----------
+        collection_name : str
+            The name of the MongoDB collection to export.
+        database_name : Optional[str]
+            Name of the database (optional). Defaults to DATABASE_NAME.
+        n_workers : int
+            Number of partitions read concurrently over the shared MongoClient.
+        batch_size : int
+            Number of documents converted per chunk within a partition.
+        query : Optional[dict]
+            Filter applied on the server (optional). Defaults to the whole collection.
+
+        Returns:
+        -------
+        pd.DataFrame
+            DataFrame with the partitions assembled in '_id' order, so the result does
+            not depend on which worker finished first.
+        """
+        try:
+            print("Fetching Data from MongoDB")
+            partitions = self.get_id_partitions(collection_name = collection_name,
+                                                database_name = database_name,
+                                                n_partitions = n_workers,
+                                                query = query)
+            with ThreadPoolExecutor(max_workers = len(partitions)) as executor:
+                frames = list(executor.map(lambda query: self.export_partition_as_dataframe(collection_name = collection_name,
+                                                                                            query = query,
+                                                                                            database_name = database_name,
+                                                                                            batch_size = batch_size),
+                                           partitions))
+            df = concat_typed_chunks([frame for frame in frames if len(frame.columns) > 0])
+            print(f"Data Fetched with length of: {len(df)} using {len(partitions)} partitions")
+            return df
+        except Exception as e:
+            raise MyException(e,sys)
@@ -1,9 +1,16 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import pandas as pd
 
 @dataclass
 class DataIngestionArtifact:
     training_file_path:str
     testing_file_path:str
+    # In-memory copies handed to the next stages while the files are written in the background
+    train_df:Optional[pd.DataFrame] = field(default=None, repr=False, compare=False)
+    test_df:Optional[pd.DataFrame] = field(default=None, repr=False, compare=False)
 
 @dataclass
 class DataValidationArtifact:
@@ -11,11 +18,43 @@ class DataValidationArtifact:
     message:str
     validation_report_file_path:str
     
+@dataclass
+class DataDriftArtifact:
+    drift_status:bool
+    drifted_columns:list
+    reference_profile_file_path:str
+    drift_report_file_path:str
+    
 @dataclass
 class DataTransformationArtifact:
-    transformed_train_file_path:str
-    transformed_test_file_path:str
+    transformed_train_dir:str
+    transformed_test_dir:str
     transformed_object_file_path:str
+    # Test accuracy of the compact feature dtype minus float64, on a sample (0.0 when not checked)
+    dtype_accuracy_delta:float = 0.0
+    # None when the preprocessor could not be compiled or did not match the sklearn output
+    compiled_object_file_path:Optional[str] = None
+    compiled_max_abs_difference:Optional[float] = None
+    train_features:Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    train_labels:Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    test_features:Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    test_labels:Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    preprocessing_object:Optional[object] = field(default=None, repr=False, compare=False)
+    compiled_preprocessor:Optional[object] = field(default=None, repr=False, compare=False)
+    # (offset, scale) int8 grid fitted on the train set, also saved next to the transformed train set
+    quantization:Optional[tuple] = field(default=None, repr=False, compare=False)
+    
+@dataclass
+class PrototypeReductionArtifact:
+    reduced_train_dir:str
+    method:Optional[str]
+    # Training rows before reduction / rows kept, 1.0 when the reduction is disabled or rejected
+    reduction_ratio:float
+    # Reduced minus full reference set metrics on the validation split of the train set
+    accuracy_delta:float
+    f1_delta:float
+    train_features:Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    train_labels:Optional[np.ndarray] = field(default=None, repr=False, compare=False)
     
 @dataclass
 class ClassificationMetricArtifact:
@@ -23,8 +62,67 @@ class ClassificationMetricArtifact:
     f1_score:float
     precision_score:float
     recall_score:float
+    reduction_ratio:float = 1.0
+    accuracy_delta:float = 0.0
+    f1_delta:float = 0.0
+    dtype_accuracy_delta:float = 0.0
     
 @dataclass
 class ModelTrainerArtifact:
     transformed_model_file_path:str
-    model_artifact:ClassificationMetricArtifact
\ No newline at end of file
+    model_artifact:ClassificationMetricArtifact
+    # In-memory MyModel handed to model evaluation while its file is written in the background
+    trained_model:Optional[object] = field(default=None, repr=False, compare=False)
+    
+@dataclass
+class EvaluationMetricArtifact:
+    accuracy_score:float
+    f1_score:float
+    precision_score:float
+    recall_score:float
+    n_rows:int
+    # Preprocessing and prediction time of the vectorized chunks divided by their rows
+    transform_seconds_per_row:float
+    predict_seconds_per_row:float
+    seconds_per_row:float
+    # Size of the model packed as a model bundle and rows of the KNN reference set (None when unknown)
+    model_bytes:Optional[int]
+    n_reference_rows:Optional[int] = None
+    
+@dataclass
+class ModelEvaluationArtifact:
+    is_model_accepted:bool
+    # Trained minus production model on the evaluation metric, the trained model score without a production model
+    changed_score:float
+    s3_model_key:str
+    trained_model_path:str
+    evaluation_report_file_path:str
+    trained_model_metrics:EvaluationMetricArtifact
+    production_model_metrics:Optional[EvaluationMetricArtifact] = None
+    # ETag of the production model evaluated against, None when there is none
+    production_model_version:Optional[str] = None
+    # Both models were scored on one preprocessed matrix per chunk
+    shared_preprocessing:bool = False
+    
+@dataclass
+class ModelPusherArtifact:
+    # False when the trained model was not accepted or no model bucket is configured
+    is_model_pushed:bool
+    bucket_name:Optional[str]
+    s3_model_key:str
+    # Packed bundle, None when the trained model was not accepted
+    bundle_file_path:Optional[str]
+    # Content version of the bundle from its manifest
+    model_version:Optional[str] = None
+    bundle_bytes:int = 0
+    # Size of the arrays as .npy files, before compression
+    uncompressed_array_bytes:int = 0
+    
+@dataclass
+class BatchPredictionArtifact:
+    predictions_file_path:str
+    n_rows:int
+    n_chunks:int
+    wall_seconds:float
+    rows_per_second:float
+    peak_rss_bytes:Optional[int]
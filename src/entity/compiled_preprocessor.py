@@ -0,0 +1,214 @@
+import sys
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder, PowerTransformer, StandardScaler
+
+from src.logger import logging
+from src.exception import MyException
+
+
+def yeo_johnson(x: np.ndarray, lambdas: np.ndarray) -> np.ndarray:
+    """
+    Yeo-Johnson transform of every column of x with its own lambda, the same expm1/log1p
+    formulation as scipy.stats.yeojohnson used by PowerTransformer.
+    """
+    eps = np.finfo(np.float64).eps
+    log_abs = np.log1p(np.abs(x))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        positive = np.where(np.abs(lambdas) < eps, log_abs, np.expm1(lambdas * log_abs) / lambdas)
+        negative = np.where(np.abs(lambdas - 2) > eps, -np.expm1((2 - lambdas) * log_abs) / (2 - lambdas), -log_abs)
+    return np.where(x >= 0, positive, negative)
+
+
+def get_scaler_parameters(scaler: StandardScaler) -> tuple:
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(scaler.n_features_in_)
+    scale = scaler.scale_ if scaler.with_std else np.ones(scaler.n_features_in_)
+    return np.asarray(mean, dtype=np.float64), np.asarray(scale, dtype=np.float64)
+
+
+class CompiledPreprocessor:
+    """
+    NumPy-only copy of a fitted preprocessing Pipeline/ColumnTransformer made of OneHotEncoder,
+    OrdinalEncoder, PowerTransformer (yeo-johnson), StandardScaler and passthrough columns.
+
+    The fitted parameters are exported into flat lookup tables and arrays, so a row is transformed
+    with a few dict lookups and vectorized operations instead of the DataFrame dispatch of every
+    sklearn transformer. Use compile_preprocessor to build it and max_abs_difference to verify it.
+    """
+    def __init__(self, input_columns: List[str], numeric_columns: List[str],
+                 categorical_blocks: List[dict], numeric_blocks: List[dict], n_output_features: int):
+        """
+        :param input_columns: columns of the preprocessor input, the column order of raw 2-D arrays
+        :param numeric_columns: input columns read as float64 by the numeric blocks
+        :param categorical_blocks: encoders, {'kind': 'onehot'|'ordinal', 'column', 'lookup', 'output', 'unknown_value'}
+        :param numeric_blocks: {'kind': 'power'|'scale'|'passthrough', 'inputs', 'output', 'lambdas', 'mean', 'scale'}
+        :param n_output_features: number of output columns
+        """
+        self.input_columns = input_columns
+        self.numeric_columns = numeric_columns
+        self.categorical_blocks = categorical_blocks
+        self.numeric_blocks = numeric_blocks
+        self.n_output_features = n_output_features
+
+    def _encode(self, block: dict, values: list, output: np.ndarray) -> None:
+        codes = np.fromiter((block['lookup'].get(value, -1) for value in values), dtype=np.int64, count=len(values))
+        unknown = codes < 0
+        if unknown.any() and block['unknown_value'] is None:
+            unknown_values = sorted({str(value) for value, is_unknown in zip(values, unknown) if is_unknown})
+            raise ValueError(f"Found unknown categories {unknown_values} in column {block['column']} during transform")
+        rows = np.arange(len(values))
+        if block['kind'] == 'onehot':
+            # 'ignore' leaves the one hot columns of unknown categories at zero
+            output[rows[~unknown], block['output'] + codes[~unknown]] = 1
+        else:
+            output[:, block['output']] = np.where(unknown, block['unknown_value'], codes) if unknown.any() else codes
+
+    def _transform_numeric(self, numeric: np.ndarray, output: np.ndarray) -> None:
+        for block in self.numeric_blocks:
+            values = numeric[:, block['inputs']]
+            if block['kind'] == 'power':
+                values = yeo_johnson(values, block['lambdas'])
+            if block['kind'] in ('power', 'scale'):
+                values = (values - block['mean']) / block['scale']
+            output[:, block['output']:block['output'] + values.shape[1]] = values
+
+    def transform_record(self, record: dict) -> np.ndarray:
+        """
+        Transforms a single {column: value} record, the low latency path. Returns a (1, n_output_features) array.
+        """
+        output = np.zeros((1, self.n_output_features))
+        for block in self.categorical_blocks:
+            code = block['lookup'].get(record[block['column']])
+            if code is None:
+                # Unknown category, raised or encoded like in the batch path
+                self._encode(block, [record[block['column']]], output)
+            elif block['kind'] == 'onehot':
+                output[0, block['output'] + code] = 1
+            else:
+                output[0, block['output']] = code
+        numeric = np.array([[record[column] for column in self.numeric_columns]], dtype=np.float64)
+        self._transform_numeric(numeric, output)
+        return output
+
+    def transform(self, X: Union[pd.DataFrame, np.ndarray, dict, list]) -> np.ndarray:
+        """
+        Transforms a DataFrame, a raw 2-D array with the input_columns in order, a dict record or a list of
+        dict records. Returns a float64 array of shape (rows, n_output_features).
+        """
+        try:
+            if isinstance(X, dict):
+                return self.transform_record(X)
+            if isinstance(X, list):
+                columns = {column: [record[column] for record in X] for column in self.input_columns}
+            elif isinstance(X, pd.DataFrame):
+                columns = {column: X[column].to_numpy() for column in self.input_columns}
+            else:
+                X = np.asarray(X, dtype=object)
+                columns = {column: X[:, i] for i, column in enumerate(self.input_columns)}
+            n_rows = len(columns[self.input_columns[0]]) if self.input_columns else 0
+            output = np.zeros((n_rows, self.n_output_features))
+            for block in self.categorical_blocks:
+                self._encode(block, list(columns[block['column']]), output)
+            numeric = np.empty((n_rows, len(self.numeric_columns)))
+            for i, column in enumerate(self.numeric_columns):
+                numeric[:, i] = np.asarray(columns[column], dtype=np.float64)
+            self._transform_numeric(numeric, output)
+            return output
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def max_abs_difference(self, preprocessor: Pipeline, dataframe: pd.DataFrame, n_records: int = 100) -> float:
+        """
+        Returns the largest absolute difference between the sklearn preprocessor output and the compiled
+        output on dataframe, for the batch path and for the first n_records rows through the record path.
+        """
+        try:
+            expected = np.asarray(preprocessor.transform(dataframe), dtype=np.float64)
+            difference = np.abs(self.transform(dataframe) - expected)
+            records = dataframe.iloc[:n_records].to_dict(orient='records')
+            record_output = np.vstack([self.transform_record(record) for record in records]) if records else expected[:0]
+            record_difference = np.abs(record_output - expected[:len(records)])
+            # NaN outputs match when both sides are NaN
+            difference[np.isnan(difference) & np.isnan(expected)] = 0
+            record_difference[np.isnan(record_difference) & np.isnan(expected[:len(records)])] = 0
+            return float(max(difference.max(initial=0), record_difference.max(initial=0)))
+        except Exception as e:
+            raise MyException(e, sys)
+
+
+def compile_preprocessor(preprocessor: Union[Pipeline, ColumnTransformer]) -> CompiledPreprocessor:
+    """
+    Exports a fitted preprocessor into a CompiledPreprocessor.
+    Raises an exception for transformers or options the compiled transform does not implement.
+    """
+    try:
+        column_transformer = preprocessor
+        if isinstance(preprocessor, Pipeline):
+            if len(preprocessor.steps) != 1:
+                raise Exception("Only a Pipeline with a single ColumnTransformer step can be compiled")
+            column_transformer = preprocessor.steps[0][1]
+        if not isinstance(column_transformer, ColumnTransformer):
+            raise Exception(f"Can not compile a {type(column_transformer).__name__}, expected a ColumnTransformer")
+
+        input_columns = list(column_transformer.feature_names_in_)
+        numeric_columns, categorical_blocks, numeric_blocks = [], [], []
+        output = 0
+
+        def get_numeric_inputs(columns: list) -> np.ndarray:
+            for column in columns:
+                if column not in numeric_columns:
+                    numeric_columns.append(column)
+            return np.array([numeric_columns.index(column) for column in columns], dtype=np.int64)
+
+        for name, transformer, columns in column_transformer.transformers_:
+            if transformer == 'drop' or len(columns) == 0:
+                continue
+            # remainder columns are given as indices of the input columns
+            columns = [input_columns[column] if isinstance(column, (int, np.integer)) else column for column in columns]
+            if isinstance(transformer, Pipeline):
+                if len(transformer.steps) != 1:
+                    raise Exception(f"Transformer {name}: only single step pipelines can be compiled")
+                transformer = transformer.steps[0][1]
+
+            if isinstance(transformer, (OneHotEncoder, OrdinalEncoder)):
+                if isinstance(transformer, OneHotEncoder):
+                    if transformer.drop_idx_ is not None or getattr(transformer, '_infrequent_enabled', False):
+                        raise Exception(f"Transformer {name}: drop and infrequent categories can not be compiled")
+                    unknown_value = None if transformer.handle_unknown == 'error' else 0
+                else:
+                    unknown_value = transformer.unknown_value if transformer.handle_unknown == 'use_encoded_value' else None
+                for column, categories in zip(columns, transformer.categories_):
+                    kind = 'onehot' if isinstance(transformer, OneHotEncoder) else 'ordinal'
+                    categorical_blocks.append({'kind': kind, 'column': column, 'output': output,
+                                               'lookup': {category: code for code, category in enumerate(categories)},
+                                               'unknown_value': unknown_value})
+                    output += len(categories) if kind == 'onehot' else 1
+            elif isinstance(transformer, PowerTransformer):
+                if transformer.method != 'yeo-johnson':
+                    raise Exception(f"Transformer {name}: only the yeo-johnson power transform can be compiled")
+                mean, scale = get_scaler_parameters(transformer._scaler) if transformer.standardize \
+                    else (np.zeros(len(columns)), np.ones(len(columns)))
+                numeric_blocks.append({'kind': 'power', 'inputs': get_numeric_inputs(columns), 'output': output,
+                                       'lambdas': np.asarray(transformer.lambdas_, dtype=np.float64), 'mean': mean, 'scale': scale})
+                output += len(columns)
+            elif isinstance(transformer, StandardScaler):
+                mean, scale = get_scaler_parameters(transformer)
+                numeric_blocks.append({'kind': 'scale', 'inputs': get_numeric_inputs(columns), 'output': output,
+                                       'mean': mean, 'scale': scale})
+                output += len(columns)
+            elif transformer == 'passthrough':
+                numeric_blocks.append({'kind': 'passthrough', 'inputs': get_numeric_inputs(columns), 'output': output})
+                output += len(columns)
+            else:
+                raise Exception(f"Transformer {name}: {type(transformer).__name__} can not be compiled")
+
+        logging.info(f"Compiled preprocessor: {len(input_columns)} input columns, {output} output features")
+        return CompiledPreprocessor(input_columns=input_columns, numeric_columns=numeric_columns,
+                                    categorical_blocks=categorical_blocks, numeric_blocks=numeric_blocks,
+                                    n_output_features=output)
+    except Exception as e:
+        raise MyException(e, sys)
@@ -1,6 +1,7 @@
 import os
 from src.constants import *
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Optional
 from datetime import datetime
 
 TIMESTAMP:str = datetime.now().strftime("%m_%d_%y_%H_%M_%S")
@@ -10,6 +11,13 @@ class TrainingPipelineConfig:
     pipeline_name:str = PIPELINE_NAME
     artifact_dir:str = os.path.join(ARTIFACT_DIR,TIMESTAMP)
     timestamp:str = TIMESTAMP
+    use_stage_cache:bool = True
+    stage_cache_dir:str = os.path.join(ARTIFACT_DIR,STAGE_CACHE_DIR_NAME)
+    stage_cache_max_entries:int = STAGE_CACHE_MAX_ENTRIES
+    max_parallel_stages:int = PIPELINE_MAX_PARALLEL_STAGES
+    run_profile_file_path:str = os.path.join(ARTIFACT_DIR,TIMESTAMP,RUN_PROFILE_FILE_NAME)
+    profiler:Optional[str] = PIPELINE_PROFILER
+    profile_dir:str = os.path.join(ARTIFACT_DIR,TIMESTAMP,PIPELINE_PROFILE_DIR_NAME)
     
 training_pipeline_config: TrainingPipelineConfig = TrainingPipelineConfig()
 
@@ -22,21 +30,65 @@ class DataIngestionConfig:
     testing_file_path: str = os.path.join(data_ingestion_dir,DATA_INGESTION_INGESTED_DIR,TEST_FILE_NAME)
     train_test_split_ratio: float = DATA_INGESTION_TRAIN_TEST_SPLIT_RATIO
     collection_name: str = DATA_INGESTION_COLLECTION_NAME
+    batch_size: int = DATA_INGESTION_BATCH_SIZE
+    n_workers: int = DATA_INGESTION_N_WORKERS
+    incremental: bool = DATA_INGESTION_INCREMENTAL
+    full_refresh: bool = False
+    persistent_feature_store_dir: str = os.path.join(ARTIFACT_DIR,DATA_INGESTION_DIR_NAME,DATA_INGESTION_FEATURE_STORE_DIR)
+    feature_store_parts_dir: str = os.path.join(persistent_feature_store_dir,DATA_INGESTION_FEATURE_STORE_PARTS_DIR)
+    checkpoint_file_path: str = os.path.join(persistent_feature_store_dir,DATA_INGESTION_CHECKPOINT_FILE_NAME)
+    max_feature_store_parts: int = DATA_INGESTION_MAX_FEATURE_STORE_PARTS
     
 @dataclass
 class DataValidationConfig:
     data_validation_dir: str = os.path.join(training_pipeline_config.artifact_dir,DATA_VALIDATION_DIR_NAME)
     validation_report_file_path: str = os.path.join(data_validation_dir,DATA_VALIDATION_REPORT_FILE_NAME)
+    validation_chunk_size: int = DATA_VALIDATION_CHUNK_SIZE
+
+@dataclass
+class DataDriftConfig:
+    data_drift_dir: str = os.path.join(training_pipeline_config.artifact_dir,DATA_DRIFT_DIR_NAME)
+    reference_profile_file_path: str = os.path.join(data_drift_dir,DATA_DRIFT_REFERENCE_PROFILE_FILE_NAME)
+    drift_report_file_path: str = os.path.join(data_drift_dir,DATA_DRIFT_REPORT_FILE_NAME)
+    n_bins: int = DATA_DRIFT_N_BINS
+    psi_threshold: float = DATA_DRIFT_PSI_THRESHOLD
+    ks_threshold: float = DATA_DRIFT_KS_THRESHOLD
 
 @dataclass
 class DataTransformationConfig:
     data_transformation_dir:str = os.path.join(training_pipeline_config.artifact_dir,DATA_TRANSFORMATION_DIR_NAME)
     data_transformation_transformed_dir:str = os.path.join(data_transformation_dir,DATA_TRANSFORMATION_TRANSFORMED_DATA_DIR)
-    transformed_train_file_path:str = os.path.join(data_transformation_dir,DATA_TRANSFORMATION_TRANSFORMED_DATA_DIR,TRAIN_FILE_NAME.replace('csv','npy'))
-    transformed_test_file_path:str = os.path.join(data_transformation_dir,DATA_TRANSFORMATION_TRANSFORMED_DATA_DIR,TEST_FILE_NAME.replace('csv','npy'))
+    transformed_train_dir:str = os.path.join(data_transformation_dir,DATA_TRANSFORMATION_TRANSFORMED_DATA_DIR,TRAIN_FILE_NAME.split('.')[0])
+    transformed_test_dir:str = os.path.join(data_transformation_dir,DATA_TRANSFORMATION_TRANSFORMED_DATA_DIR,TEST_FILE_NAME.split('.')[0])
     transformed_object_file_path:str = os.path.join(data_transformation_dir,
                                                     DATA_TRANSFORMATION_TRANSFORMED_OBJECT_DIR,
                                                     PREPROCESSING_OBJECT_FILE_NAME)
+    compiled_object_file_path:str = os.path.join(data_transformation_dir,
+                                                 DATA_TRANSFORMATION_TRANSFORMED_OBJECT_DIR,
+                                                 COMPILED_PREPROCESSING_OBJECT_FILE_NAME)
+    feature_dtype:str = DATA_TRANSFORMATION_FEATURE_DTYPE
+    label_dtype:str = DATA_TRANSFORMATION_LABEL_DTYPE
+    storage_dtype:str = DATA_TRANSFORMATION_STORAGE_DTYPE
+    dtype_check_sample_size:int = DATA_TRANSFORMATION_DTYPE_CHECK_SAMPLE_SIZE
+    resample_test:bool = DATA_TRANSFORMATION_RESAMPLE_TEST
+    resampling_n_jobs:Optional[int] = DATA_TRANSFORMATION_RESAMPLING_N_JOBS
+    resampling_algorithm:str = DATA_TRANSFORMATION_RESAMPLING_ALGORITHM
+    resampling_ivf_n_probe:int = DATA_TRANSFORMATION_RESAMPLING_IVF_N_PROBE
+    resampling_random_state:int = DATA_TRANSFORMATION_RESAMPLING_RANDOM_STATE
+    compile_preprocessor:bool = DATA_TRANSFORMATION_COMPILE_PREPROCESSOR
+    compiled_tolerance:float = DATA_TRANSFORMATION_COMPILED_TOLERANCE
+    
+@dataclass
+class PrototypeReductionConfig:
+    prototype_reduction_dir:str = os.path.join(training_pipeline_config.artifact_dir,PROTOTYPE_REDUCTION_DIR_NAME)
+    reduced_train_dir:str = os.path.join(prototype_reduction_dir,PROTOTYPE_REDUCTION_REDUCED_DATA_DIR,TRAIN_FILE_NAME.split('.')[0])
+    method:Optional[str] = PROTOTYPE_REDUCTION_METHOD
+    kmeans_ratio:float = PROTOTYPE_REDUCTION_KMEANS_RATIO
+    max_kept_fraction:float = PROTOTYPE_REDUCTION_MAX_KEPT_FRACTION
+    condensing_batch_fraction:float = PROTOTYPE_REDUCTION_CONDENSING_BATCH_FRACTION
+    max_metric_drop:float = PROTOTYPE_REDUCTION_MAX_METRIC_DROP
+    validation_fraction:float = PROTOTYPE_REDUCTION_VALIDATION_FRACTION
+    random_state:int = PROTOTYPE_REDUCTION_RANDOM_STATE
     
 @dataclass
 class ModelTrainerConfig:
@@ -44,6 +96,66 @@ class ModelTrainerConfig:
     model_trainer_trained_model_file_path:str = os.path.join(model_trainer_dir,MODEL_TRAINER_TRAINED_MODEL_DIR,MODEL_TRAINER_TRAINED_MODEL_NAME)
     expected_accuracy:float = MODEL_TRAINER_EXPECTED_SCORE
     model_trainer_config_file_path:str = MODEL_TRAINER_MODEL_CONFIG_FILE_PATH
+    predict_batch_size:int = MODEL_TRAINER_PREDICT_BATCH_SIZE
     _weights:str = MODEL_TRAINER_WEIGHTS
     _n_neighbors:int = MODEL_TRAINER_N_NEIGHBORS
-    _algorithm:str = MODEL_TRAINER_ALGORITHM
\ No newline at end of file
+    _algorithm:str = MODEL_TRAINER_ALGORITHM
+    _ivf_n_lists:Optional[int] = MODEL_TRAINER_IVF_N_LISTS
+    _ivf_n_probe:int = MODEL_TRAINER_IVF_N_PROBE
+    
+@dataclass
+class ModelEvaluationConfig:
+    model_evaluation_dir:str = os.path.join(training_pipeline_config.artifact_dir,MODEL_EVALUATION_DIR_NAME)
+    evaluation_report_file_path:str = os.path.join(model_evaluation_dir,MODEL_EVALUATION_REPORT_FILE_NAME)
+    bucket_name:Optional[str] = MODEL_BUCKET_NAME
+    s3_model_key:str = MODEL_BUNDLE_FILE_NAME
+    metric:str = MODEL_EVALUATION_METRIC
+    changed_threshold_score:float = MODEL_EVALUATION_CHANGED_THRESHOLD_SCORE
+    max_latency_ratio:Optional[float] = MODEL_EVALUATION_MAX_LATENCY_RATIO
+    chunk_size:int = MODEL_EVALUATION_CHUNK_SIZE
+    bundle_dir:str = os.path.join(model_evaluation_dir,MODEL_EVALUATION_BUNDLE_DIR)
+    bundle_file_path:str = os.path.join(model_evaluation_dir,MODEL_BUNDLE_FILE_NAME)
+    compression:Optional[str] = MODEL_PUSHER_COMPRESSION
+    compression_level:int = MODEL_PUSHER_COMPRESSION_LEVEL
+    min_array_bytes:int = MODEL_PUSHER_MIN_ARRAY_BYTES
+    
+@dataclass
+class ModelPusherConfig:
+    model_pusher_dir:str = os.path.join(training_pipeline_config.artifact_dir,MODEL_PUSHER_DIR_NAME)
+    bundle_dir:str = os.path.join(model_pusher_dir,MODEL_PUSHER_BUNDLE_DIR)
+    bundle_file_path:str = os.path.join(model_pusher_dir,MODEL_BUNDLE_FILE_NAME)
+    bucket_name:Optional[str] = MODEL_BUCKET_NAME
+    s3_model_key:str = MODEL_BUNDLE_FILE_NAME
+    compression:Optional[str] = MODEL_PUSHER_COMPRESSION
+    compression_level:int = MODEL_PUSHER_COMPRESSION_LEVEL
+    min_array_bytes:int = MODEL_PUSHER_MIN_ARRAY_BYTES
+    
+@dataclass
+class BatchPredictionConfig:
+    batch_prediction_dir:str = os.path.join(training_pipeline_config.artifact_dir,BATCH_PREDICTION_DIR_NAME)
+    predictions_file_path:str = os.path.join(batch_prediction_dir,BATCH_PREDICTION_FILE_NAME)
+    input_source:str = BATCH_PREDICTION_INPUT_SOURCE
+    # file path for 'file', key prefix for 's3'
+    input_path:Optional[str] = None
+    input_bucket_name:Optional[str] = None
+    input_collection_name:str = DATA_INGESTION_COLLECTION_NAME
+    # local model file, or its key in model_bucket_name when that is set
+    model_file_path:Optional[str] = None
+    model_bucket_name:Optional[str] = None
+    chunk_size:int = BATCH_PREDICTION_CHUNK_SIZE
+    n_workers:Optional[int] = BATCH_PREDICTION_N_WORKERS
+    max_pending_chunks_per_worker:int = BATCH_PREDICTION_MAX_PENDING_CHUNKS_PER_WORKER
+    prediction_column:str = BATCH_PREDICTION_PREDICTION_COLUMN
+    include_input_columns:bool = True
+
+@dataclass
+class ServingConfig:
+    # local model file, or its key in model_bucket_name when that is set
+    # read from the environment when the service starts
+    model_file_path:Optional[str] = field(default_factory=lambda: os.getenv(SERVING_MODEL_FILE_PATH_KEY))
+    model_bucket_name:Optional[str] = field(default_factory=lambda: os.getenv(SERVING_MODEL_BUCKET_NAME_KEY))
+    max_batch_size:int = SERVING_MAX_BATCH_SIZE
+    max_wait_ms:float = SERVING_MAX_WAIT_MS
+    metrics_window:int = SERVING_METRICS_WINDOW
+    model_cache_max_versions:int = SERVING_MODEL_CACHE_MAX_VERSIONS
+    model_reload_interval_seconds:Optional[float] = SERVING_MODEL_RELOAD_INTERVAL_SECONDS
@@ -1,11 +1,13 @@
 import sys
+from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
-from pandas import DataFrame
 from sklearn.pipeline import Pipeline
 
 from src.logger import logging
 from src.exception import MyException
+from src.utils.main_utils import quantize_features, dequantize_features
 
 class TargetValueMapping:
     def __init__(self):
@@ -18,28 +20,68 @@ class TargetValueMapping:
         return dict(zip(mapping_response.values(),mapping_response.key()))
 
 class MyModel:
-    def __init__(self, preprocessing_object: Pipeline, trained_model_object: object):
+    def __init__(self, preprocessing_object: Pipeline, trained_model_object: object,
+                 compiled_preprocessor: Optional[object] = None, feature_dtype: Optional[str] = None,
+                 quantization: Optional[tuple] = None):
         """
         :param preprocessing_object: Input Object of preprocesser
         :param trained_model_object: Input Object of trained model 
+        :param compiled_preprocessor: NumPy-only CompiledPreprocessor verified against preprocessing_object (optional),
+                                      used instead of it when present
+        :param feature_dtype: dtype of the features the model was fitted on, queries are cast to it
+        :param quantization: (offset, scale) int8 grid of the train set when it was stored quantized (optional),
+                             queries are snapped to it
         """
         self.preprocessing_object=preprocessing_object
         self.trained_model_object=trained_model_object
+        self.compiled_preprocessor=compiled_preprocessor
+        self.feature_dtype=feature_dtype
+        self.quantization=quantization
         
-    def predict(self, dataframe:pd.DataFrame) -> DataFrame:
+    def get_input_columns(self) -> list:
         """
-        Function accepts preprocessed inputs (with all custom transformations already applied),
-        applies scaling using preprocessing_object, and performs prediction on transformed features.
+        Returns the input columns of the preprocessing, other columns of a dataframe are not used.
+        """
+        compiled_preprocessor = getattr(self, 'compiled_preprocessor', None)
+        if compiled_preprocessor is not None:
+            return list(compiled_preprocessor.input_columns)
+        return list(self.preprocessing_object.feature_names_in_)
+        
+    def transform(self, dataframe: Union[pd.DataFrame, dict, list]) -> np.ndarray:
+        """
+        Applies the preprocessing to a dataframe, a single {column: value} record or a list of records, with the compiled
+        preprocessor when available, and returns the features in the dtype of the trained model, on its int8 grid
+        when it was trained on quantized features.
+        """
+        # Models saved before the compiled preprocessor existed do not have the attributes
+        compiled_preprocessor = getattr(self, 'compiled_preprocessor', None)
+        if compiled_preprocessor is not None:
+            transformed_data = compiled_preprocessor.transform(dataframe)
+        else:
+            if isinstance(dataframe, (dict, list)):
+                dataframe = pd.DataFrame.from_records([dataframe] if isinstance(dataframe, dict) else dataframe)
+            transformed_data = self.preprocessing_object.transform(dataframe)
+        feature_dtype = getattr(self, 'feature_dtype', None)
+        quantization = getattr(self, 'quantization', None)
+        if quantization is not None:
+            codes, offset, scale = quantize_features(np.asarray(transformed_data), *quantization)
+            return dequantize_features(codes, offset, scale, dtype=feature_dtype or 'float32')
+        return np.asarray(transformed_data, dtype=feature_dtype) if feature_dtype else transformed_data
+        
+    def predict(self, dataframe: Union[pd.DataFrame, dict, list]) -> np.ndarray:
+        """
+        Function accepts preprocessed inputs (with all custom transformations already applied) as a dataframe,
+        a single record or a list of records, applies scaling using the preprocessing, and performs prediction on transformed features.
         """
         try:
             logging.info("Starting prediction process")
             
-            # Step 1: Apply scaling transformations using the pre-trained preprocessig object
-            transformed_data = self.preprocessing_object.transform(dataframe)
+            # Step 1: Apply scaling transformations using the pre-trained (compiled) preprocessig object
+            transformed_data = self.transform(dataframe)
             
             # Step 2: Perform prediction using the trained model
             logging.info("Using the trained model to get prediction")
-            predictions = self.trained_model_object.transform(transformed_data)
+            predictions = self.trained_model_object.predict(transformed_data)
             
             return predictions
         except Exception as e:
@@ -0,0 +1,369 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.base import BaseEstimator
+from sklearn.neighbors import NearestNeighbors, KNeighborsClassifier
+
+from src.logger import logging
+from src.exception import MyException
+
+EXACT_ALGORITHMS = ('auto', 'brute', 'kd_tree', 'ball_tree')
+APPROXIMATE_ALGORITHMS = ('ivf',)
+
+
+def squared_distances(queries: np.ndarray, vectors: np.ndarray, vector_norms: np.ndarray) -> np.ndarray:
+    """
+    Returns the squared euclidean distances between every query and every vector,
+    computed as |q|^2 - 2 q.v + |v|^2 so the heavy part is a single matrix product.
+    """
+    distances = queries @ vectors.T
+    distances *= -2
+    distances += np.einsum('ij,ij->i', queries, queries)[:, None]
+    distances += vector_norms[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def smallest_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the column indices of the k smallest values of every row, in no particular order.
+    For the small k of a KNN model k argmin passes are several times faster than argpartition.
+    distances is modified in place.
+    """
+    if k > 8:
+        return np.argpartition(distances, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(distances))
+    smallest = np.empty((len(distances), k), dtype=np.int64)
+    # Position at which a row ran out of finite values, k when it did not
+    n_finite = np.full(len(distances), k)
+    for position in range(k):
+        smallest[:, position] = distances.argmin(axis=1)
+        n_finite[(n_finite == k) & np.isinf(distances[rows, smallest[:, position]])] = position
+        distances[rows, smallest[:, position]] = np.inf
+    # Past its finite values argmin returns the columns already selected, the remaining
+    # positions of the row get distinct unselected (infinite) columns instead
+    for row in np.flatnonzero(n_finite < k):
+        position = n_finite[row]
+        smallest[row, position:] = np.setdiff1d(np.arange(distances.shape[1]), smallest[row, :position])[:k - position]
+    return smallest
+
+
+def assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+    """
+    Returns the index of the closest centroid of every vector. The |v|^2 term does not
+    change the argmin and is skipped, chunks are kept small so they stay in cache.
+    """
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        distances = vectors[start:start + chunk_size] @ centroids.T
+        distances *= -2
+        distances += centroid_norms
+        assignments[start:start + chunk_size] = distances.argmin(axis=1)
+    return assignments
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 10, random_state: int = 42) -> np.ndarray:
+    """
+    Returns n_clusters k-means centroids of vectors (Lloyd iterations from a random start).
+    Empty clusters keep their previous centroid.
+    """
+    n_clusters = max(1, min(n_clusters, len(vectors)))
+    rng = np.random.default_rng(random_state)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].astype(np.float64)
+    for _ in range(n_iter):
+        assignments = assign_to_centroids(vectors, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.stack([np.bincount(assignments, weights=vectors[:, feature], minlength=n_clusters)
+                         for feature in range(vectors.shape[1])], axis=1)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids
+
+
+class ExactNeighborIndex:
+    """
+    Exact neighbor search with the sklearn brute force, KD tree or Ball tree backend.
+    """
+    def __init__(self, algorithm: str = 'auto'):
+        self.algorithm = algorithm
+
+    def fit(self, vectors: np.ndarray) -> 'ExactNeighborIndex':
+        self._index = NearestNeighbors(algorithm=self.algorithm).fit(vectors)
+        return self
+
+    def kneighbors(self, queries: np.ndarray, n_neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._index.kneighbors(queries, n_neighbors=n_neighbors)
+
+
+class IVFNeighborIndex:
+    """
+    Approximate neighbor search with an inverted file index built on NumPy.
+
+    The training vectors are clustered with k-means into n_lists cells and stored
+    grouped by cell. A query only scans the n_probe cells whose centroids are the
+    closest to it, so the work per query is about n_probe / n_lists of a brute force scan.
+    Queries probing the same cell are scored together with one matrix product.
+    """
+    def __init__(self, n_lists: Optional[int] = None, n_probe: int = 8, n_iter: int = 10,
+                 training_sample_size: int = 256, random_state: int = 42):
+        """
+        :param n_lists: number of k-means cells, defaults to sqrt(number of vectors)
+        :param n_probe: number of cells scanned per query, higher is slower and more exact
+        :param n_iter: k-means iterations
+        :param training_sample_size: vectors sampled per cell to train k-means
+        :param random_state: seed of the k-means sampling
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.training_sample_size = training_sample_size
+        self.random_state = random_state
+
+    def fit(self, vectors: np.ndarray) -> 'IVFNeighborIndex':
+        try:
+            # float32 reference sets stay float32, the distance computations then touch half the memory
+            dtype = vectors.dtype if vectors.dtype in (np.float32, np.float64) else np.float64
+            vectors = np.ascontiguousarray(vectors, dtype=dtype)
+            n_lists = self.n_lists or int(np.sqrt(len(vectors)))
+            n_lists = max(1, min(n_lists, len(vectors)))
+            rng = np.random.default_rng(self.random_state)
+
+            # k-means on a sample, it only has to place the cells roughly
+            sample_size = min(len(vectors), n_lists * self.training_sample_size)
+            sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+            self.centroids_ = kmeans(sample, n_clusters = n_lists, n_iter = self.n_iter, random_state = self.random_state).astype(dtype)
+            self._centroid_norms = np.einsum('ij,ij->i', self.centroids_, self.centroids_)
+
+            # Vectors are stored grouped by cell, cell l spans offsets_[l]:offsets_[l+1]
+            assignments = assign_to_centroids(vectors, self.centroids_)
+            order = np.argsort(assignments, kind='stable')
+            self.ids_ = order
+            self.vectors_ = vectors[order]
+            self.vector_norms_ = np.einsum('ij,ij->i', self.vectors_, self.vectors_)
+            self.offsets_ = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+            logging.info(f"IVF index built: {len(vectors)} vectors in {n_lists} cells")
+            return self
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def kneighbors(self, queries: np.ndarray, n_neighbors: int, n_probe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the distances and training indices of the approximate n_neighbors nearest
+        vectors of every query, sorted by distance. Missing neighbors (fewer than
+        n_neighbors vectors in the probed cells) have an infinite distance and index -1.
+        n_probe overrides the cells scanned per query, probing all the cells is an exact search.
+        """
+        try:
+            queries = np.ascontiguousarray(queries, dtype=self.vectors_.dtype)
+            n_queries, n_lists = len(queries), len(self.centroids_)
+            n_probe = min(n_probe or self.n_probe, n_lists)
+            centroid_distances = squared_distances(queries, self.centroids_, self._centroid_norms)
+            probes = np.argpartition(centroid_distances, n_probe - 1, axis=1)[:, :n_probe] if n_probe < n_lists \
+                else np.broadcast_to(np.arange(n_lists), (n_queries, n_lists))
+
+            # Every (query, probed cell) pair gets a slot of n_neighbors candidates, the final
+            # neighbors are selected once over the n_probe * n_neighbors candidates of a query
+            candidate_distances = np.full((n_queries * n_probe, n_neighbors), np.inf, dtype=self.vectors_.dtype)
+            candidate_ids = np.full((n_queries * n_probe, n_neighbors), -1, dtype=np.int64)
+
+            # Group the (query, cell) pairs by cell so every cell is scanned once per batch
+            flat_probes = probes.ravel()
+            pair_order = np.argsort(flat_probes, kind='stable')
+            cell_bounds = np.concatenate([[0], np.cumsum(np.bincount(flat_probes, minlength=n_lists))])
+            for cell in range(n_lists):
+                start, end = self.offsets_[cell], self.offsets_[cell + 1]
+                if start == end or cell_bounds[cell] == cell_bounds[cell + 1]:
+                    continue
+                pairs = pair_order[cell_bounds[cell]:cell_bounds[cell + 1]]
+                distances = squared_distances(queries[pairs // n_probe], self.vectors_[start:end], self.vector_norms_[start:end])
+                if distances.shape[1] > n_neighbors:
+                    top = smallest_k(distances.copy(), n_neighbors)
+                    candidate_distances[pairs] = np.take_along_axis(distances, top, axis=1)
+                    candidate_ids[pairs] = self.ids_[start:end][top]
+                else:
+                    candidate_distances[pairs, :distances.shape[1]] = distances
+                    candidate_ids[pairs, :distances.shape[1]] = self.ids_[start:end]
+
+            candidate_distances = candidate_distances.reshape(n_queries, -1)
+            candidate_ids = candidate_ids.reshape(n_queries, -1)
+            if candidate_distances.shape[1] > n_neighbors:
+                top = smallest_k(candidate_distances.copy(), n_neighbors)
+                candidate_distances = np.take_along_axis(candidate_distances, top, axis=1)
+                candidate_ids = np.take_along_axis(candidate_ids, top, axis=1)
+            order = np.argsort(candidate_distances, axis=1)
+            return np.sqrt(np.take_along_axis(candidate_distances, order, axis=1)), np.take_along_axis(candidate_ids, order, axis=1)
+        except Exception as e:
+            raise MyException(e, sys)
+
+
+def search_neighbors(index: object, X: np.ndarray, n_neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns index.kneighbors(X, n_neighbors). Rows whose probed IVF cells hold fewer than n_neighbors
+    vectors are searched again with twice as many cells, up to all of them (an exact search), so every
+    row gets n_neighbors distinct neighbors when the index holds that many vectors.
+    """
+    distances, ids = index.kneighbors(X, n_neighbors)
+    rows = np.flatnonzero((ids < 0).any(axis=1))
+    n_probe, n_lists = getattr(index, 'n_probe', None), len(getattr(index, 'centroids_', ()))
+    while len(rows) > 0 and n_probe is not None and n_probe < n_lists:
+        n_probe = min(n_probe * 2, n_lists)
+        distances[rows], ids[rows] = index.kneighbors(X[rows], n_neighbors, n_probe=n_probe)
+        rows = rows[(ids[rows] < 0).any(axis=1)]
+    return distances, ids
+
+
+class NeighborIndexClassifier:
+    """
+    k-nearest neighbors classifier on top of any neighbor index exposing fit/kneighbors.
+    Votes follow KNeighborsClassifier: 'uniform' or 'distance' weights, and with
+    'distance' weights exact matches (zero distance) take all the weight. Rows missing
+    neighbors in the probed IVF cells are searched again with more cells (search_neighbors).
+    """
+    def __init__(self, index: object, n_neighbors: int = 5, weights: str = 'uniform', batch_size: int = 10000):
+        """
+        :param index: neighbor index, e.g. IVFNeighborIndex
+        :param n_neighbors: number of neighbors voting
+        :param weights: 'uniform' or 'distance'
+        :param batch_size: rows searched at once in predict, bounds the distance matrices in memory
+        """
+        self.index = index
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.batch_size = batch_size
+
+    def fit(self, X: np.ndarray, y: np.ndarray) -> 'NeighborIndexClassifier':
+        self.classes_, self._y = np.unique(y, return_inverse=True)
+        self.index.fit(X)
+        self.n_samples_fit_ = len(X)
+        return self
+
+    def kneighbors(self, X: np.ndarray, n_neighbors: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        return search_neighbors(self.index, X, n_neighbors or self.n_neighbors)
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        probabilities = np.empty((len(X), len(self.classes_)))
+        for start in range(0, len(X), self.batch_size):
+            distances, ids = self.kneighbors(X[start:start + self.batch_size])
+            found = ids >= 0
+            if self.weights == 'distance':
+                with np.errstate(divide='ignore'):
+                    weights = 1.0 / distances
+                exact_matches = distances == 0
+                has_exact_match = exact_matches.any(axis=1)
+                weights[has_exact_match] = exact_matches[has_exact_match]
+            else:
+                weights = np.ones_like(distances)
+            weights[~found] = 0
+            labels = self._y[np.where(found, ids, 0)]
+            votes = np.stack([(weights * (labels == label)).sum(axis=1) for label in range(len(self.classes_))], axis=1)
+            totals = votes.sum(axis=1, keepdims=True)
+            if (totals == 0).any():
+                # Only an index without any vector in reach of a row gets here, argmax would silently pick class 0
+                raise ValueError(f"No neighbors found for {int((totals == 0).sum())} rows, "
+                                 f"the index holds {self.n_samples_fit_} vectors")
+            probabilities[start:start + self.batch_size] = votes / totals
+        return probabilities
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+class IndexNearestNeighbors(BaseEstimator):
+    """
+    sklearn NearestNeighbors compatible estimator (fit, kneighbors, kneighbors_graph) over a
+    neighbor index, so approximate indexes can be plugged into estimators taking a neighbors
+    object, e.g. the SMOTE and ENN steps of imblearn. Queries are searched batch_size rows at a
+    time on n_jobs threads, the matrix products of the index release the GIL.
+    """
+    def __init__(self, n_neighbors: int = 5, algorithm: str = 'ivf', ivf_n_lists: Optional[int] = None,
+                 ivf_n_probe: int = 8, batch_size: int = 10000, n_jobs: Optional[int] = None):
+        """
+        :param n_neighbors: default number of neighbors of kneighbors
+        :param algorithm: neighbor index, see get_neighbor_index
+        :param ivf_n_lists: number of IVF cells
+        :param ivf_n_probe: number of IVF cells scanned per query
+        :param batch_size: rows searched at once
+        :param n_jobs: number of threads searching batches, None for 1 and -1 for all CPUs
+        """
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.ivf_n_lists = ivf_n_lists
+        self.ivf_n_probe = ivf_n_probe
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def fit(self, X: np.ndarray, y: Optional[np.ndarray] = None) -> 'IndexNearestNeighbors':
+        self.index_ = get_neighbor_index(self.algorithm, ivf_n_lists=self.ivf_n_lists, ivf_n_probe=self.ivf_n_probe).fit(X)
+        self.n_samples_fit_ = len(X)
+        return self
+
+    def kneighbors(self, X: np.ndarray, n_neighbors: Optional[int] = None, return_distance: bool = True):
+        n_neighbors = n_neighbors or self.n_neighbors
+        if n_neighbors > self.n_samples_fit_:
+            raise ValueError(f"Expected n_neighbors <= n_samples_fit, but n_neighbors = {n_neighbors}, "
+                             f"n_samples_fit = {self.n_samples_fit_}")
+        batches = [X[start:start + self.batch_size] for start in range(0, len(X), self.batch_size)]
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else (self.n_jobs or 1)
+        if n_jobs > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(lambda batch: search_neighbors(self.index_, batch, n_neighbors), batches))
+        else:
+            results = [search_neighbors(self.index_, batch, n_neighbors) for batch in batches]
+        distances = np.concatenate([result[0] for result in results])
+        ids = np.concatenate([result[1] for result in results])
+        return (distances, ids) if return_distance else ids
+
+    def kneighbors_graph(self, X: np.ndarray, n_neighbors: Optional[int] = None, mode: str = 'connectivity') -> csr_matrix:
+        distances, ids = self.kneighbors(X, n_neighbors)
+        data = distances.ravel() if mode == 'distance' else np.ones(ids.size)
+        return csr_matrix((data, ids.ravel(), np.arange(0, ids.size + 1, ids.shape[1])),
+                          shape=(len(X), self.n_samples_fit_))
+
+
+def get_nearest_neighbors(algorithm: str, n_neighbors: int, n_jobs: Optional[int] = None,
+                          ivf_n_lists: Optional[int] = None, ivf_n_probe: int = 8) -> object:
+    """
+    Returns an unfitted nearest neighbors estimator: sklearn NearestNeighbors for the exact
+    algorithms ('brute' searches in memory bounded chunks) and IndexNearestNeighbors otherwise.
+    """
+    if algorithm in EXACT_ALGORITHMS:
+        return NearestNeighbors(n_neighbors=n_neighbors, algorithm=algorithm, n_jobs=n_jobs)
+    return IndexNearestNeighbors(n_neighbors=n_neighbors, algorithm=algorithm, ivf_n_lists=ivf_n_lists,
+                                 ivf_n_probe=ivf_n_probe, n_jobs=n_jobs)
+
+
+def get_neighbor_index(algorithm: str, ivf_n_lists: Optional[int] = None, ivf_n_probe: int = 8) -> object:
+    """
+    Returns an unfitted neighbor index for algorithm: one of EXACT_ALGORITHMS or 'ivf'.
+    """
+    if algorithm in EXACT_ALGORITHMS:
+        return ExactNeighborIndex(algorithm=algorithm)
+    if algorithm == 'ivf':
+        return IVFNeighborIndex(n_lists=ivf_n_lists, n_probe=ivf_n_probe)
+    raise ValueError(f"Unknown neighbor algorithm {algorithm}, expected one of {EXACT_ALGORITHMS + APPROXIMATE_ALGORITHMS}")
+
+
+def get_neighbor_classifier(algorithm: str, n_neighbors: int, weights: str,
+                            ivf_n_lists: Optional[int] = None, ivf_n_probe: int = 8) -> object:
+    """
+    Returns an unfitted KNN classifier: KNeighborsClassifier for the exact sklearn
+    algorithms and NeighborIndexClassifier over an approximate index otherwise.
+    """
+    if algorithm in EXACT_ALGORITHMS:
+        return KNeighborsClassifier(n_neighbors=n_neighbors, weights=weights, algorithm=algorithm)
+    return NeighborIndexClassifier(index=get_neighbor_index(algorithm, ivf_n_lists=ivf_n_lists, ivf_n_probe=ivf_n_probe),
+                                   n_neighbors=n_neighbors, weights=weights)
+
+
+def predict_in_batches(clf: object, X: np.ndarray, batch_size: int) -> np.ndarray:
+    """
+    Returns clf.predict(X) computed batch_size rows at a time, so the neighbor distances and
+    indices in memory stay bounded and a memory mapped X is only paged in one batch at a time.
+    """
+    if len(X) <= batch_size:
+        return clf.predict(X)
+    return np.concatenate([clf.predict(X[start:start + batch_size]) for start in range(0, len(X), batch_size)])
@@ -1,40 +1,190 @@
 from src.cloud_storage.aws_storage import SimpleStorageService
+from src.constants import SERVING_MODEL_CACHE_MAX_VERSIONS
 from src.exception import MyException
 from src.entity.estimator import MyModel
+from src.logger import logging
 import sys
+import threading
+from collections import OrderedDict
+from typing import Optional
 from pandas import DataFrame
 
 
 class Proj1Estimator:
     """
     This class is used to save and retrieve our model from s3 bucket and to do prediction
+
+    The served model is cached in memory by S3 ETag. refresh checks the ETag with a HEAD request and
+    swaps a new version in atomically: predict reads the current (version, model) pair once, so
+    in-flight predictions finish on the model they started with. The last max_cached_versions
+    models stay in memory for an instant rollback. A rollback pins the version it swapped in: refresh
+    keeps serving it until the bucket holds a version other than the one rolled back from, or until unpin.
     """
 
-    def __init__(self,bucket_name,model_path,):
+    def __init__(self,bucket_name,model_path,max_cached_versions:int=SERVING_MODEL_CACHE_MAX_VERSIONS):
         """
         :param bucket_name: Name of your model bucket
         :param model_path: Location of your model in bucket
+        :param max_cached_versions: Number of model versions kept in memory, the current one included
         """
         self.bucket_name = bucket_name
         self.s3 = SimpleStorageService()
         self.model_path = model_path
-        self.loaded_model:MyModel=None
+        self.max_cached_versions = max_cached_versions
+        # (etag, model) of the served version, replaced as a whole
+        self._current:tuple = (None, None)
+        self._versions = OrderedDict()
+        self._versions_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        # ETag served when the model was rolled back, None when no rollback is pinned
+        self._rolled_back_from:Optional[str] = None
+        self._stop_polling = threading.Event()
+        self._polling_thread:Optional[threading.Thread] = None
+
+    @property
+    def loaded_model(self)->Optional[MyModel]:
+        return self._current[1]
+
+    @property
+    def loaded_version(self)->Optional[str]:
+        return self._current[0]
 
+    @property
+    def is_pinned(self)->bool:
+        return self._rolled_back_from is not None
+
+    @property
+    def cached_versions(self)->list:
+        """
+        ETags of the models in memory, least recently served first.
+        """
+        with self._versions_lock:
+            return list(self._versions)
 
     def is_model_present(self,model_path):
+        """
+        Checks the model key with one HEAD request, a following load_model reuses its ETag.
+        """
         try:
-            return self.s3.s3_key_path_available(bucket_name=self.bucket_name, s3_key=model_path)
+            return self.s3.get_object_metadata(bucket_name=self.bucket_name, s3_key=model_path) is not None
         except MyException as e:
             print(e)
             return False
 
-    def load_model(self,)->MyModel:
+    def get_model_version(self,use_cache:bool=False)->Optional[str]:
+        """
+        Returns the ETag of the model in the bucket with a single HEAD request, None when it is missing.
+        :param use_cache: whether an ETag from the short lived metadata cache may be returned
+        """
+        return self.s3.get_object_etag(bucket_name=self.bucket_name, s3_key=self.model_path, use_cache=use_cache)
+
+    def load_model(self,etag:Optional[str]=None)->MyModel:
         """
         Load the model from the model_path
+        :param etag: version to load, the load fails when the model in the bucket has changed since
         :return:
         """
 
-        return self.s3.load_model(self.model_path,bucket_name=self.bucket_name)
+        return self.s3.load_model(self.model_path,bucket_name=self.bucket_name,etag=etag)
+
+    def _swap(self,etag:str,model:MyModel)->None:
+        with self._versions_lock:
+            self._versions[etag] = model
+            self._versions.move_to_end(etag)
+            while len(self._versions) > self.max_cached_versions:
+                self._versions.popitem(last=False)
+            self._current = (etag, model)
+
+    def refresh(self)->bool:
+        """
+        Serves the model version currently in the bucket. A version still in memory is swapped in
+        without a download, another one is loaded first while the previous version keeps serving.
+        A pinned rollback is kept while the bucket still holds the version rolled back from.
+        :return: True when the served version changed
+        """
+        try:
+            with self._reload_lock:
+                etag = self.get_model_version()
+                if etag is None:
+                    raise Exception(f"Model s3://{self.bucket_name}/{self.model_path} not found")
+                if self._rolled_back_from is not None:
+                    if etag == self._rolled_back_from:
+                        return False
+                    logging.info(f"New model version {etag} in the bucket, releasing the rollback to {self.loaded_version}")
+                    self._rolled_back_from = None
+                if etag == self.loaded_version:
+                    return False
+                with self._versions_lock:
+                    model = self._versions.get(etag)
+                if model is None:
+                    model = self.load_model(etag=etag)
+                self._swap(etag, model)
+                logging.info(f"Serving model s3://{self.bucket_name}/{self.model_path} version {etag}")
+                return True
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def rollback(self,etag:Optional[str]=None)->str:
+        """
+        Swaps back to a model version still in memory and pins it, refresh does not serve the
+        version rolled back from again.
+        :param etag: version to serve, by default the one served before the current version
+        :return: the ETag of the served version
+        """
+        try:
+            with self._reload_lock:
+                cached_versions = self.cached_versions
+                if etag is None:
+                    if len(cached_versions) < 2:
+                        raise Exception("No previous model version in memory to roll back to")
+                    etag = cached_versions[-2]
+                with self._versions_lock:
+                    model = self._versions.get(etag)
+                if model is None:
+                    raise Exception(f"Model version {etag} is not in memory, cached versions: {cached_versions}")
+                # A second rollback stays pinned against the version of the first one
+                if self._rolled_back_from is None:
+                    self._rolled_back_from = self.loaded_version
+                self._swap(etag, model)
+                logging.info(f"Rolled back to model version {etag}, pinned until the bucket holds "
+                             f"a version other than {self._rolled_back_from}")
+                return etag
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def unpin(self)->None:
+        """
+        Releases a pinned rollback, the next refresh serves the version in the bucket again.
+        """
+        with self._reload_lock:
+            if self._rolled_back_from is not None:
+                logging.info(f"Released the rollback to model version {self.loaded_version}")
+            self._rolled_back_from = None
+
+    def _poll(self,interval_seconds:float)->None:
+        while not self._stop_polling.wait(interval_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                # The current version keeps serving, the next check retries
+                logging.error(f"Model refresh failed: {e}")
+
+    def start_polling(self,interval_seconds:float)->None:
+        """
+        Checks for a new model version every interval_seconds on a background thread.
+        """
+        if self._polling_thread is not None and self._polling_thread.is_alive():
+            return
+        self._stop_polling.clear()
+        self._polling_thread = threading.Thread(target=self._poll, args=(interval_seconds,),
+                                                name='model_reload', daemon=True)
+        self._polling_thread.start()
+
+    def stop_polling(self)->None:
+        self._stop_polling.set()
+        if self._polling_thread is not None:
+            self._polling_thread.join()
+            self._polling_thread = None
 
     def save_model(self,from_file,remove:bool=False)->None:
         """
@@ -59,8 +209,10 @@ class Proj1Estimator:
         :return:
         """
         try:
-            if self.loaded_model is None:
-                self.loaded_model = self.load_model()
-            return self.loaded_model.predict(dataframe=dataframe)
+            model = self.loaded_model
+            if model is None:
+                self.refresh()
+                model = self.loaded_model
+            return model.predict(dataframe=dataframe)
         except Exception as e:
-            raise MyException(e, sys)
\ No newline at end of file
+            raise MyException(e, sys)
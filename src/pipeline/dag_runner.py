@@ -0,0 +1,102 @@
+import sys
+import time
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List
+
+from src.logger import logging
+from src.exception import MyException
+
+
+@dataclass
+class PipelineStage:
+    """
+    A node of the pipeline DAG.
+
+    name: unique stage name, the artifact of the stage is passed downstream as `<name>_artifact`
+    run: callable producing the stage artifact, called with the artifacts of its inputs as keyword arguments
+    inputs: names of the stages whose artifacts this stage consumes
+    """
+    name: str
+    run: Callable[..., object]
+    inputs: List[str] = field(default_factory=list)
+
+
+class DAGRunner:
+    """
+    Runs pipeline stages as a DAG: a stage starts as soon as all of its inputs are available,
+    so stages that do not depend on each other run concurrently on a thread pool.
+    """
+
+    def __init__(self, stages: List[PipelineStage], max_workers: int):
+        """
+        :param stages: stages of the pipeline, in any order
+        :param max_workers: maximum number of stages running at the same time
+        """
+        try:
+            self.stages = {stage.name: stage for stage in stages}
+            self.max_workers = max_workers
+            self.stage_timings: Dict[str, dict] = {}
+            self.validate()
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def validate(self) -> None:
+        """
+        Checks that every input refers to a known stage and that the stages have no cycle.
+        """
+        for stage in self.stages.values():
+            unknown_inputs = [name for name in stage.inputs if name not in self.stages]
+            if len(unknown_inputs) > 0:
+                raise Exception(f"Stage {stage.name} depends on unknown stages: {unknown_inputs}")
+
+        resolved = set()
+        remaining = dict(self.stages)
+        while remaining:
+            ready = [name for name, stage in remaining.items() if set(stage.inputs) <= resolved]
+            if len(ready) == 0:
+                raise Exception(f"Pipeline stages have a cycle: {sorted(remaining)}")
+            resolved.update(ready)
+            for name in ready:
+                remaining.pop(name)
+
+    def run_stage(self, stage: PipelineStage, artifacts: Dict[str, object]) -> object:
+        start_time = time.perf_counter()
+        logging.info(f"Starting stage: {stage.name}")
+        artifact = stage.run(**{f"{name}_artifact": artifacts[name] for name in stage.inputs})
+        self.stage_timings[stage.name] = {'seconds': time.perf_counter() - start_time}
+        logging.info(f"Finished stage: {stage.name} in {self.stage_timings[stage.name]['seconds']:.3f}s")
+        return artifact
+
+    def run(self) -> Dict[str, object]:
+        """
+        Runs every stage once its inputs are done and returns the artifacts keyed by stage name.
+        The first failing stage stops the scheduling of new stages and its error is raised
+        once the running stages have finished.
+        """
+        try:
+            artifacts: Dict[str, object] = {}
+            pending = dict(self.stages)
+            running = {}
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pipeline-stage') as executor:
+                while pending or running:
+                    ready = [name for name, stage in pending.items() if all(name in artifacts for name in stage.inputs)]
+                    for name in ready:
+                        running[executor.submit(self.run_stage, pending.pop(name), artifacts)] = name
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        error = future.exception()
+                        if error is not None:
+                            logging.info(f"Stage {name} failed, waiting for running stages before stopping")
+                            wait(running)
+                            raise error
+                        artifacts[name] = future.result()
+
+            total_seconds = sum(timing['seconds'] for timing in self.stage_timings.values())
+            logging.info(f"Stage timings: { {name: round(timing['seconds'], 3) for name, timing in self.stage_timings.items()} } "
+                         f"(sum {total_seconds:.3f}s)")
+            return artifacts
+        except Exception as e:
+            raise MyException(e, sys)
@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.logger import logging
+from src.exception import MyException
+from src.constants import SCHEMA_FILE_PATH
+from src.entity.config_entity import BatchPredictionConfig, ServingConfig
+from src.entity.artifact_entity import BatchPredictionArtifact
+from src.entity.estimator import MyModel
+from src.utils.main_utils import (read_yaml_file, get_schema_dtypes, iter_dataframe_chunks,
+                                  DataFrameChunkWriter)
+from src.utils.model_bundle import is_model_bundle, unpack_model_file, load_model_file
+from src.utils.profiling import get_peak_rss
+
+# Model of a scoring worker process, loaded once by init_worker
+_worker_model: Optional[MyModel] = None
+
+
+def init_worker(model_file_path: str) -> None:
+    global _worker_model
+    _worker_model = load_model_file(model_file_path)
+
+
+def get_feature_columns(model: MyModel) -> list:
+    """
+    Returns the input columns of the model preprocessing, other columns of a chunk are not scored.
+    """
+    return model.get_input_columns()
+
+
+def predict_chunk(chunk: pd.DataFrame, model: Optional[MyModel] = None):
+    """
+    Scores one chunk with model, or with the model of the worker process when None.
+    """
+    model = model if model is not None else _worker_model
+    return model.predict(chunk[get_feature_columns(model)])
+
+
+class BatchPredictionPipeline:
+    def __init__(self, batch_prediction_config: BatchPredictionConfig = BatchPredictionConfig):
+        """
+        :param batch_prediction_config: Configuration for batch prediction
+        """
+        try:
+            self.batch_prediction_config = batch_prediction_config
+            self._schema_dtypes = get_schema_dtypes(read_yaml_file(file_path = SCHEMA_FILE_PATH))
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def get_model_file_path(self) -> str:
+        """
+        Method Name :   get_model_file_path
+        Description :   This method returns the local model file scored with. A model in S3 is downloaded
+                        once into the batch prediction directory, every worker then loads the local copy.
+                        A model bundle is unpacked once, the workers share its memory mapped arrays
+
+        Output      :   Returns the local model file path
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            config = self.batch_prediction_config
+            if config.model_file_path is None:
+                raise Exception("No model_file_path configured for batch prediction")
+            if config.model_bucket_name is None:
+                return unpack_model_file(config.model_file_path) if is_model_bundle(config.model_file_path) else config.model_file_path
+            from src.cloud_storage.aws_storage import SimpleStorageService
+            local_file_path = os.path.join(config.batch_prediction_dir, os.path.basename(config.model_file_path))
+            os.makedirs(config.batch_prediction_dir, exist_ok=True)
+            SimpleStorageService().download_file(config.model_bucket_name, config.model_file_path, local_file_path)
+            logging.info(f"Model s3://{config.model_bucket_name}/{config.model_file_path} downloaded to {local_file_path}")
+            return unpack_model_file(local_file_path) if is_model_bundle(local_file_path) else local_file_path
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def iter_input_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Method Name :   iter_input_chunks
+        Description :   This method streams the input as typed DataFrame chunks of at most chunk_size rows
+                        from a csv/parquet/arrow file, a MongoDB collection or the objects under an S3 prefix
+
+        Output      :   Returns an iterator of DataFrame chunks
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            config = self.batch_prediction_config
+            if config.input_source == 'file':
+                yield from iter_dataframe_chunks(config.input_path, chunksize = config.chunk_size, dtypes = self._schema_dtypes)
+            elif config.input_source == 'mongodb':
+                from src.data_access.loan_data import LoanData
+                yield from LoanData().export_collection_as_batches(collection_name = config.input_collection_name,
+                                                                   batch_size = config.chunk_size)
+            elif config.input_source == 's3':
+                from src.cloud_storage.aws_storage import SimpleStorageService
+                yield from SimpleStorageService().iter_prefix_dataframe_chunks(bucket_name = config.input_bucket_name,
+                                                                               prefix = config.input_path,
+                                                                               chunksize = config.chunk_size,
+                                                                               dtypes = self._schema_dtypes)
+            else:
+                raise Exception(f"Unknown batch prediction input source {config.input_source}, expected 'file', 'mongodb' or 's3'")
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def get_output_chunk(self, chunk: pd.DataFrame, predictions) -> pd.DataFrame:
+        config = self.batch_prediction_config
+        output = chunk.reset_index(drop = True) if config.include_input_columns else pd.DataFrame(index = range(len(chunk)))
+        output[config.prediction_column] = predictions
+        return output
+
+    def initiate_batch_prediction(self) -> BatchPredictionArtifact:
+        """
+        Method Name :   initiate_batch_prediction
+        Description :   This method scores the input chunk by chunk on a pool of n_workers processes and appends
+                        the predictions to the output file in input order. At most max_pending_chunks_per_worker
+                        chunks per worker are read ahead, so the memory stays flat whatever the input size
+
+        Output      :   Returns batch prediction artifact with the throughput in rows per second
+        On Failure  :   Write an exception log and then raise an exception
+        """
+        try:
+            logging.info("Entered initiate_batch_prediction method of BatchPredictionPipeline class")
+            config = self.batch_prediction_config
+            model_file_path = self.get_model_file_path()
+            n_workers = config.n_workers or os.cpu_count()
+            start = time.perf_counter()
+            n_chunks = 0
+
+            with DataFrameChunkWriter(config.predictions_file_path) as writer:
+                if n_workers == 1:
+                    model = load_model_file(model_file_path)
+                    for chunk in self.iter_input_chunks():
+                        writer.write(self.get_output_chunk(chunk, predict_chunk(chunk, model)))
+                        n_chunks += 1
+                else:
+                    max_pending_chunks = n_workers * config.max_pending_chunks_per_worker
+                    with ProcessPoolExecutor(max_workers = n_workers, initializer = init_worker,
+                                             initargs = (model_file_path,)) as executor:
+                        pending = deque()
+                        for chunk in self.iter_input_chunks():
+                            pending.append((chunk, executor.submit(predict_chunk, chunk)))
+                            # Write the oldest chunk once the read ahead is full, the output keeps the input order
+                            while len(pending) >= max_pending_chunks:
+                                done_chunk, future = pending.popleft()
+                                writer.write(self.get_output_chunk(done_chunk, future.result()))
+                                n_chunks += 1
+                        while pending:
+                            done_chunk, future = pending.popleft()
+                            writer.write(self.get_output_chunk(done_chunk, future.result()))
+                            n_chunks += 1
+                n_rows = writer.n_rows
+
+            wall_seconds = time.perf_counter() - start
+            batch_prediction_artifact = BatchPredictionArtifact(predictions_file_path = config.predictions_file_path,
+                                                                n_rows = n_rows,
+                                                                n_chunks = n_chunks,
+                                                                wall_seconds = wall_seconds,
+                                                                rows_per_second = n_rows / wall_seconds if wall_seconds > 0 else 0.0,
+                                                                peak_rss_bytes = get_peak_rss())
+            logging.info(f"Scored {n_rows} rows in {n_chunks} chunks on {n_workers} workers: "
+                         f"{batch_prediction_artifact.rows_per_second:.0f} rows/s")
+            logging.info(f"Batch prediction artifact: {batch_prediction_artifact}")
+            return batch_prediction_artifact
+        except Exception as e:
+            raise MyException(e, sys)
+
+
+# Root causes of a failed prediction that come from the record rather than from the model
+INPUT_ERROR_TYPES = (KeyError, ValueError, TypeError)
+
+
+class InvalidRecordError(ValueError):
+    """
+    A record the model cannot score, e.g. a missing column or a value it does not handle. Raised to the
+    request of that record only, the other records of its micro-batch are scored.
+    """
+
+
+def get_root_cause(error: BaseException) -> BaseException:
+    """
+    Returns the innermost exception of error, e.g. the one a MyException was raised for.
+    """
+    while (error.__cause__ or error.__context__) is not None:
+        error = error.__cause__ or error.__context__
+    return error
+
+
+class MicroBatchPredictor:
+    """
+    Coalesces concurrent single record predictions of an asyncio server into micro-batches.
+
+    A request waits at most max_wait_ms for other requests to fill its batch of up to max_batch_size
+    records, the batch is then scored with one vectorized MyModel.predict call on a worker thread,
+    so the event loop keeps accepting requests meanwhile. Requests arriving while a batch is scored
+    queue up and form the next batch, the batches grow with the load.
+    """
+    def __init__(self, model, serving_config: ServingConfig):
+        """
+        :param model: MyModel loaded once when the service starts, or a Proj1Estimator whose
+                      current model version scores every batch
+        :param serving_config: Configuration of the micro-batching
+        """
+        try:
+            self.model = model
+            self.serving_config = serving_config
+            self._queue: Optional[asyncio.Queue] = None
+            self._task: Optional[asyncio.Task] = None
+            self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'micro_batch')
+            self._latencies = deque(maxlen = serving_config.metrics_window)
+            self._batch_sizes = deque(maxlen = serving_config.metrics_window)
+            self._n_requests, self._n_batches, self._n_errors = 0, 0, 0
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def start(self) -> None:
+        """
+        Starts the batching task, to be called from the running event loop of the server.
+        """
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logging.info(f"Micro-batching started: max batch size {self.serving_config.max_batch_size}, "
+                     f"max wait {self.serving_config.max_wait_ms}ms")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait = True)
+
+    async def predict(self, record: dict):
+        """
+        Scores a single {column: value} record within the next batch and returns its prediction.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((record, future, time.perf_counter()))
+        return await future
+
+    def predict_batch(self, records: list) -> np.ndarray:
+        # The model is read once per batch, a hot reloaded version applies from the next batch on
+        model = getattr(self.model, 'loaded_model', self.model)
+        feature_columns = get_feature_columns(model)
+        return model.predict([{column: record[column] for column in feature_columns} for record in records])
+
+    def predict_each(self, records: list, batch_error: Exception) -> list:
+        """
+        Scores the records of a failed batch one by one, so that only the records that fail on their own get
+        an error. Returns the prediction of every record, or its exception: an InvalidRecordError when another
+        record of the batch scored or when the root cause is an input error, the model error otherwise.
+        """
+        if len(records) == 1:
+            results = [batch_error]
+        else:
+            results = []
+            for record in records:
+                try:
+                    results.append(self.predict_batch([record])[0])
+                except Exception as e:
+                    results.append(e)
+        any_scored = any(not isinstance(result, Exception) for result in results)
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                root_cause = get_root_cause(result)
+                if any_scored or isinstance(root_cause, INPUT_ERROR_TYPES):
+                    results[i] = InvalidRecordError(f"{type(root_cause).__name__}: {root_cause}")
+        return results
+
+    async def _collect_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.serving_config.max_wait_ms / 1000
+        while len(batch) < self.serving_config.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            records = [item[0] for item in batch]
+            try:
+                predictions = await loop.run_in_executor(self._executor, self.predict_batch, records)
+            except Exception as e:
+                logging.error(f"Micro-batch of {len(batch)} records failed, scoring them one by one: {e}")
+                predictions = await loop.run_in_executor(self._executor, self.predict_each, records, e)
+            end = time.perf_counter()
+            n_errors = sum(isinstance(prediction, Exception) for prediction in predictions)
+            self._n_requests += len(batch) - n_errors
+            self._n_errors += n_errors
+            self._n_batches += 1
+            self._batch_sizes.append(len(batch))
+            for (_, future, start), prediction in zip(batch, predictions):
+                failed = isinstance(prediction, Exception)
+                if not failed:
+                    self._latencies.append(end - start)
+                # the request may have been cancelled, e.g. the client disconnected
+                if future.done():
+                    continue
+                if failed:
+                    future.set_exception(prediction)
+                else:
+                    future.set_result(prediction.item() if isinstance(prediction, np.generic) else prediction)
+
+    def get_metrics(self) -> dict:
+        """
+        Returns the request/batch counters, the p50/p99 request latency in milliseconds (queueing
+        included) and the batch size distribution over the last metrics_window requests and batches.
+        """
+        latencies = np.array(self._latencies) * 1000
+        batch_sizes = np.array(self._batch_sizes)
+        metrics = {'requests': self._n_requests, 'batches': self._n_batches, 'errors': self._n_errors,
+                   'queued': self._queue.qsize() if self._queue is not None else 0,
+                   'max_batch_size': self.serving_config.max_batch_size, 'max_wait_ms': self.serving_config.max_wait_ms}
+        if len(latencies):
+            metrics.update({'latency_p50_ms': float(np.percentile(latencies, 50)),
+                            'latency_p99_ms': float(np.percentile(latencies, 99)),
+                            'latency_max_ms': float(latencies.max())})
+        if len(batch_sizes):
+            metrics.update({'batch_size_mean': float(batch_sizes.mean()),
+                            'batch_size_p50': float(np.percentile(batch_sizes, 50)),
+                            'batch_size_p99': float(np.percentile(batch_sizes, 99)),
+                            'batch_size_max': int(batch_sizes.max())})
+        return metrics
@@ -1,28 +1,112 @@
 import sys
+from typing import Callable, Tuple, List, Optional
+
 from src.logger import logging
 from src.exception import MyException
+from src.constants import SCHEMA_FILE_PATH, MODEL_TRAINER_MODEL_CONFIG_FILE_PATH
+from src.utils.main_utils import wait_for_background_writes, read_yaml_file
+from src.utils.stage_cache import StageCache, get_config_fingerprint, get_code_fingerprint
+from src.utils.profiling import RunProfiler
+from src.pipeline.dag_runner import PipelineStage, DAGRunner
 
 from src.components.data_ingestion import DataIngestion
 from src.components.data_validation import DataValidation
+from src.components.data_drift import DataDrift
 from src.components.data_transformation import DataTransformation
+from src.components.prototype_reduction import PrototypeReduction
 from src.components.model_trainer import ModelTrainer
+from src.components.model_evaluation import ModelEvaluation
+from src.components.model_pusher import ModelPusher
 
-from src.entity.config_entity import (DataIngestionConfig,
+from src.entity.config_entity import (training_pipeline_config,
+                                      DataIngestionConfig,
                                       DataValidationConfig,
+                                      DataDriftConfig,
                                       DataTransformationConfig,
-                                      ModelTrainerConfig)
+                                      PrototypeReductionConfig,
+                                      ModelTrainerConfig,
+                                      ModelEvaluationConfig,
+                                      ModelPusherConfig)
 
 from src.entity.artifact_entity import (DataIngestionArtifact,
                                         DataValidationArtifact,
+                                        DataDriftArtifact,
                                         DataTransformationArtifact,
-                                        ModelTrainerArtifact)
+                                        PrototypeReductionArtifact,
+                                        ModelTrainerArtifact,
+                                        ModelEvaluationArtifact,
+                                        ModelPusherArtifact)
+
+# schema.yaml sections each stage depends on, part of the stage cache keys
+STAGE_SCHEMA_SECTIONS = {
+    'data_ingestion': ['columns'],
+    'data_validation': ['columns', 'numerical_columns', 'categorical_columns', 'max_null_rate', 'max_out_of_range_rate',
+                        'max_out_of_domain_rate', 'numerical_ranges', 'categorical_domains'],
+    'data_drift': ['numerical_columns', 'categorical_columns'],
+    'data_transformation': ['columns', 'numerical_columns', 'transform_features', 'or_columns', 'oh_columns'],
+    'prototype_reduction': [],
+    'model_trainer': [],
+    'model_evaluation': ['columns'],
+    'model_pusher': [],
+}
+
+# Modules whose source is part of the stage cache keys of every stage, and of each stage
+COMMON_CODE_MODULES = ['src.utils.main_utils', 'src.entity.artifact_entity']
+STAGE_CODE_MODULES = {
+    'data_ingestion': ['src.components.data_ingestion', 'src.data_access.loan_data', 'src.configuration.mongo_db_connection'],
+    'data_validation': ['src.components.data_validation'],
+    'data_drift': ['src.components.data_drift'],
+    'data_transformation': ['src.components.data_transformation', 'src.entity.compiled_preprocessor', 'src.entity.neighbor_index'],
+    'prototype_reduction': ['src.components.prototype_reduction', 'src.entity.neighbor_index'],
+    'model_trainer': ['src.components.model_trainer', 'src.entity.estimator', 'src.entity.neighbor_index'],
+    'model_evaluation': ['src.components.model_evaluation', 'src.entity.estimator', 'src.entity.s3_estimator',
+                         'src.utils.model_bundle', 'src.cloud_storage.aws_storage', 'src.utils.model_cache'],
+    'model_pusher': ['src.components.model_pusher', 'src.utils.model_bundle', 'src.cloud_storage.aws_storage'],
+}
 
 class TrainPipeline:
     def __init__(self):
+        self.training_pipeline_config = training_pipeline_config
         self.data_ingestion_config = DataIngestionConfig
         self.data_validation_config = DataValidationConfig
+        self.data_drift_config = DataDriftConfig
         self.data_transformation_config = DataTransformationConfig
+        self.prototype_reduction_config = PrototypeReductionConfig
         self.model_trainer_config = ModelTrainerConfig
+        self.model_evaluation_config = ModelEvaluationConfig
+        self.model_pusher_config = ModelPusherConfig
+        self.stage_cache = StageCache(cache_dir = self.training_pipeline_config.stage_cache_dir,
+                                      max_entries = self.training_pipeline_config.stage_cache_max_entries)
+        self._schema_config = read_yaml_file(file_path = SCHEMA_FILE_PATH)
+        self._model_config = read_yaml_file(file_path = MODEL_TRAINER_MODEL_CONFIG_FILE_PATH) or {}
+        self._stage_keys = {}
+        self._code_fingerprints = {stage_name: get_code_fingerprint(COMMON_CODE_MODULES + module_names)
+                                   for stage_name, module_names in STAGE_CODE_MODULES.items()}
+        self.max_workers = self.training_pipeline_config.max_parallel_stages
+        if self.training_pipeline_config.profiler is not None and self.max_workers > 1:
+            # cProfile allows one active profiler per process (Python 3.12+), profiled stages run one at a time
+            logging.info(f"Profiler {self.training_pipeline_config.profiler} is configured, running the stages serially")
+            self.max_workers = 1
+        self.profiler = RunProfiler(profiler = self.training_pipeline_config.profiler,
+                                    profile_dir = self.training_pipeline_config.profile_dir,
+                                    serial_stages = self.max_workers == 1)
+        self.stage_timings = {}
+    
+    def get_schema_sections(self, stage_name: str) -> dict:
+        return {section: self._schema_config.get(section) for section in STAGE_SCHEMA_SECTIONS[stage_name]}
+    
+    def run_cached_stage(self, stage_name: str, stage_dir: str, run_stage: Callable, **inputs) -> Tuple[str, object]:
+        """
+        This method of TrainPipeline class runs a stage unless an artifact with the same content
+        address (hash of the stage inputs) is in the stage cache, and returns the stage key and artifact
+        """
+        key = StageCache.get_key(stage_name, **inputs)
+        artifact = self.stage_cache.get(key) if self.training_pipeline_config.use_stage_cache else None
+        if artifact is None:
+            artifact = run_stage()
+            if self.training_pipeline_config.use_stage_cache:
+                self.stage_cache.put(key = key, stage_name = stage_name, artifact = artifact, stage_dir = stage_dir)
+        return key, artifact
     
     def start_data_ingestion(self) -> DataIngestionArtifact:
         """
@@ -54,6 +138,20 @@ class TrainPipeline:
         except Exception as e:
             raise MyException(e,sys)
     
+    def start_data_drift(self,data_ingestion_artifact: DataIngestionArtifact) -> DataDriftArtifact:
+        """
+        This method of TrainPipeline class is responsible for starting data drift component
+        """
+        try:
+            logging.info("Entered the start_data_drift method of TrainPipeline class")
+            data_drift = DataDrift(data_ingestion_artifact = data_ingestion_artifact,
+                                   data_drift_config = self.data_drift_config)
+            data_drift_artifact = data_drift.initiate_data_drift()
+            logging.info("Exited the start_data_drift method of TrainPipeline class")
+            return data_drift_artifact
+        except Exception as e:
+            raise MyException(e,sys)
+    
     def start_data_transformation(self,data_ingestion_artifact = DataIngestionArtifact,
                        data_validation_artifact = DataValidationArtifact) -> DataTransformationArtifact:
         """
@@ -69,29 +167,145 @@ class TrainPipeline:
         except Exception as e:
             raise MyException(e,sys)
     
-    def start_model_trainer(self,data_transformation_artifact = DataTransformationArtifact):
+    def start_prototype_reduction(self,data_transformation_artifact = DataTransformationArtifact) -> PrototypeReductionArtifact:
+        """
+        This method of TrainPipeline class is responsible for starting prototype reduction component
+        """
+        try:
+            logging.info("Entered the start_prototype_reduction method of TrainPipeline class")
+            prototype_reduction = PrototypeReduction(data_transformation_artifact = data_transformation_artifact,
+                                                     prototype_reduction_config = self.prototype_reduction_config,
+                                                     model_trainer_config = self.model_trainer_config)
+            prototype_reduction_artifact = prototype_reduction.initiate_prototype_reduction()
+            return prototype_reduction_artifact
+        except Exception as e:
+            raise MyException(e,sys)
+    
+    def start_model_trainer(self,data_transformation_artifact = DataTransformationArtifact,
+                            prototype_reduction_artifact = PrototypeReductionArtifact):
         """
         This method of TrainPipeline class is responsible for starting model trainer component
         """
         try:
             logging.info("Entered the start_model_trainer method of TrainPipeline class")
             model_trainer = ModelTrainer(model_trainer_config = self.model_trainer_config,
-                                         data_transformation_artifact = data_transformation_artifact)
+                                         data_transformation_artifact = data_transformation_artifact,
+                                         prototype_reduction_artifact = prototype_reduction_artifact)
             model_trainer_artifact = model_trainer.initiate_model_trainer()
             return model_trainer_artifact
         except Exception as e:
             raise MyException(e,sys)
     
+    def start_model_evaluation(self,data_ingestion_artifact = DataIngestionArtifact,
+                               model_trainer_artifact = ModelTrainerArtifact) -> ModelEvaluationArtifact:
+        """
+        This method of TrainPipeline class is responsible for starting model evaluation component
+        """
+        try:
+            logging.info("Entered the start_model_evaluation method of TrainPipeline class")
+            model_evaluation = ModelEvaluation(model_eval_config = self.model_evaluation_config,
+                                               data_ingestion_artifact = data_ingestion_artifact,
+                                               model_trainer_artifact = model_trainer_artifact)
+            model_evaluation_artifact = model_evaluation.initiate_model_evaluation()
+            return model_evaluation_artifact
+        except Exception as e:
+            raise MyException(e,sys)
+    
+    def start_model_pusher(self,model_trainer_artifact = ModelTrainerArtifact,
+                           model_evaluation_artifact = ModelEvaluationArtifact) -> ModelPusherArtifact:
+        """
+        This method of TrainPipeline class is responsible for starting model pusher component
+        """
+        try:
+            logging.info("Entered the start_model_pusher method of TrainPipeline class")
+            model_pusher = ModelPusher(model_evaluation_artifact = model_evaluation_artifact,
+                                       model_pusher_config = self.model_pusher_config,
+                                       model_trainer_artifact = model_trainer_artifact)
+            model_pusher_artifact = model_pusher.initiate_model_pusher()
+            return model_pusher_artifact
+        except Exception as e:
+            raise MyException(e,sys)
+    
+        
+    def get_cached_stage(self, stage_name: str, start_stage: Callable, config: object, stage_dir: str,
+                         inputs: Optional[List[str]] = None, extra_inputs: Optional[Callable[[], dict]] = None) -> PipelineStage:
+        """
+        This method of TrainPipeline class wraps a start_* method into a DAG stage going through the stage cache.
+        The stage key is made of the keys of its input stages, its schema sections, its config, the source of
+        its modules and extra_inputs
+        """
+        inputs = inputs or []
+        
+        def run(**artifacts):
+            with self.profiler.profile_stage(stage_name) as record:
+                cache_inputs = {'upstream': {name: self._stage_keys[name] for name in inputs},
+                                'schema': self.get_schema_sections(stage_name),
+                                'config': get_config_fingerprint(config),
+                                'code': self._code_fingerprints[stage_name]}
+                if extra_inputs is not None:
+                    cache_inputs.update(extra_inputs())
+                record['cache_hit'] = True
+                
+                def run_stage():
+                    record['cache_hit'] = False
+                    return start_stage(**artifacts)
+                
+                key, artifact = self.run_cached_stage(stage_name, stage_dir, run_stage, **cache_inputs)
+            self.profiler.record_artifact(stage_name, artifact)
+            self._stage_keys[stage_name] = key
+            return artifact
         
-    def run_pipeline(self, ) -> None:
+        return PipelineStage(name = stage_name, run = run, inputs = inputs)
+    
+    def get_pipeline_stages(self) -> List[PipelineStage]:
+        """
+        This method of TrainPipeline class declares the pipeline DAG: every stage consumes the
+        artifacts of the stages listed in its inputs, stages without a path between them run concurrently
+        """
+        return [
+            self.get_cached_stage('data_ingestion', self.start_data_ingestion, self.data_ingestion_config,
+                                  self.data_ingestion_config.data_ingestion_dir,
+                                  extra_inputs = lambda: {'data': DataIngestion(data_ingestion_config=self.data_ingestion_config).get_data_fingerprint()}),
+            self.get_cached_stage('data_validation', self.start_data_validation, self.data_validation_config,
+                                  self.data_validation_config.data_validation_dir,
+                                  inputs = ['data_ingestion']),
+            self.get_cached_stage('data_drift', self.start_data_drift, self.data_drift_config,
+                                  self.data_drift_config.data_drift_dir,
+                                  inputs = ['data_ingestion']),
+            self.get_cached_stage('data_transformation', self.start_data_transformation, self.data_transformation_config,
+                                  self.data_transformation_config.data_transformation_dir,
+                                  inputs = ['data_ingestion', 'data_validation']),
+            self.get_cached_stage('prototype_reduction', self.start_prototype_reduction, self.prototype_reduction_config,
+                                  self.prototype_reduction_config.prototype_reduction_dir,
+                                  inputs = ['data_transformation'],
+                                  extra_inputs = lambda: {'model_trainer': get_config_fingerprint(self.model_trainer_config)}),
+            self.get_cached_stage('model_trainer', self.start_model_trainer, self.model_trainer_config,
+                                  self.model_trainer_config.model_trainer_dir,
+                                  inputs = ['data_transformation', 'prototype_reduction'],
+                                  extra_inputs = lambda: {'model': self._model_config}),
+            self.get_cached_stage('model_evaluation', self.start_model_evaluation, self.model_evaluation_config,
+                                  self.model_evaluation_config.model_evaluation_dir,
+                                  inputs = ['data_ingestion', 'model_trainer'],
+                                  extra_inputs = lambda: {'production_model': ModelEvaluation.get_production_model_version(self.model_evaluation_config)}),
+            self.get_cached_stage('model_pusher', self.start_model_pusher, self.model_pusher_config,
+                                  self.model_pusher_config.model_pusher_dir,
+                                  inputs = ['model_trainer', 'model_evaluation']),
+        ]
+    
+    def run_pipeline(self, ) -> dict:
         """
         This method of TrainPipeline class is responsible for running complete pipeline
         """
         try:
-            data_ingestion_artifact = self.start_data_ingestion()
-            data_validation_artifact = self.start_data_validation(data_ingestion_artifact=data_ingestion_artifact)
-            data_transformation_artifact = self.start_data_transformation(data_ingestion_artifact = data_ingestion_artifact,
-                                                                        data_validation_artifact = data_validation_artifact)
-            model_trainer_artifact = self.start_model_trainer(data_transformation_artifact = data_transformation_artifact)
+            dag_runner = DAGRunner(stages = self.get_pipeline_stages(), max_workers = self.max_workers)
+            artifacts = dag_runner.run()
+            self.stage_timings = dag_runner.stage_timings
+            
+            # Artifacts are written in the background while later stages run on the in-memory objects
+            wait_for_background_writes()
+            logging.info("All pipeline artifacts are written to disk")
+            self.stage_cache.commit()
+            self.profiler.write(file_path = self.training_pipeline_config.run_profile_file_path)
+            return artifacts
         except Exception as e:
-            raise MyException(e,sys)
\ No newline at end of file
+            raise MyException(e,sys)
@@ -1,12 +1,53 @@
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Optional, Callable, Iterator, Tuple
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import dill
 import yaml
 
 from src.logger import logging
 from src.exception import MyException
+from src.utils.profiling import bind_to_current_stage
+
+SCHEMA_DTYPE_MAPPING = {'float': 'float64', 'int': 'int64', 'category': 'category'}
+DATAFRAME_FILE_FORMATS = ('parquet', 'arrow', 'csv')
+# Files of a feature/label data set directory written by save_feature_label_data
+FEATURES_FILE_NAME = 'features.npy'
+LABELS_FILE_NAME = 'labels.npy'
+QUANTIZATION_FILE_NAME = 'quantization.npz'
+
+# Background writer used to persist artifacts while the next pipeline stage works on the in-memory objects
+_background_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='artifact-writer')
+_pending_writes: List[Future] = []
+_pending_writes_lock = threading.Lock()
+
+def save_in_background(func:Callable, **kwargs) -> Future:
+    """
+    Submit an artifact write to the background writer.
+    func: save function to call, e.g. save_dataframe or save_object
+    kwargs: keyword arguments of func
+    return: Future of the write
+    """
+    future = _background_writer.submit(bind_to_current_stage(func, f"background_{func.__name__}"), **kwargs)
+    with _pending_writes_lock:
+        _pending_writes.append(future)
+    return future
+
+def wait_for_background_writes() -> None:
+    """
+    Block until every artifact write submitted with save_in_background is on disk.
+    Re-raises the first write failure.
+    """
+    with _pending_writes_lock:
+        futures = list(_pending_writes)
+        _pending_writes.clear()
+    for future in futures:
+        future.result()
 
 def read_yaml_file(file_path:str) -> dict:
     try:
@@ -26,6 +67,202 @@ def write_yaml_file(file_path:str, content:object, replace:bool = False) -> None
     except Exception as e:
         raise MyException(e,sys)
     
+def get_schema_dtypes(schema_config:dict) -> dict:
+    """
+    Returns a {column: pandas dtype} mapping built from the 'columns' section of schema.yaml
+    schema_config: dict content of schema.yaml
+    return: dict of column name to dtype
+    """
+    try:
+        dtypes = {}
+        for column in schema_config['columns']:
+            for column_name, dtype in column.items():
+                dtypes[column_name] = SCHEMA_DTYPE_MAPPING.get(dtype, dtype)
+        return dtypes
+    except Exception as e:
+        raise MyException(e,sys)
+    
+def apply_schema_dtypes(dataframe:pd.DataFrame, dtypes:dict) -> pd.DataFrame:
+    """
+    Casts the columns of dataframe to the dtypes declared in schema.yaml.
+    Integer columns holding missing values are kept as float64.
+    dataframe: pd.DataFrame to cast in place
+    dtypes: dict returned by get_schema_dtypes
+    return: pd.DataFrame with typed columns
+    """
+    try:
+        for column_name, dtype in dtypes.items():
+            if column_name not in dataframe.columns:
+                continue
+            if dtype == 'category':
+                dataframe[column_name] = dataframe[column_name].astype('category')
+                continue
+            series = pd.to_numeric(dataframe[column_name], errors='coerce')
+            if dtype == 'int64' and series.isna().any():
+                dtype = 'float64'
+            dataframe[column_name] = series.astype(dtype)
+        return dataframe
+    except Exception as e:
+        raise MyException(e,sys)
+    
+def concat_typed_chunks(chunks:List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenates typed dataframe chunks once, aligning categorical columns on the union
+    of their categories so they stay categorical instead of falling back to object.
+    chunks: list of pd.DataFrame with identical columns
+    return: pd.DataFrame
+    """
+    try:
+        if len(chunks) == 0:
+            return pd.DataFrame()
+        if len(chunks) == 1:
+            return chunks[0]
+        for column_name in chunks[0].columns:
+            if not isinstance(chunks[0][column_name].dtype, pd.CategoricalDtype):
+                continue
+            categories = chunks[0][column_name].cat.categories
+            for chunk in chunks[1:]:
+                categories = categories.union(chunk[column_name].cat.categories)
+            for chunk in chunks:
+                chunk[column_name] = chunk[column_name].cat.set_categories(categories)
+        return pd.concat(chunks, ignore_index=True)
+    except Exception as e:
+        raise MyException(e,sys)
+    
+def get_file_format(file_path:str) -> str:
+    """
+    Returns the dataframe artifact format ('parquet', 'arrow' or 'csv') from the file extension
+    """
+    extension = os.path.splitext(file_path)[1].lstrip('.').lower()
+    if extension not in DATAFRAME_FILE_FORMATS:
+        raise ValueError(f"Unsupported dataframe file format: [{extension}] for file: [{file_path}]")
+    return extension
+
+def save_dataframe(file_path:str, dataframe:pd.DataFrame) -> None:
+    """
+    Save dataframe to file in the format given by its extension.
+    Parquet and Arrow IPC files keep the dtypes, including categoricals.
+    file_path: str location of file to save
+    dataframe: pd.DataFrame data to save
+    """
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file_format = get_file_format(file_path)
+        if file_format == 'parquet':
+            dataframe.to_parquet(file_path, index=False)
+        elif file_format == 'arrow':
+            dataframe.reset_index(drop=True).to_feather(file_path)
+        else:
+            dataframe.to_csv(file_path, header=True, index=False)
+    except Exception as e:
+        raise MyException(e,sys)
+    
+def read_dataframe(file_path:str, columns:Optional[List[str]] = None, dtypes:Optional[dict] = None) -> pd.DataFrame:
+    """
+    Read dataframe from file in the format given by its extension.
+    file_path: str location of file to read
+    columns: list of columns to read, all columns are read when None
+    dtypes: dict returned by get_schema_dtypes, applied to formats that do not store dtypes (csv)
+    return: pd.DataFrame data read
+    """
+    try:
+        file_format = get_file_format(file_path)
+        if file_format == 'parquet':
+            return pd.read_parquet(file_path, columns=columns)
+        if file_format == 'arrow':
+            return pd.read_feather(file_path, columns=columns)
+        dataframe = pd.read_csv(file_path, usecols=columns)
+        return apply_schema_dtypes(dataframe, dtypes) if dtypes else dataframe
+    except Exception as e:
+        raise MyException(e,sys)
+    
+def iter_dataframe_chunks(file_path:str, chunksize:int, columns:Optional[List[str]] = None,
+                          dtypes:Optional[dict] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read dataframe from file in chunks of at most chunksize rows, so files larger than memory can be scanned.
+    file_path: str location of file to read
+    chunksize: int number of rows per chunk
+    columns: list of columns to read, all columns are read when None
+    dtypes: dict returned by get_schema_dtypes, applied to formats that do not store dtypes (csv)
+    return: iterator of pd.DataFrame chunks
+    """
+    try:
+        file_format = get_file_format(file_path)
+        if file_format == 'parquet':
+            for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas()
+        elif file_format == 'arrow':
+            with pa.memory_map(file_path) as source:
+                reader = pa.ipc.open_file(source)
+                for index in range(reader.num_record_batches):
+                    table = pa.Table.from_batches([reader.get_batch(index)])
+                    table = table.select(columns) if columns is not None else table
+                    for offset in range(0, table.num_rows, chunksize):
+                        yield table.slice(offset, chunksize).to_pandas()
+        else:
+            for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunksize):
+                yield apply_schema_dtypes(chunk, dtypes) if dtypes else chunk
+    except Exception as e:
+        raise MyException(e,sys)
+    
+class DataFrameChunkWriter:
+    """
+    Appends DataFrame chunks to one file in the format given by its extension, so results larger
+    than memory can be written incrementally. Parquet chunks become row groups, Arrow IPC chunks
+    record batches and CSV chunks are appended after a single header. Use as a context manager.
+    """
+    def __init__(self, file_path:str):
+        self.file_path = file_path
+        self.file_format = get_file_format(file_path)
+        self.n_rows = 0
+        self._writer = None
+        self._schema = None
+
+    def __enter__(self) -> 'DataFrameChunkWriter':
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        if self.file_format == 'csv' and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+        return self
+
+    def write(self, chunk:pd.DataFrame) -> None:
+        try:
+            if self.file_format == 'csv':
+                chunk.to_csv(self.file_path, mode='a', header=self.n_rows == 0, index=False)
+            else:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if self._writer is None:
+                    self._schema = table.schema
+                    self._writer = pq.ParquetWriter(self.file_path, self._schema) if self.file_format == 'parquet' \
+                        else pa.ipc.new_file(self.file_path, self._schema)
+                else:
+                    # e.g. a column that is all null in one chunk
+                    table = table.cast(self._schema)
+                self._writer.write_table(table)
+            self.n_rows += len(chunk)
+        except Exception as e:
+            raise MyException(e,sys)
+
+    def __exit__(self, *exc_info) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+def read_dataframe_schema(file_path:str) -> pd.DataFrame:
+    """
+    Read only the columns and dtypes of a dataframe file, without its rows.
+    file_path: str location of file to read
+    return: empty pd.DataFrame with the columns of the file
+    """
+    try:
+        file_format = get_file_format(file_path)
+        if file_format == 'parquet':
+            return pq.read_schema(file_path).empty_table().to_pandas()
+        if file_format == 'arrow':
+            with pa.memory_map(file_path) as source:
+                return pa.ipc.open_file(source).schema.empty_table().to_pandas()
+        return pd.read_csv(file_path, nrows=0)
+    except Exception as e:
+        raise MyException(e,sys)
+    
 def load_object(file_path:str) -> object:
     """
     Returns model/object from project directory.
@@ -51,15 +288,111 @@ def save_numpy_array_data(file_path:str, array: np.array) -> None:
     except Exception as e:
         raise MyException(e,sys)
     
-def load_numpy_array_data(file_path:str) -> np.array:
+def load_numpy_array_data(file_path:str, mmap_mode:Optional[str] = None) -> np.array:
     """
     load numpy array data from file
     file_path: str location of file to load
+    mmap_mode: None to read the array into memory, 'r' to map the .npy file read-only without copying it
     return: np.array data loaded
     """
     try:
-        with open(file_path,'rb') as file:
-            return np.load(file)
+        return np.load(file_path, mmap_mode=mmap_mode)
+    except Exception as e:
+        raise MyException(e,sys)
+
+def fit_quantization(features: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit the int8 grid of quantize_features on a feature matrix, usually the train set.
+    features: 2-D float array
+    return: per feature offset and per feature scale
+    """
+    offset = features.min(axis=0).astype(np.float32)
+    scale = ((features.max(axis=0) - offset) / 255).astype(np.float32)
+    scale[scale == 0] = 1
+    return offset, scale
+
+def quantize_features(features: np.ndarray, offset: Optional[np.ndarray] = None,
+                      scale: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Quantize a feature matrix to int8 with one affine mapping per feature (column).
+    features: 2-D float array
+    offset, scale: grid fitted with fit_quantization, fitted on features when not given.
+                   Values outside of the grid are clipped to its ends
+    return: int8 codes, per feature offset and per feature scale, features ~ (codes + 128) * scale + offset
+    """
+    if offset is None or scale is None:
+        offset, scale = fit_quantization(features)
+    codes = np.clip(np.round((features - offset) / scale) - 128, -128, 127).astype(np.int8)
+    return codes, offset, scale
+
+def dequantize_features(codes: np.ndarray, offset: np.ndarray, scale: np.ndarray, dtype:str = 'float32') -> np.ndarray:
+    """
+    Inverse of quantize_features, returns the feature matrix as dtype.
+    """
+    features = codes.astype(dtype)
+    features += 128
+    features *= scale
+    features += offset
+    return features
+
+def save_feature_label_data(dir_path:str, features: np.ndarray, labels: np.ndarray, storage_dtype:str = 'float32',
+                            quantization: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> None:
+    """
+    Save a feature matrix and its label array as separate contiguous .npy files in dir_path, so that
+    both can be memory mapped by load_feature_label_data
+    dir_path: str directory of the data set, receives FEATURES_FILE_NAME and LABELS_FILE_NAME
+    features: 2-D feature matrix
+    labels: 1-D label array, stored with its own (small int) dtype
+    storage_dtype: 'float32', 'float64' or 'int8' (per feature affine quantization, see quantize_features,
+                   the offset and scale are saved in QUANTIZATION_FILE_NAME)
+    quantization: (offset, scale) grid of the int8 storage, fitted on features when None. Train and test
+                  sets share the grid fitted on the train set
+    """
+    try:
+        os.makedirs(dir_path, exist_ok=True)
+        if storage_dtype == 'int8':
+            features, offset, scale = quantize_features(features, *(quantization or (None, None)))
+            np.savez(os.path.join(dir_path, QUANTIZATION_FILE_NAME), feature_offset=offset, feature_scale=scale)
+        else:
+            features = features.astype(storage_dtype, copy=False)
+        np.save(os.path.join(dir_path, FEATURES_FILE_NAME), np.ascontiguousarray(features))
+        np.save(os.path.join(dir_path, LABELS_FILE_NAME), np.ascontiguousarray(labels))
+    except Exception as e:
+        raise MyException(e,sys)
+
+def load_quantization(dir_path:str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Returns the (offset, scale) int8 grid of a data set saved with save_feature_label_data, None when
+    its features are not quantized
+    """
+    try:
+        quantization_file_path = os.path.join(dir_path, QUANTIZATION_FILE_NAME)
+        if not os.path.exists(quantization_file_path):
+            return None
+        with np.load(quantization_file_path) as quantization:
+            return quantization['feature_offset'], quantization['feature_scale']
+    except Exception as e:
+        raise MyException(e,sys)
+
+def load_feature_label_data(dir_path:str, feature_dtype:str = 'float32', mmap_mode:Optional[str] = 'r') -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load a feature matrix and its label array saved with save_feature_label_data
+    dir_path: str directory of the data set
+    feature_dtype: dtype of the returned feature matrix
+    mmap_mode: 'r' maps the files read-only, features stored in feature_dtype are then returned without
+               any copy. Quantized or other dtype features are converted and so read into memory
+    return: features, labels
+    """
+    try:
+        features = np.load(os.path.join(dir_path, FEATURES_FILE_NAME), mmap_mode=mmap_mode)
+        labels = np.load(os.path.join(dir_path, LABELS_FILE_NAME), mmap_mode=mmap_mode)
+        quantization = load_quantization(dir_path)
+        if quantization is not None:
+            features = dequantize_features(np.asarray(features), *quantization, dtype = feature_dtype)
+        elif features.dtype != feature_dtype:
+            logging.info(f"Converting {features.dtype} features of {dir_path} to {feature_dtype} in memory")
+            features = np.asarray(features).astype(feature_dtype)
+        return features, labels
     except Exception as e:
         raise MyException(e,sys)
     
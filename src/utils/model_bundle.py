@@ -0,0 +1,375 @@
+import os
+import sys
+import json
+import zlib
+import pickle
+import shutil
+import hashlib
+import tarfile
+from datetime import datetime, timezone
+from typing import Optional
+
+import numpy as np
+
+from src.logger import logging
+from src.exception import MyException
+from src.utils.main_utils import load_object
+
+BUNDLE_FORMAT = 'model_bundle'
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_EXTENSION = '.bundle'
+MANIFEST_FILE_NAME = 'manifest.json'
+PICKLE_FILE_NAME = 'model.pkl'
+PREPROCESSOR_FILE_NAME = 'preprocessor.json'
+# Suffix of the compressed .npy blocks by codec, None stores plain .npy files
+CODEC_SUFFIXES = {'zstd': '.zst', 'lz4': '.lz4', 'zlib': '.zz', None: ''}
+COPY_CHUNK_SIZE = 2**20
+
+
+class _LZ4Compressor:
+    """
+    lz4 frame compressor with the compress/flush interface of the zstd and zlib compressors.
+    """
+    def __init__(self, level: int):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data) -> bytes:
+        header, self._header = self._header, b''
+        return header + self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._header + self._compressor.flush()
+
+
+def get_compressor(codec: str, level: int):
+    """
+    Returns a streaming compressor of codec, zstandard and lz4 are imported when used.
+    """
+    if codec == 'zstd':
+        import zstandard
+        # threads=-1 compresses on every CPU
+        return zstandard.ZstdCompressor(level=level, threads=-1).compressobj()
+    if codec == 'lz4':
+        return _LZ4Compressor(level)
+    if codec == 'zlib':
+        return zlib.compressobj(level)
+    raise Exception(f"Unknown bundle compression {codec}, expected 'zstd', 'lz4', 'zlib' or None")
+
+
+def get_decompressor(codec: str):
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameDecompressor()
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    raise Exception(f"Unknown bundle compression {codec}, expected 'zstd', 'lz4', 'zlib' or None")
+
+
+class _BlockWriter:
+    """
+    File-like target of np.lib.format.write_array: hashes the .npy bytes, compresses them and
+    writes the compressed block, hashing it as well. numpy writes the array in bounded chunks.
+    """
+    def __init__(self, file, codec: Optional[str], level: int):
+        self.file = file
+        self.compressor = get_compressor(codec, level) if codec is not None else None
+        self.npy_hash = hashlib.sha256()
+        self.npy_bytes = 0
+        self.block_hash = hashlib.sha256()
+        self.block_bytes = 0
+
+    def _write_block(self, data) -> None:
+        if data:
+            self.file.write(data)
+            self.block_hash.update(data)
+            self.block_bytes += len(data)
+
+    def write(self, data) -> int:
+        n_bytes = memoryview(data).nbytes
+        self.npy_hash.update(data)
+        self.npy_bytes += n_bytes
+        self._write_block(self.compressor.compress(data) if self.compressor is not None else bytes(data))
+        return n_bytes
+
+    def close(self) -> None:
+        if self.compressor is not None:
+            self._write_block(self.compressor.flush())
+
+
+class _BundlePickler(pickle.Pickler):
+    """
+    Pickles a model with its large NumPy arrays replaced by references to .npy blocks written aside.
+    """
+    def __init__(self, file, bundle_dir: str, codec: Optional[str], level: int, min_array_bytes: int):
+        super().__init__(file, protocol=5)
+        self.bundle_dir = bundle_dir
+        self.codec = codec
+        self.level = level
+        self.min_array_bytes = min_array_bytes
+        self.arrays = []
+        # id of a written array -> its index, the arrays are kept referenced so that ids are not reused
+        self._array_ids = {}
+        self._written = []
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or obj.nbytes < self.min_array_bytes:
+            return None
+        if id(obj) not in self._array_ids:
+            self._array_ids[id(obj)] = self.write_array(obj)
+            self._written.append(obj)
+        return self._array_ids[id(obj)]
+
+    def write_array(self, array: np.ndarray) -> int:
+        index = len(self.arrays)
+        npy_file = f"array_{index}.npy"
+        block_file = npy_file + CODEC_SUFFIXES[self.codec]
+        with open(os.path.join(self.bundle_dir, block_file), 'wb') as file:
+            writer = _BlockWriter(file, self.codec, self.level)
+            np.lib.format.write_array(writer, np.asarray(array), allow_pickle=False)
+            writer.close()
+        self.arrays.append({'file': block_file, 'npy_file': npy_file, 'dtype': array.dtype.str,
+                            'shape': list(array.shape), 'npy_bytes': writer.npy_bytes,
+                            'npy_sha256': writer.npy_hash.hexdigest(),
+                            'sha256': writer.block_hash.hexdigest(), 'bytes': writer.block_bytes})
+        return index
+
+
+def get_file_sha256(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def to_json(obj: object) -> object:
+    """
+    Converts the NumPy values and non string keys of the fitted preprocessor parameters for json.
+    """
+    if isinstance(obj, dict):
+        return {str(to_json(key)): to_json(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(value) for value in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def get_preprocessor_parameters(model: object) -> Optional[dict]:
+    """
+    Returns the fitted parameters of the compiled preprocessor of a MyModel (lookup tables, Yeo-Johnson
+    lambdas, means and scales), None when the model has none.
+    """
+    compiled_preprocessor = getattr(model, 'compiled_preprocessor', None)
+    if compiled_preprocessor is None:
+        return None
+    return to_json(vars(compiled_preprocessor))
+
+
+def save_model_bundle(model: object, bundle_dir: str, codec: Optional[str] = 'zstd', level: int = 3,
+                      min_array_bytes: int = 2**16, metadata: Optional[dict] = None) -> dict:
+    """
+    Writes model as a bundle directory: the NumPy arrays of at least min_array_bytes (e.g. the KNN
+    reference matrix) as one compressed .npy block each, the rest of the model as a small pickle
+    referencing them, the fitted preprocessor parameters as json, and a manifest with the sha256
+    and size of every file. The manifest is written last, a bundle without one is incomplete.
+    model: object to save, usually a MyModel
+    bundle_dir: str directory of the bundle, replaced when it exists
+    codec: 'zstd', 'lz4', 'zlib' or None (plain .npy files)
+    level: compression level of codec
+    min_array_bytes: smallest array stored as a .npy block
+    metadata: json serializable dict stored in the manifest, e.g. the evaluation metrics
+    return: the manifest
+    """
+    try:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+        os.makedirs(bundle_dir)
+        with open(os.path.join(bundle_dir, PICKLE_FILE_NAME), 'wb') as pickle_file:
+            pickler = _BundlePickler(pickle_file, bundle_dir, codec, level, min_array_bytes)
+            pickler.dump(model)
+        files = {PICKLE_FILE_NAME: None}
+        preprocessor_parameters = get_preprocessor_parameters(model)
+        if preprocessor_parameters is not None:
+            with open(os.path.join(bundle_dir, PREPROCESSOR_FILE_NAME), 'w') as preprocessor_file:
+                json.dump(preprocessor_parameters, preprocessor_file)
+            files[PREPROCESSOR_FILE_NAME] = None
+        for file_name in files:
+            file_path = os.path.join(bundle_dir, file_name)
+            files[file_name] = {'sha256': get_file_sha256(file_path), 'bytes': os.path.getsize(file_path)}
+        for array in pickler.arrays:
+            files[array['file']] = {'sha256': array.pop('sha256'), 'bytes': array.pop('bytes')}
+
+        # The version is derived from the content, the same model gives the same version
+        version_hash = hashlib.sha256(files[PICKLE_FILE_NAME]['sha256'].encode())
+        for array in pickler.arrays:
+            version_hash.update(array['npy_sha256'].encode())
+        manifest = {'format': BUNDLE_FORMAT, 'format_version': BUNDLE_FORMAT_VERSION,
+                    'version': version_hash.hexdigest()[:16],
+                    'created_at': datetime.now(timezone.utc).isoformat(),
+                    'model_class': type(model).__name__,
+                    'codec': codec, 'compression_level': level if codec is not None else None,
+                    'preprocessor_file': PREPROCESSOR_FILE_NAME if preprocessor_parameters is not None else None,
+                    'metadata': metadata or {}, 'files': files, 'arrays': pickler.arrays}
+        with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        stored_bytes = sum(file['bytes'] for file in files.values())
+        npy_bytes = sum(array['npy_bytes'] for array in pickler.arrays)
+        logging.info(f"Model bundle {manifest['version']} saved to {bundle_dir}: {len(pickler.arrays)} arrays, "
+                     f"{npy_bytes} bytes compressed with {codec} to {stored_bytes - files[PICKLE_FILE_NAME]['bytes']}")
+        return manifest
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+def pack_model_bundle(bundle_dir: str, file_path: str) -> None:
+    """
+    Packs a bundle directory into one uncompressed tar file, the blocks are compressed already.
+    The manifest is the first member, so that it can be read without reading the whole file.
+    """
+    try:
+        with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with tarfile.open(file_path, 'w') as bundle_file:
+            for file_name in [MANIFEST_FILE_NAME, *manifest['files']]:
+                bundle_file.add(os.path.join(bundle_dir, file_name), arcname=file_name)
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+def is_model_bundle(file_path: str) -> bool:
+    return file_path.endswith(BUNDLE_EXTENSION)
+
+
+def read_bundle_manifest(file_path: str) -> dict:
+    """
+    Returns the manifest of a packed bundle file.
+    """
+    with tarfile.open(file_path, 'r') as bundle_file:
+        return json.load(bundle_file.extractfile(MANIFEST_FILE_NAME))
+
+
+def decompress_block(bundle_dir: str, array: dict, codec: Optional[str]) -> None:
+    """
+    Decompresses an array block into its .npy file and checks the sha256 of the .npy bytes.
+    The file is written under a temporary name and renamed, a present .npy file is complete.
+    """
+    npy_file_path = os.path.join(bundle_dir, array['npy_file'])
+    if codec is None or os.path.isfile(npy_file_path):
+        return
+    npy_hash = hashlib.sha256()
+    decompressor = get_decompressor(codec)
+    with open(os.path.join(bundle_dir, array['file']), 'rb') as block_file, open(npy_file_path + '.tmp', 'wb') as npy_file:
+        for chunk in iter(lambda: block_file.read(COPY_CHUNK_SIZE), b''):
+            data = decompressor.decompress(chunk)
+            npy_hash.update(data)
+            npy_file.write(data)
+        data = decompressor.flush() if hasattr(decompressor, 'flush') else b''
+        npy_hash.update(data)
+        npy_file.write(data)
+    if npy_hash.hexdigest() != array['npy_sha256']:
+        os.remove(npy_file_path + '.tmp')
+        raise Exception(f"Checksum mismatch of {array['npy_file']} decompressed from {array['file']}")
+    os.replace(npy_file_path + '.tmp', npy_file_path)
+
+
+def unpack_model_bundle(file_path: str, bundle_dir: str) -> dict:
+    """
+    Extracts a packed bundle file into bundle_dir, checking the sha256 of every file against the
+    manifest, and decompresses the array blocks into .npy files that load_model_bundle memory maps.
+    The compressed blocks are removed once decompressed. The manifest is written last.
+    return: the manifest
+    """
+    try:
+        os.makedirs(bundle_dir, exist_ok=True)
+        with tarfile.open(file_path, 'r') as bundle_file:
+            manifest = json.load(bundle_file.extractfile(MANIFEST_FILE_NAME))
+            if manifest.get('format') != BUNDLE_FORMAT or manifest.get('format_version', 0) > BUNDLE_FORMAT_VERSION:
+                raise Exception(f"{file_path} is not a model bundle of format version {BUNDLE_FORMAT_VERSION} or older")
+            for file_name, expected in manifest['files'].items():
+                # Names are taken from the manifest, members can not write outside bundle_dir
+                file_hash = hashlib.sha256()
+                source = bundle_file.extractfile(os.path.basename(file_name))
+                with open(os.path.join(bundle_dir, os.path.basename(file_name)), 'wb') as target:
+                    for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+                        file_hash.update(chunk)
+                        target.write(chunk)
+                if file_hash.hexdigest() != expected['sha256']:
+                    raise Exception(f"Checksum mismatch of {file_name} in model bundle {file_path}")
+        for array in manifest['arrays']:
+            decompress_block(bundle_dir, array, manifest['codec'])
+            if manifest['codec'] is not None:
+                os.remove(os.path.join(bundle_dir, array['file']))
+        with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        logging.info(f"Model bundle {manifest['version']} unpacked to {bundle_dir}")
+        return manifest
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+class _BundleUnpickler(pickle.Unpickler):
+    def __init__(self, file, arrays: list):
+        super().__init__(file)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        return self.arrays[pid]
+
+
+def load_model_bundle(bundle_dir: str, mmap: bool = True) -> object:
+    """
+    Loads the model of a bundle directory, saved or unpacked. Array blocks not decompressed yet are
+    decompressed first.
+    mmap: the arrays are read-only memory maps of the .npy files, paged in on use and shared between
+    the processes loading the same bundle; read into memory when False
+    """
+    try:
+        with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        arrays = []
+        for array in manifest['arrays']:
+            decompress_block(bundle_dir, array, manifest['codec'])
+            arrays.append(np.load(os.path.join(bundle_dir, array['npy_file']), mmap_mode='r' if mmap else None,
+                                  allow_pickle=False))
+        with open(os.path.join(bundle_dir, PICKLE_FILE_NAME), 'rb') as pickle_file:
+            return _BundleUnpickler(pickle_file, arrays).load()
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+def unpack_model_file(file_path: str) -> str:
+    """
+    Unpacks a packed bundle file next to it, into <file_path>.unpacked, unless the same version is
+    unpacked there already, and returns the bundle directory.
+    """
+    try:
+        bundle_dir = file_path + '.unpacked'
+        manifest_file_path = os.path.join(bundle_dir, MANIFEST_FILE_NAME)
+        if os.path.isfile(manifest_file_path):
+            with open(manifest_file_path, 'r') as manifest_file:
+                if json.load(manifest_file)['version'] == read_bundle_manifest(file_path)['version']:
+                    return bundle_dir
+            shutil.rmtree(bundle_dir)
+        unpack_model_bundle(file_path, bundle_dir)
+        return bundle_dir
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+def load_model_file(file_path: str) -> object:
+    """
+    Loads a model from a pickle file, a packed bundle file (unpacked next to it) or a bundle directory.
+    """
+    if os.path.isdir(file_path):
+        return load_model_bundle(file_path)
+    if is_model_bundle(file_path):
+        return load_model_bundle(unpack_model_file(file_path))
+    return load_object(file_path = file_path)
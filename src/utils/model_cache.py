@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import mmap
+import uuid
+import pickle
+import shutil
+import hashlib
+from typing import Callable, Optional
+
+from src.logger import logging
+from src.exception import MyException
+from src.utils.model_bundle import BUNDLE_FORMAT, is_model_bundle, unpack_model_bundle, load_model_bundle
+
+MANIFEST_FILE_NAME = 'manifest.json'
+PICKLE_FILE_NAME = 'model.pkl'
+BUFFERS_FILE_NAME = 'buffers.bin'
+# Offsets of the out-of-band buffers are aligned for the arrays memory mapped over them
+BUFFER_ALIGNMENT = 64
+
+
+class ModelDiskCache:
+    """
+    Content addressed local disk cache of the models loaded from S3, keyed by bucket, key and ETag.
+
+    A downloaded model is stored re-pickled with pickle protocol 5: the NumPy arrays of at least
+    min_mmap_bytes (e.g. the KNN reference matrix) are written out of band to one buffers file and
+    are memory mapped read-only when the model is loaded, so they are paged in on use and shared
+    between the processes serving the same model. The total size is bounded, least recently used
+    entries are evicted. Entries are published with an atomic rename, processes can share the cache.
+    A model bundle (.bundle key) is cached unpacked, its arrays are the .npy files of the bundle.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, min_mmap_bytes: int):
+        """
+        :param cache_dir: directory holding one sub directory per cached model version
+        :param max_bytes: maximum size of the cache on disk
+        :param min_mmap_bytes: smallest array stored out of band and memory mapped
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_mmap_bytes = min_mmap_bytes
+
+    @staticmethod
+    def get_key(bucket_name: str, s3_key: str, etag: str) -> str:
+        return hashlib.sha256(f"{bucket_name}/{s3_key}/{etag}".encode()).hexdigest()
+
+    def get_entry_dir(self, bucket_name: str, s3_key: str, etag: str) -> str:
+        return os.path.join(self.cache_dir, self.get_key(bucket_name, s3_key, etag))
+
+    def contains(self, bucket_name: str, s3_key: str, etag: str) -> bool:
+        return os.path.isfile(os.path.join(self.get_entry_dir(bucket_name, s3_key, etag), MANIFEST_FILE_NAME))
+
+    def write_entry(self, entry_dir: str, obj: object, manifest: dict) -> None:
+        """
+        Pickles obj into entry_dir with its large contiguous buffers out of band.
+        """
+        buffers, offset = [], 0
+        with open(os.path.join(entry_dir, BUFFERS_FILE_NAME), 'wb') as buffers_file:
+            def write_buffer(buffer: pickle.PickleBuffer) -> bool:
+                nonlocal offset
+                raw = buffer.raw()
+                if raw.nbytes < self.min_mmap_bytes:
+                    # A true value keeps the buffer in the pickle stream
+                    return True
+                padding = -offset % BUFFER_ALIGNMENT
+                buffers_file.write(b'\0' * padding)
+                buffers.append((offset + padding, raw.nbytes))
+                buffers_file.write(raw)
+                offset += padding + raw.nbytes
+                return False
+
+            with open(os.path.join(entry_dir, PICKLE_FILE_NAME), 'wb') as pickle_file:
+                pickle.dump(obj, pickle_file, protocol=5, buffer_callback=write_buffer)
+        with open(os.path.join(entry_dir, MANIFEST_FILE_NAME), 'w') as manifest_file:
+            json.dump({**manifest, 'buffers': buffers}, manifest_file, indent=4)
+
+    def load_entry(self, entry_dir: str) -> object:
+        """
+        Loads a cached model, its out-of-band arrays are read-only views of the memory mapped buffers file.
+        """
+        with open(os.path.join(entry_dir, MANIFEST_FILE_NAME), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('format') == BUNDLE_FORMAT:
+            return load_model_bundle(entry_dir)
+        buffers = []
+        if manifest['buffers']:
+            with open(os.path.join(entry_dir, BUFFERS_FILE_NAME), 'rb') as buffers_file:
+                # The mapping stays valid after the file is closed, and after an eviction unlinks it
+                mapped = memoryview(mmap.mmap(buffers_file.fileno(), 0, access=mmap.ACCESS_READ))
+            buffers = [mapped[offset:offset + length] for offset, length in manifest['buffers']]
+        with open(os.path.join(entry_dir, PICKLE_FILE_NAME), 'rb') as pickle_file:
+            return pickle.load(pickle_file, buffers=buffers)
+
+    def get(self, bucket_name: str, s3_key: str, etag: str) -> Optional[object]:
+        """
+        Returns the cached model of this version, or None when it is not cached or can not be read.
+        """
+        entry_dir = self.get_entry_dir(bucket_name, s3_key, etag)
+        if not os.path.isfile(os.path.join(entry_dir, MANIFEST_FILE_NAME)):
+            return None
+        try:
+            obj = self.load_entry(entry_dir)
+            # The modification time of the entry orders the evictions
+            os.utime(entry_dir)
+            logging.info(f"Model cache hit for s3://{bucket_name}/{s3_key} {etag}: {entry_dir}")
+            return obj
+        except Exception as e:
+            logging.info(f"Model cache entry {entry_dir} could not be read: {e}")
+            return None
+
+    def put(self, bucket_name: str, s3_key: str, etag: str, download: Callable[[str], None]) -> object:
+        """
+        Downloads a model version into the cache and returns it loaded from the cache.
+        download: writes the object to the file path it is given
+        """
+        try:
+            entry_dir = self.get_entry_dir(bucket_name, s3_key, etag)
+            temp_dir = os.path.join(self.cache_dir, f"tmp-{uuid.uuid4().hex}")
+            os.makedirs(temp_dir)
+            try:
+                download_file_path = os.path.join(temp_dir, 'download.pkl')
+                download(download_file_path)
+                if is_model_bundle(s3_key):
+                    unpack_model_bundle(download_file_path, temp_dir)
+                else:
+                    with open(download_file_path, 'rb') as download_file:
+                        obj = pickle.load(download_file)
+                    self.write_entry(temp_dir, obj, manifest={'bucket_name': bucket_name, 's3_key': s3_key, 'etag': etag,
+                                                              'download_bytes': os.path.getsize(download_file_path)})
+                    del obj
+                os.remove(download_file_path)
+                try:
+                    os.rename(temp_dir, entry_dir)
+                except OSError:
+                    # Another process published the same version first, its entry is identical
+                    if not self.contains(bucket_name, s3_key, etag):
+                        raise
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            self.evict(keep=entry_dir)
+            logging.info(f"Model s3://{bucket_name}/{s3_key} {etag} cached in {entry_dir}")
+            return self.load_entry(entry_dir)
+        except Exception as e:
+            raise MyException(e, sys)
+
+    def get_entries(self) -> list:
+        """
+        Returns (last used time, bytes, entry dir) of the published entries, least recently used first.
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('tmp-') or not os.path.isfile(os.path.join(entry_dir, MANIFEST_FILE_NAME)):
+                continue
+            entry_bytes = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), entry_bytes, entry_dir))
+        return sorted(entries)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Removes the least recently used entries until the cache fits in max_bytes, except keep.
+        """
+        entries = self.get_entries()
+        total_bytes = sum(entry_bytes for _, entry_bytes, _ in entries)
+        for _, entry_bytes, entry_dir in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            logging.info(f"Evicting model cache entry {entry_dir} ({entry_bytes} bytes)")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= entry_bytes
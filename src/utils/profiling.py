@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import threading
+import dataclasses
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.logger import logging
+from src.exception import MyException
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is then not reported
+    resource = None
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+# Stage record of the current thread, steps timed with profile_step are attached to it
+_current = threading.local()
+
+# Only one cProfile profiler can be active per process on Python 3.12+, profiled sections never overlap
+_profiler_lock = threading.Lock()
+
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Returns the peak resident set size of the process in bytes, or None when it can not be read.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def get_artifact_metrics(artifact: object) -> dict:
+    """
+    Returns the rows and bytes of the dataframes/arrays handed over by an artifact. Arrays memory
+    mapped from disk are counted as mapped_bytes, they are only paged in when read.
+    """
+    rows, memory_bytes, mapped_bytes = 0, 0, 0
+    if dataclasses.is_dataclass(artifact):
+        for field in dataclasses.fields(artifact):
+            value = getattr(artifact, field.name)
+            if isinstance(value, pd.DataFrame):
+                rows += len(value)
+                memory_bytes += int(value.memory_usage(index=False).sum())
+            elif isinstance(value, np.ndarray):
+                # Label arrays travel with a feature matrix, only matrices count as rows
+                rows += value.shape[0] if value.ndim > 1 else 0
+                if isinstance(value, np.memmap):
+                    mapped_bytes += value.nbytes
+                else:
+                    memory_bytes += value.nbytes
+    return {'rows': rows, 'memory_bytes': memory_bytes, 'mapped_bytes': mapped_bytes}
+
+
+def get_artifact_file_bytes(artifact: object) -> dict:
+    """
+    Returns the size on disk of every file referenced by an artifact ('*_path' fields) and of the
+    files in every directory it references ('*_dir' fields).
+    """
+    file_bytes = {}
+    if dataclasses.is_dataclass(artifact):
+        for field in dataclasses.fields(artifact):
+            value = getattr(artifact, field.name)
+            if field.name.endswith('_path') and isinstance(value, str) and os.path.isfile(value):
+                file_bytes[value] = os.path.getsize(value)
+            elif field.name.endswith('_dir') and isinstance(value, str) and os.path.isdir(value):
+                for file_name in sorted(os.listdir(value)):
+                    file_path = os.path.join(value, file_name)
+                    if os.path.isfile(file_path):
+                        file_bytes[file_path] = os.path.getsize(file_path)
+            elif dataclasses.is_dataclass(value):
+                file_bytes.update(get_artifact_file_bytes(value))
+    return file_bytes
+
+
+class RunProfiler:
+    """
+    Collects a structured profile of a pipeline run: wall time, CPU time and peak RSS per stage,
+    the timed steps inside each stage, and the rows/bytes each stage produced. The profile is
+    written as json next to the run artifacts.
+
+    When stages run serially, CPU time is the process CPU time, so it includes the worker threads
+    of a stage (parallel export, n_jobs neighbor searches) and the background artifact writes running
+    meanwhile. When stages run concurrently it falls back to the thread CPU time of the stage, which
+    misses its worker threads. The peak RSS is the high water mark of the whole process when the stage ended.
+    """
+
+    def __init__(self, profiler: Optional[str] = None, profile_dir: Optional[str] = None, serial_stages: bool = False):
+        """
+        :param profiler: optional per stage profiler, 'cprofile' or 'pyinstrument'
+        :param profile_dir: directory receiving the per stage profiler outputs
+        :param serial_stages: whether stages run one at a time, CPU time is then measured for the whole process
+        """
+        try:
+            if profiler is not None and profiler not in PROFILERS:
+                raise Exception(f"Unknown profiler {profiler}, expected one of {PROFILERS}")
+            self.profiler = profiler
+            self.profile_dir = profile_dir
+            self.cpu_clock = 'process' if serial_stages else 'thread'
+            self._cpu_time = time.process_time if serial_stages else time.thread_time
+            self.stages = {}
+            self._artifacts = {}
+            self._lock = threading.Lock()
+            self._start_time = time.time()
+        except Exception as e:
+            raise MyException(e, sys)
+
+    @contextmanager
+    def start_profiler(self, stage_name: str):
+        """
+        Runs the optional cProfile/pyinstrument profiler around a stage and saves its output.
+        Only one profiled stage runs at a time: a concurrent stage waits for the lock, so the
+        pipeline runs its stages serially when a profiler is configured. Work the stage hands
+        to other threads (e.g. background writes) is not in its profile.
+        """
+        if self.profiler is None:
+            yield
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with _profiler_lock:
+            if self.profiler == 'cprofile':
+                import cProfile
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    profile.dump_stats(os.path.join(self.profile_dir, f"{stage_name}.prof"))
+            else:
+                from pyinstrument import Profiler
+                profile = Profiler(async_mode='disabled')
+                profile.start()
+                try:
+                    yield
+                finally:
+                    profile.stop()
+                    with open(os.path.join(self.profile_dir, f"{stage_name}.html"), 'w') as profile_file:
+                        profile_file.write(profile.output_html())
+
+    @contextmanager
+    def profile_stage(self, stage_name: str):
+        """
+        Profiles the stage running in the with block. The yielded record can be updated with
+        extra fields, e.g. whether the stage came from the stage cache.
+        """
+        record = {'start_offset_seconds': time.time() - self._start_time, 'steps': {}}
+        previous_record, previous_cpu_time = getattr(_current, 'record', None), getattr(_current, 'cpu_time', None)
+        _current.record, _current.cpu_time = record, self._cpu_time
+        peak_rss_before = get_peak_rss()
+        wall_start, cpu_start = time.perf_counter(), self._cpu_time()
+        try:
+            with self.start_profiler(stage_name):
+                yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall_start
+            record['cpu_seconds'] = self._cpu_time() - cpu_start
+            record['peak_rss_bytes'] = get_peak_rss()
+            if peak_rss_before is not None:
+                record['peak_rss_increase_bytes'] = record['peak_rss_bytes'] - peak_rss_before
+            _current.record, _current.cpu_time = previous_record, previous_cpu_time
+            with self._lock:
+                self.stages[stage_name] = record
+            logging.info(f"Stage profile {stage_name}: wall {record['wall_seconds']:.3f}s, "
+                         f"cpu {record['cpu_seconds']:.3f}s, peak rss {record['peak_rss_bytes']}")
+
+    def record_artifact(self, stage_name: str, artifact: object) -> None:
+        """
+        Records the rows/bytes of a stage artifact, file sizes are read when the profile is written.
+        """
+        with self._lock:
+            self.stages[stage_name].update(get_artifact_metrics(artifact))
+            self._artifacts[stage_name] = artifact
+
+    def write(self, file_path: str) -> dict:
+        """
+        Writes the run profile as json once the artifact files are on disk and returns it.
+        """
+        try:
+            with self._lock:
+                for stage_name, artifact in self._artifacts.items():
+                    file_bytes = get_artifact_file_bytes(artifact)
+                    self.stages[stage_name]['files'] = file_bytes
+                    self.stages[stage_name]['file_bytes'] = sum(file_bytes.values())
+                run_profile = {'wall_seconds': time.time() - self._start_time,
+                               'cpu_clock': self.cpu_clock,
+                               'peak_rss_bytes': get_peak_rss(),
+                               'stages': self.stages}
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as profile_file:
+                json.dump(run_profile, profile_file, indent=4)
+            logging.info(f"Run profile saved: {file_path}")
+            return run_profile
+        except Exception as e:
+            raise MyException(e, sys)
+
+
+def add_step(record: Optional[dict], step_name: str, wall_seconds: float, cpu_seconds: float, rows: Optional[int]) -> None:
+    if record is None:
+        return
+    step = record['steps'].setdefault(step_name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+    step['calls'] += 1
+    step['wall_seconds'] += wall_seconds
+    step['cpu_seconds'] += cpu_seconds
+    if rows is not None:
+        step['rows'] = step.get('rows', 0) + rows
+
+
+@contextmanager
+def profile_step(step_name: str, rows: Optional[int] = None):
+    """
+    Times a heavy call inside a component. The timing is attached to the stage profiled on the
+    current thread and is a no-op outside of a profiled stage, apart from the log line. CPU time
+    is measured with the clock of the stage (process or thread CPU time).
+    step_name: name of the step in the run profile, e.g. 'fit_preprocessor'
+    rows: number of rows processed by the step, when known
+    """
+    cpu_time = getattr(_current, 'cpu_time', None) or time.thread_time
+    wall_start, cpu_start = time.perf_counter(), cpu_time()
+    try:
+        yield
+    finally:
+        wall_seconds = time.perf_counter() - wall_start
+        add_step(getattr(_current, 'record', None), step_name, wall_seconds, cpu_time() - cpu_start, rows)
+        logging.info(f"Step {step_name} took {wall_seconds:.3f}s")
+
+
+def bind_to_current_stage(func: Callable, step_name: str) -> Callable:
+    """
+    Wraps func so that, when it runs on another thread (e.g. the background artifact writer),
+    its timing is still attached to the stage that submitted it. Its CPU time is the thread CPU time
+    of the writer thread, the write overlaps with the stages that run meanwhile.
+    """
+    record = getattr(_current, 'record', None)
+
+    def run(*args, **kwargs):
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_step(record, step_name, time.perf_counter() - wall_start, time.thread_time() - cpu_start, None)
+
+    return run
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import importlib.util
+import threading
+import dataclasses
+from datetime import datetime
+from typing import List, Optional
+
+from src.logger import logging
+from src.exception import MyException
+from src.utils.main_utils import save_object, load_object
+
+# Config fields holding artifact locations are excluded from the stage keys, they change with every run
+PATH_FIELD_SUFFIXES = ('_dir', '_path')
+
+
+def get_config_fingerprint(config: object) -> dict:
+    """
+    Returns the fields of a config dataclass that change what a stage computes,
+    i.e. every field except the timestamped artifact locations
+    config: config dataclass (class or instance)
+    return: dict of field name to value
+    """
+    return {field.name: getattr(config, field.name) for field in dataclasses.fields(config)
+            if not field.name.endswith(PATH_FIELD_SUFFIXES)}
+
+
+def get_code_fingerprint(module_names: List[str]) -> str:
+    """
+    Returns the sha256 of the source files of modules, so that stage keys change with the code
+    computing the stage. The modules are located without being imported.
+    module_names: dotted module names, e.g. 'src.components.data_ingestion'
+    return: hex digest
+    """
+    try:
+        digest = hashlib.sha256()
+        for module_name in sorted(set(module_names)):
+            digest.update(module_name.encode())
+            with open(importlib.util.find_spec(module_name).origin, 'rb') as source_file:
+                digest.update(source_file.read())
+        return digest.hexdigest()
+    except Exception as e:
+        raise MyException(e, sys)
+
+
+class StageCache:
+    """
+    Content addressed cache of pipeline stage artifacts.
+
+    A stage key is the hash of everything its output depends on: the keys of its input
+    artifacts, the relevant schema.yaml/model.yaml sections, the stage config and the source
+    of the modules computing it (get_code_fingerprint). A stage
+    whose key is in the cache is not run again and its previous artifact is reused.
+    The number of cached stages is bounded, least recently used entries are evicted
+    together with their artifact directory.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int):
+        """
+        :param cache_dir: directory holding the cache index and the cached artifacts
+        :param max_entries: maximum number of cached stage outputs
+        """
+        try:
+            self.cache_dir = cache_dir
+            self.max_entries = max_entries
+            self.index_file_path = os.path.join(cache_dir, 'index.json')
+            self._lock = threading.Lock()
+            self._pending = {}
+            self._used_keys = set()
+            self._index = {}
+            if os.path.exists(self.index_file_path):
+                with open(self.index_file_path, 'r') as index_file:
+                    self._index = json.load(index_file)
+        except Exception as e:
+            raise MyException(e, sys)
+
+    @staticmethod
+    def get_key(stage_name: str, **inputs) -> str:
+        """
+        Returns the content address of a stage from its name and its inputs.
+        """
+        payload = json.dumps({'stage': stage_name, 'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def get_artifact_file_paths(artifact: object) -> list:
+        return [getattr(artifact, field.name) for field in dataclasses.fields(artifact)
+                if field.name.endswith(PATH_FIELD_SUFFIXES) and isinstance(getattr(artifact, field.name), str)]
+
+    def get(self, key: str) -> Optional[object]:
+        """
+        Returns the cached artifact of key, or None when it is not cached or its files are gone.
+        """
+        try:
+            with self._lock:
+                entry = self._index.get(key)
+                if entry is None:
+                    return None
+                artifact = load_object(file_path = entry['artifact_file_path'])
+                if not all(os.path.exists(path) for path in self.get_artifact_file_paths(artifact)):
+                    logging.info(f"Stage cache entry {key[:12]} of {entry['stage']} has missing files, ignoring it")
+                    return None
+                entry['last_used'] = datetime.now().isoformat()
+                self._used_keys.add(key)
+                logging.info(f"Stage cache hit for {entry['stage']}: {key[:12]}")
+                return artifact
+        except Exception as e:
+            logging.info(f"Stage cache entry {key[:12]} could not be read: {e}")
+            return None
+
+    def put(self, key: str, stage_name: str, artifact: object, stage_dir: str) -> None:
+        """
+        Registers the artifact of a freshly run stage. Entries are only written to the index
+        by commit, once the artifact files are known to be on disk.
+        """
+        # In-memory objects are handed to the next stage directly and are not cached
+        in_memory_fields = {field.name: None for field in dataclasses.fields(artifact) if not field.compare}
+        with self._lock:
+            # Entries pointing at the same stage directory had their files overwritten by this run
+            for stale_key in [stale_key for stale_key, entry in self._index.items() if entry['stage_dir'] == stage_dir]:
+                self._index.pop(stale_key)
+            self._pending[key] = (stage_name, dataclasses.replace(artifact, **in_memory_fields), stage_dir)
+            self._used_keys.add(key)
+
+    def commit(self) -> None:
+        """
+        Writes the pending entries to the index and evicts the least recently used entries
+        above max_entries, except the ones used by the current run.
+        """
+        try:
+            with self._lock:
+                now = datetime.now().isoformat()
+                for key, (stage_name, artifact, stage_dir) in self._pending.items():
+                    artifact_file_path = os.path.join(self.cache_dir, f"{key}.pkl")
+                    save_object(file_path = artifact_file_path, obj = artifact)
+                    self._index[key] = {'stage': stage_name, 'artifact_file_path': artifact_file_path,
+                                        'stage_dir': stage_dir, 'created': now, 'last_used': now}
+                self._pending = {}
+
+                evictable = sorted((entry['last_used'], key) for key, entry in self._index.items()
+                                   if key not in self._used_keys)
+                n_evictions = max(0, len(self._index) - self.max_entries)
+                for _, key in evictable[:n_evictions]:
+                    entry = self._index.pop(key)
+                    logging.info(f"Evicting stage cache entry {key[:12]} of {entry['stage']}: {entry['stage_dir']}")
+                    shutil.rmtree(entry['stage_dir'], ignore_errors=True)
+                    run_dir = os.path.dirname(entry['stage_dir'])
+                    if os.path.isdir(run_dir) and len(os.listdir(run_dir)) == 0:
+                        os.rmdir(run_dir)
+                    if os.path.exists(entry['artifact_file_path']):
+                        os.remove(entry['artifact_file_path'])
+
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.index_file_path + '.tmp', 'w') as index_file:
+                    json.dump(self._index, index_file, indent=4)
+                os.replace(self.index_file_path + '.tmp', self.index_file_path)
+        except Exception as e:
+            raise MyException(e, sys)